@@ -1,15 +1,29 @@
 """AWS Helper Classes"""
+import calendar
+import hashlib
+import json
 import logging
+import math
 import os
+import random
+import re
+import threading
 import time
 import uuid
-from collections import defaultdict
+import zlib
+from collections import defaultdict, namedtuple
 
 import boto3
 import botocore
+import botocore.config
 from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple  # noqa
 
+from ardere.exceptions import (
+    CreateServicesException,
+    InsufficientCapacityException,
+)
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -18,10 +32,20 @@ dir_path = os.path.dirname(os.path.realpath(__file__))
 parent_dir_path = os.path.dirname(dir_path)
 wait_script_path = os.path.join(parent_dir_path, "src", "shell",
                                 "waitforcluster.sh")
+runstep_script_path = os.path.join(parent_dir_path, "src", "shell",
+                                   "runstep.sh")
 telegraf_script_path = os.path.join(parent_dir_path, "src", "shell",
                                     "telegraf.toml")
 metric_create_script = os.path.join(parent_dir_path, "ardere", "scripts",
                                     "metric_creator.py")
+annotate_script = os.path.join(parent_dir_path, "ardere", "scripts",
+                               "annotator.py")
+statsd_relay_script = os.path.join(parent_dir_path, "ardere", "scripts",
+                                   "statsd_relay.py")
+histogram_merger_script = os.path.join(parent_dir_path, "ardere", "scripts",
+                                       "histogram_merger.py")
+metrics_aggregator_script = os.path.join(parent_dir_path, "ardere",
+                                         "scripts", "metrics_aggregator.py")
 
 # EC2 userdata to setup values on load
 # Settings for net.ipv4 settings based on:
@@ -88,6 +112,201 @@ for vcpu, instance_types in ec2_type_by_vcpu.items():
     for instance_type in instance_types:
         ec2_vcpu_by_type[instance_type] = vcpu
 
+# RunInstances error codes indicating EC2 is out of an instance type
+CAPACITY_ERROR_CODES = ("InsufficientInstanceCapacity",
+                        "InstanceLimitExceeded",
+                        "Unsupported")
+
+# RunInstances error codes indicating a spot request can't be fulfilled
+SPOT_ERROR_CODES = CAPACITY_ERROR_CODES + ("SpotMaxPriceTooLow",
+                                           "MaxSpotInstanceCountExceeded")
+
+# Tag of an instance launched in place of another instance type, holding
+# the type it stands in for. Instances are counted as that type, which
+# keeps the substitutes of a plan known to every state and retry.
+SUBSTITUTE_TAG = "StandsInFor"
+
+# Memory (MiB) of the instance types above for packing steps together
+ec2_memory_by_type = {
+    "t2.nano": 512, "t2.micro": 1024, "t2.small": 2048, "t2.medium": 4096,
+    "t2.large": 8192, "t2.xlarge": 16384, "t2.2xlarge": 32768,
+    "m3.medium": 3840, "m3.large": 7680, "m3.xlarge": 15360,
+    "m3.2xlarge": 30720,
+    "m4.large": 8192, "m4.xlarge": 16384, "m4.2xlarge": 32768,
+    "m4.4xlarge": 65536, "m4.10xlarge": 163840, "m4.16xlarge": 262144,
+    "c3.large": 3840, "c3.xlarge": 7680, "c3.2xlarge": 15360,
+    "c3.4xlarge": 30720, "c3.8xlarge": 61440,
+    "c4.large": 3840, "c4.xlarge": 7680, "c4.2xlarge": 15360,
+    "c4.4xlarge": 30720, "c4.8xlarge": 61440,
+    "r3.large": 15616, "r3.xlarge": 31232, "r3.2xlarge": 62464,
+    "r3.4xlarge": 124928, "r3.8xlarge": 249856,
+    "r4.large": 15616, "r4.xlarge": 31232, "r4.2xlarge": 62464,
+    "r4.4xlarge": 124928, "r4.8xlarge": 249856, "r4.16xlarge": 499712,
+    "x1.16xlarge": 999424, "x1.32xlarge": 1998848,
+}
+
+# Fraction of an instance's memory the OS and ECS agent keep for themselves
+ECS_MEMORY_OVERHEAD = 0.1
+
+# Resources reserved for the telegraf container run alongside every step
+TELEGRAF_CPU_UNITS = 512
+TELEGRAF_MEMORY_RESERVATION = 256
+
+# Maximum amount of container definitions ECS accepts per task definition,
+# a step's copies share it with telegraf and the statsd relay
+MAX_CONTAINERS_PER_TASK = 10
+
+# Resources reserved for the statsd relay run alongside every step when
+# the plan keeps latency histograms. Telegraf then listens for statsd
+# metrics this far above the step's statsd port, the relay passes them on.
+STATSD_RELAY_CPU_UNITS = 128
+STATSD_RELAY_MEMORY_RESERVATION = 64
+STATSD_RELAY_PORT_OFFSET = 1000
+
+# Significant digits latency histograms keep of every timing
+DEFAULT_HISTOGRAM_PRECISION = 2
+
+# Port the metrics aggregator on the metrics instance takes writes on. With
+# metrics aggregated per step, hosts write to it in place of InfluxDB and
+# only this share of them also have their own series written.
+METRICS_AGGREGATOR_PORT = 8186
+DEFAULT_HOST_SAMPLE_RATE = 0.0
+
+# Name of the aggregator's container in the metrics service, which only
+# has one when created for a plan aggregating metrics per step
+METRICS_AGGREGATOR_CONTAINER = "metrics-aggregator"
+
+# CPU units of the containers on the metrics instance besides InfluxDB,
+# which gets the rest of it. Room is left for the metric setup tasks that
+# run at once, the histogram merger and a setup or annotation task.
+GRAFANA_CPU_UNITS = 256
+METRICS_AGGREGATOR_CPU_UNITS = 256
+METRICS_SETUP_CPU_UNITS = 128
+METRICS_SETUP_TASKS = 2
+
+# Memory reserved for a step's container unless it specifies otherwise
+DEFAULT_MEMORY_RESERVATION = 256
+
+# Port telegraf listens for statsd metrics on. Steps packed onto shared
+# instances are each given their own port counting up from this one.
+DEFAULT_STATSD_PORT = 8125
+
+# Maximum amount of services DescribeServices accepts per call
+DESCRIBE_SERVICES_BATCH_SIZE = 10
+
+# Bounds of how many API calls are made at once when fanning out, the
+# limit starts at the initial value and adapts to throttling between them
+MAX_API_CONCURRENCY = 32
+INITIAL_API_CONCURRENCY = 8
+
+# Sustained calls per second and burst size allowed per API family. These
+# sit under the documented AWS limits so fan-out seldom gets throttled.
+API_RATE_LIMITS = {
+    "ecs": (20, 40),
+    "ec2": (20, 100),
+}
+DEFAULT_API_RATE_LIMIT = (10, 20)
+
+# Error codes AWS API's use to indicate we're being throttled
+THROTTLE_ERROR_CODES = ("Throttling", "ThrottlingException",
+                        "RequestLimitExceeded", "TooManyRequestsException")
+
+# Attempts at a throttled call, and the base of its backoff in seconds
+THROTTLE_RETRIES = 5
+THROTTLE_BACKOFF = 0.5
+
+# Seconds a step's service is scaled up ahead of its run_delay when it
+# reuses instances from steps that ran before it. Instances are only
+# shared when the earlier steps end at least this long before the later
+# one starts, leaving time to stop the earlier services and drain them.
+HOST_REUSE_DELAY = 30
+
+# Share of a step's tasks that must be running for the plan to start, once
+# the grace period since its services were created is over. Until then all
+# of them must be running.
+DEFAULT_READY_THRESHOLD = 1.0
+DEFAULT_READY_GRACE = 120
+
+# Seconds to wait for the services to be ready before giving up, what
+# happens then is up to the ready policy: "abort" the plan or "start" it
+# with the tasks that are running. The timeout can't exceed the retries the
+# state machine allows for readiness, 180 attempts 10 seconds apart, or the
+# policy would never be applied.
+DEFAULT_READY_TIMEOUT = 1500
+MAX_READY_TIMEOUT = 1800
+DEFAULT_READY_POLICY = "abort"
+
+# Seconds a step's command has to exit after being signalled at the end of
+# its run window before it's killed
+DEFAULT_STOP_GRACE = 10
+
+# Where a step's container keeps the cluster start time
+START_TIME_FILE = "/tmp/ardere_start_time"
+
+# GETs per second the containers of a plan may make, all together, while
+# polling for the ready file, and the bounds of the interval each of them
+# polls at to stay under it. The plan starts a couple of intervals after
+# the ready file is dropped so every container learns of the start before
+# it comes around.
+READY_POLL_RATE = 25
+MIN_READY_POLL = 4
+MAX_READY_POLL = 60
+
+# Seconds a running instance may take to join the cluster before it's
+# considered a straggler and replaced
+STRAGGLER_GRACE = 300
+
+# Tasks that may fail to start on an instance before it's considered bad,
+# and the stop reasons that point at the instance rather than the step
+STRAGGLER_TASK_FAILURES = 3
+HOST_FAILURE_REASONS = ("CannotPullContainerError",
+                        "CannotCreateContainerError",
+                        "CannotStartContainerError",
+                        "DockerTimeoutError")
+
+# Who annotation tasks are started by, apart from the metric creation
+# task that's started by the plan run
+ANNOTATION_TASK_STARTED_BY = "ardere-annotations"
+
+# Who the tasks merging the latency histograms of a run are started by
+HISTOGRAM_MERGER_STARTED_BY = "ardere-histograms"
+
+# Characters the container overrides of a task may take up as JSON. The
+# annotations are split across as many tasks as it takes to stay within.
+MAX_CONTAINER_OVERRIDES_SIZE = 8192
+
+# Tasks of a step that may stop, per task it runs, before it's considered
+# to be crash looping
+DEFAULT_CRASH_LOOP_THRESHOLD = 3
+
+# Stop reason of tasks stopped by scaling their service down
+SCALING_STOP_REASON = "Scaling activity initiated by"
+
+# Stop reasons of tasks stopped along with their instance, such as a
+# straggler or reclaimed spot instance, which aren't failures of the step
+HOST_STOP_REASONS = ("Host EC2", "Container instance deregistration",
+                     "Your Spot Task was interrupted")
+
+# Containers run alongside a step's copies. ECS stops them once the step
+# exits, so only how the step's own containers exited tells of a failure.
+SIDECAR_CONTAINERS = ("telegraf", "statsd-relay")
+
+# Maximum amount of tasks DescribeTasks accepts per call
+DESCRIBE_TASKS_BATCH_SIZE = 100
+
+# Hex digits of the task definition content hash kept in a step's family
+TASK_FAMILY_HASH_LEN = 32
+
+# Log stream prefix of step containers. Step task definitions are shared
+# between runs so it can't name the run, the log streams of a run are
+# listed in its plan instead.
+STEP_LOG_STREAM_PREFIX = "ardere"
+
+# Plan keys the state machine reads itself, or that change on every poll,
+# these are passed between states alongside the plan state reference rather
+# than stored with the plan
+PLAN_REFERENCE_KEYS = ("next_check_wait", "services_ready", "current_phase")
+
 
 def cpu_units_for_instance_type(instance_type):
     # type: (str) -> int
@@ -102,10 +321,239 @@ def cpu_units_for_instance_type(instance_type):
     return (ec2_vcpu_by_type[instance_type] * 1024) - 512
 
 
+def memory_units_for_instance_type(instance_type):
+    # type: (str) -> int
+    """Calculate how much memory (MiB) ECS can reserve on an instance_type"""
+    return int(ec2_memory_by_type[instance_type] * (1 - ECS_MEMORY_OVERHEAD))
+
+
+def equivalent_instance_types(instance_type):
+    # type: (str) -> List[str]
+    """List the instance types that can stand in for instance_type
+
+    These have the same vcpu count so steps get the same cpu units. Burstable
+    t2 types are only substituted for each other as their cpu credits run
+    out under sustained load.
+
+    """
+    burstable = instance_type.startswith("t2.")
+    return [
+        candidate for candidate in
+        ec2_type_by_vcpu[ec2_vcpu_by_type[instance_type]]
+        if candidate != instance_type and
+        candidate.startswith("t2.") == burstable
+    ]
+
+
+def ready_poll_interval(steps):
+    # type: (List[Dict[str, Any]]) -> int
+    """Seconds each container of a plan waits between polls for the
+    ready file, so the polls of all of them stay around READY_POLL_RATE
+
+    Every copy of a step on an instance polls on its own.
+
+    """
+    tasks = sum(step["instance_count"] * step.get("tasks_per_instance", 1)
+                for step in steps)
+    interval = int(math.ceil(float(tasks) / READY_POLL_RATE))
+    return min(max(interval, MIN_READY_POLL), MAX_READY_POLL)
+
+
+ApiResult = namedtuple("ApiResult", ["item", "result", "error"])
+
+
+class TokenBucket(object):
+    """Paces calls to at most rate per second, allowing bursts of up to
+    burst calls"""
+    def __init__(self, rate, burst):
+        # type: (float, int) -> None
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # type: () -> None
+        """Block until a call may be made"""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ApiExecutor(object):
+    """Runs AWS API calls concurrently as fast as AWS allows
+
+    The amount of concurrent work is limited with AIMD: every successful
+    call raises the limit a little and every throttled call halves it.
+    Calls are also paced per AWS api with a token bucket. Throttled
+    calls are retried with jittered exponential backoff, any other
+    failure is returned to the caller.
+
+    """
+    def __init__(self, min_concurrency=1,
+                 max_concurrency=MAX_API_CONCURRENCY,
+                 initial_concurrency=INITIAL_API_CONCURRENCY):
+        # type: (int, int, int) -> None
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self._limit = float(initial_concurrency)
+        self._active = 0
+        self._condition = threading.Condition()
+        self._buckets = {}  # type: Dict[str, TokenBucket]
+
+    @property
+    def limit(self):
+        # type: () -> int
+        return int(self._limit)
+
+    def _bucket(self, api):
+        # type: (str) -> TokenBucket
+        with self._condition:
+            if api not in self._buckets:
+                rate, burst = API_RATE_LIMITS.get(api,
+                                                  DEFAULT_API_RATE_LIMIT)
+                self._buckets[api] = TokenBucket(rate, burst)
+            return self._buckets[api]
+
+    def _succeeded(self):
+        with self._condition:
+            self._limit = min(self.max_concurrency,
+                              self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+    def _throttled(self):
+        with self._condition:
+            self._limit = max(self.min_concurrency, self._limit / 2)
+
+    def call(self, api, method, **kwargs):
+        # type: (str, Any, **Any) -> Any
+        """Call a method of an AWS api, retrying it while throttled"""
+        bucket = self._bucket(api)
+        for attempt in range(THROTTLE_RETRIES):
+            bucket.acquire()
+            try:
+                result = method(**kwargs)
+            except botocore.exceptions.ClientError as exc:
+                code = exc.response.get("Error", {}).get("Code")
+                if code not in THROTTLE_ERROR_CODES:
+                    raise
+                self._throttled()
+                if attempt == THROTTLE_RETRIES - 1:
+                    raise
+                time.sleep(random.uniform(0, THROTTLE_BACKOFF * 2 ** attempt))
+                continue
+            self._succeeded()
+            return result
+
+    def _run(self, func, item):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+        try:
+            return func(item)
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def map(self, func, items):
+        # type: (Any, List[Any]) -> List[ApiResult]
+        """Run func over items concurrently within the concurrency limit
+
+        Returns an ApiResult per item, in order, holding either what func
+        returned or the exception it raised.
+
+        """
+        items = list(items)
+        if not items:
+            return []
+        workers = min(len(items), self.max_concurrency)
+        with ThreadPoolExecutor(max_workers=workers) as executer:
+            futures = [executer.submit(self._run, func, item)
+                       for item in items]
+        results = []
+        for item, future in zip(items, futures):
+            error = future.exception()
+            if error:
+                results.append(ApiResult(item, None, error))
+            else:
+                results.append(ApiResult(item, future.result(), None))
+        return results
+
+
+# Shared by every ECSManager so warm invocations keep the learned limit
+api_executor = ApiExecutor()
+
+
+class ApiCallCounter(object):
+    """Counts the AWS API calls made through the shared clients, by
+    service and operation"""
+    def __init__(self):
+        self._counts = defaultdict(int)  # type: Dict[str, int]
+        self._lock = threading.Lock()
+
+    def record(self, event_name, **kwargs):
+        # type: (str, **Any) -> None
+        """botocore before-call handler"""
+        _, service, operation = event_name.split(".", 2)
+        with self._lock:
+            self._counts["{}.{}".format(service, operation)] += 1
+
+    def snapshot(self):
+        # type: () -> Dict[str, int]
+        with self._lock:
+            return dict(self._counts)
+
+    def since(self, snapshot):
+        # type: (Dict[str, int]) -> Dict[str, int]
+        """Return the calls made since a snapshot was taken"""
+        return {name: count - snapshot.get(name, 0)
+                for name, count in self.snapshot().items()
+                if count > snapshot.get(name, 0)}
+
+
+# Counts of a warm Lambda container carry over, callers diff snapshots
+api_calls = ApiCallCounter()
+
+# Clients live at module level so a warm Lambda container reuses them, and
+# their kept-alive connections, across invocations. The pool is sized so
+# the executor at full concurrency never waits on a connection.
+CLIENT_CONFIG = botocore.config.Config(
+    max_pool_connections=MAX_API_CONCURRENCY)
+_clients = {}  # type: Dict[Tuple[Any, str], Any]
+_clients_lock = threading.Lock()
+
+
+def cached_client(boto, service_name):
+    # type: (Any, str) -> Any
+    """Return the shared client for an AWS service, creating it on first
+    use"""
+    key = (boto, service_name)
+    with _clients_lock:
+        if key not in _clients:
+            client = boto.client(service_name, config=CLIENT_CONFIG)
+            client.meta.events.register("before-call", api_calls.record)
+            _clients[key] = client
+        return _clients[key]
+
+
 class ECSManager(object):
     """ECS Manager queries and manages an ECS cluster"""
     # For testing purposes
     boto = boto3
+    api = api_executor
 
     # ECS optimized AMI id's
     ecs_ami_ids = {
@@ -121,14 +569,19 @@ class ECSManager(object):
     python_container = "jfloff/alpine-python:2.7-slim"
 
     _wait_script = None
+    _runstep_script = None
     _telegraf_script = None
     _metric_create_script = None
+    _annotate_script = None
+    _statsd_relay_script = None
+    _histogram_merger_script = None
+    _metrics_aggregator_script = None
 
     def __init__(self, plan):
         # type: (Dict[str, Any]) -> None
         """Create and return a ECSManager for a cluster of the given name."""
-        self._ecs_client = self.boto.client('ecs')
-        self._ec2_client = self.boto.client('ec2')
+        self._ecs_client = cached_client(self.boto, 'ecs')
+        self._ec2_client = cached_client(self.boto, 'ec2')
         self._ecs_name = plan["ecs_name"]
         self._plan = plan
 
@@ -142,6 +595,21 @@ class ECSManager(object):
 
         self._plan_uuid = plan["plan_run_uuid"]
 
+        # Stopped tasks of the plan run, described once per state
+        self._run_stopped_tasks = None  # type: Optional[List[Dict[str, Any]]]  # noqa
+
+    def _ecs_call(self, operation, **kwargs):
+        # type: (str, **Any) -> Any
+        """Call an ECS API operation through the shared API executor"""
+        return self.api.call("ecs", getattr(self._ecs_client, operation),
+                             **kwargs)
+
+    def _ec2_call(self, operation, **kwargs):
+        # type: (str, **Any) -> Any
+        """Call an EC2 API operation through the shared API executor"""
+        return self.api.call("ec2", getattr(self._ec2_client, operation),
+                             **kwargs)
+
     @property
     def wait_script(self):
         if not self._wait_script:
@@ -149,6 +617,13 @@ class ECSManager(object):
                 self._wait_script = f.read()
         return self._wait_script
 
+    @property
+    def runstep_script(self):
+        if not self._runstep_script:
+            with open(runstep_script_path, 'r') as f:
+                self._runstep_script = f.read()
+        return self._runstep_script
+
     @property
     def telegraf_script(self):
         if not self._telegraf_script:
@@ -163,6 +638,34 @@ class ECSManager(object):
                 self._metric_create_script = f.read()
         return self._metric_create_script
 
+    @property
+    def annotate_script(self):
+        if not self._annotate_script:
+            with open(annotate_script, 'r') as f:
+                self._annotate_script = f.read()
+        return self._annotate_script
+
+    @property
+    def statsd_relay_script(self):
+        if not self._statsd_relay_script:
+            with open(statsd_relay_script, 'r') as f:
+                self._statsd_relay_script = f.read()
+        return self._statsd_relay_script
+
+    @property
+    def histogram_merger_script(self):
+        if not self._histogram_merger_script:
+            with open(histogram_merger_script, 'r') as f:
+                self._histogram_merger_script = f.read()
+        return self._histogram_merger_script
+
+    @property
+    def metrics_aggregator_script(self):
+        if not self._metrics_aggregator_script:
+            with open(metrics_aggregator_script, 'r') as f:
+                self._metrics_aggregator_script = f.read()
+        return self._metrics_aggregator_script
+
     @property
     def plan_uuid(self):
         return self._plan_uuid
@@ -174,6 +677,23 @@ class ECSManager(object):
             key="{}.ready".format(self._plan_uuid)
         )
 
+    @property
+    def s3_run_file(self):
+        return "https://s3.amazonaws.com/{bucket}/{key}".format(
+            bucket=self.s3_ready_bucket,
+            key="{}.run".format(self._ecs_name)
+        )
+
+    @property
+    def step_log_config(self):
+        return {
+            "logDriver": "awslogs",
+            "options": {"awslogs-group": self.container_log_group,
+                        "awslogs-region": "us-east-1",
+                        "awslogs-stream-prefix": STEP_LOG_STREAM_PREFIX
+                        }
+        }
+
     @property
     def log_config(self):
         return {
@@ -197,10 +717,14 @@ class ECSManager(object):
     def grafana_admin_password(self):
         return self._plan["metrics_options"]["dashboard"]["admin_password"]
 
-    def family_name(self, step):
-        # type: (Dict[str, Any]) -> str
-        """Generate a consistent family name for a given step"""
-        return step["name"] + "-" + self._plan_uuid
+    def family_name(self, step, task_definition):
+        # type: (Dict[str, Any], Dict[str, Any]) -> str
+        """Generate a family name for a step from a hash of its task
+        definition, so identical steps share a family across runs"""
+        digest = hashlib.sha256(
+            json.dumps(task_definition, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        return "{}-{}".format(step["name"], digest[:TASK_FAMILY_HASH_LEN])
 
     def metrics_family_name(self):
         # type: () -> str
@@ -212,14 +736,23 @@ class ECSManager(object):
         """Generate a consistent metric setup family name"""
         return "{}-metrics-setup".format(self._ecs_name)
 
-    def query_active_instances(self, additional_tags=None):
-        # type: (Optional[Dict[str, str]]) -> Dict[str, int]
-        """Query EC2 for all the instances owned by ardere for this cluster."""
-        instance_dict = defaultdict(int)
-        paginator = self._ec2_client.get_paginator('describe_instances')
-        filters = {"Owner": "ardere", "ECSCluster": self._ecs_name}
-        if additional_tags:
-            filters.update(additional_tags)
+    def query_instances(self, additional_tags=None):
+        # type: (Optional[Dict[str, str]]) -> List[Dict[str, Any]]
+        """Query EC2 for the pending/running instances owned by ardere for
+        this cluster and return their descriptions."""
+        return self._describe_ardere_instances(
+            self._ec2_client,
+            dict(ECSCluster=self._ecs_name, **(additional_tags or {}))
+        )
+
+    @staticmethod
+    def _describe_ardere_instances(ec2_client, tags):
+        # type: (Any, Dict[str, str]) -> List[Dict[str, Any]]
+        """Describe pending/running ardere owned instances with tags"""
+        instances = []
+        paginator = ec2_client.get_paginator('describe_instances')
+        filters = {"Owner": "ardere"}
+        filters.update(tags)
         response_iterator = paginator.paginate(
             Filters=[
                 {
@@ -234,9 +767,329 @@ class ECSManager(object):
                     # Determine if the instance is pending/running and count
                     # 0 = Pending, 16 = Running, > is all shutting down, etc.
                     if instance["State"]["Code"] <= 16:
-                        instance_dict[instance["InstanceType"]] += 1
+                        instances.append(instance)
+        return instances
+
+    def query_active_instances(self, additional_tags=None, exclude=None):
+        # type: (Optional[Dict[str, str]], Optional[List[str]]) -> Dict[str, int]  # noqa
+        """Query EC2 for all the instances owned by ardere for this cluster.
+
+        Instances launched in place of another instance type are counted
+        as the type they stand in for. Instances with an id in exclude
+        aren't counted, such as those just terminated that EC2 may still
+        describe as running.
+
+        """
+        instance_dict = defaultdict(int)
+        for instance in self.query_instances(additional_tags):
+            if exclude and instance["InstanceId"] in exclude:
+                continue
+            tags = {tag["Key"]: tag["Value"]
+                    for tag in instance.get("Tags", [])}
+            instance_dict[tags.get(SUBSTITUTE_TAG,
+                                   instance["InstanceType"])] += 1
         return instance_dict
 
+    def query_instance_substitutes(self):
+        # type: () -> Dict[str, Dict[str, int]]
+        """Query EC2 for the cluster's instances launched in place of
+        another instance type
+
+        Returns a dict of the instance types stood in for to a dict of the
+        instance types and counts standing in for them.
+
+        """
+        substitutes = defaultdict(lambda: defaultdict(int))
+        for instance in self.query_instances():
+            tags = {tag["Key"]: tag["Value"]
+                    for tag in instance.get("Tags", [])}
+            if SUBSTITUTE_TAG in tags:
+                substitutes[tags[SUBSTITUTE_TAG]][
+                    instance["InstanceType"]] += 1
+        return {instance_type: dict(types)
+                for instance_type, types in substitutes.items()}
+
+    @classmethod
+    def pooled_clusters(cls):
+        # type: () -> List[str]
+        """Return the names of all clusters with pooled instances"""
+        instances = cls._describe_ardere_instances(
+            cached_client(cls.boto, 'ec2'), dict(Pool="warm"))
+        clusters = set()
+        for instance in instances:
+            tags = {tag["Key"]: tag["Value"]
+                    for tag in instance.get("Tags", [])}
+            if "ECSCluster" in tags:
+                clusters.add(tags["ECSCluster"])
+        return sorted(clusters)
+
+    def touch_instances(self):
+        # type: () -> List[str]
+        """Mark all the cluster's pooled instances as used right now
+
+        Called when a plan claims the pool and again when it's done with
+        it, so the reaper only counts idle time from the end of the last
+        plan.
+
+        """
+        instance_ids = [instance["InstanceId"] for instance in
+                        self.query_instances(dict(Pool="warm"))]
+        if instance_ids:
+            self._ec2_client.create_tags(
+                Resources=instance_ids,
+                Tags=[dict(Key="LastUsed", Value=str(int(time.time())))]
+            )
+        return instance_ids
+
+    def reap_idle_instances(self, idle_ttl):
+        # type: (int) -> List[str]
+        """Terminate pooled instances idle for longer than idle_ttl seconds
+
+        An instance is idle when it has been longer than idle_ttl since it
+        was last used by a plan and it isn't running or starting any ECS
+        tasks. Nothing is terminated while a plan runs in the cluster, its
+        instances may sit without tasks waiting on deferred steps. Returns
+        the instance id's terminated.
+
+        """
+        if self._plan_in_flight():
+            logger.info("Plan running in {}, not reaping".format(
+                self._ecs_name))
+            return []
+
+        # Count the tasks on every instance registered with the cluster
+        task_counts = {
+            instance_id: container["runningTasksCount"] +
+            container["pendingTasksCount"]
+            for instance_id, container in self._container_instances().items()
+        }
+
+        now = time.time()
+        idle = []
+        for instance in self.query_instances(dict(Pool="warm")):
+            tags = {tag["Key"]: tag["Value"]
+                    for tag in instance.get("Tags", [])}
+            try:
+                last_used = int(tags["LastUsed"])
+            except (KeyError, ValueError):
+                continue
+            if now - last_used < idle_ttl:
+                continue
+            if task_counts.get(instance["InstanceId"], 0):
+                continue
+            idle.append(instance["InstanceId"])
+
+        if idle:
+            logger.info("Terminating idle instances: {}".format(idle))
+            self._ec2_client.terminate_instances(InstanceIds=idle)
+        return idle
+
+    def _plan_in_flight(self):
+        # type: () -> bool
+        """Return whether the cluster has services other than the metrics
+        one, which only exist while a plan runs"""
+        paginator = self._ecs_client.get_paginator('list_services')
+        for page in paginator.paginate(cluster=self._ecs_name):
+            for service_arn in page["serviceArns"]:
+                if service_arn.rsplit("/", 1)[-1] != "metrics":
+                    return True
+        return False
+
+    def _container_instances(self):
+        # type: () -> Dict[str, Dict[str, Any]]
+        """Describe every instance registered with the cluster, by EC2
+        instance id"""
+        containers = {}
+        paginator = self._ecs_client.get_paginator('list_container_instances')
+        for page in paginator.paginate(cluster=self._ecs_name):
+            arns = page["containerInstanceArns"]
+            if not arns:
+                continue
+            response = self._ecs_client.describe_container_instances(
+                cluster=self._ecs_name,
+                containerInstances=arns
+            )
+            for container in response["containerInstances"]:
+                containers[container["ec2InstanceId"]] = container
+        return containers
+
+    def _stopped_tasks(self):
+        # type: () -> List[Dict[str, Any]]
+        """Describe the stopped tasks of the plan run ECS still knows of
+
+        Tasks created before the run's services were belong to earlier
+        runs. The tasks are only described on the first call, every state
+        creates its own ECSManager so later calls share them.
+
+        """
+        if self._run_stopped_tasks is None:
+            since = int(self._plan.get("services_created_at", 0))
+            self._run_stopped_tasks = [
+                task for task in self._described_tasks("STOPPED")
+                if not task.get("createdAt") or
+                calendar.timegm(task["createdAt"].utctimetuple()) >= since
+            ]
+        return self._run_stopped_tasks
+
+    def _described_tasks(self, desired_status):
+        # type: (str) -> List[Dict[str, Any]]
+        """Describe the tasks of the cluster with a desired status"""
+        task_arns = []
+        paginator = self._ecs_client.get_paginator('list_tasks')
+        for page in paginator.paginate(cluster=self._ecs_name,
+                                       desiredStatus=desired_status):
+            task_arns.extend(page["taskArns"])
+
+        tasks = []
+        for i in range(0, len(task_arns), DESCRIBE_TASKS_BATCH_SIZE):
+            response = self._ecs_call(
+                "describe_tasks",
+                cluster=self._ecs_name,
+                tasks=task_arns[i:i + DESCRIBE_TASKS_BATCH_SIZE]
+            )
+            tasks.extend(response["tasks"])
+        return tasks
+
+    @staticmethod
+    def _stop_reasons(task):
+        # type: (Dict[str, Any]) -> List[str]
+        """Return the reasons a task and its containers stopped for"""
+        return [task.get("stoppedReason", "")] + \
+            [container.get("reason", "")
+             for container in task.get("containers", [])]
+
+    def _task_start_failures(self, tasks):
+        # type: (List[Dict[str, Any]]) -> Dict[str, int]
+        """Count the stopped tasks that failed to start because of their
+        instance, by container instance ARN"""
+        failures = defaultdict(int)
+        for task in tasks:
+            if any(host_reason in reason
+                   for reason in self._stop_reasons(task)
+                   for host_reason in HOST_FAILURE_REASONS):
+                failures[task.get("containerInstanceArn")] += 1
+        return failures
+
+    @staticmethod
+    def _task_failed(task):
+        # type: (Dict[str, Any]) -> bool
+        """Return whether a container of the step in a stopped task exited
+        non-zero or never ran"""
+        containers = [container for container in task.get("containers", [])
+                      if container.get("name") not in SIDECAR_CONTAINERS]
+        return not containers or \
+            any(container.get("exitCode") != 0 for container in containers)
+
+    def task_failures(self, steps):
+        # type: (List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]
+        """Summarize the tasks of steps that failed, stopping without being
+        scaled down or their instance going away
+
+        A task failed when a container of the step exited non-zero or never
+        ran. Steps whose command finishes early exit 0 and are restarted by
+        their service, those tasks aren't failures. Returns a dict of step
+        name to how many of its tasks failed, and the reason and exit code
+        of the latest failure.
+
+        """
+        groups = {"service:{}".format(step["name"]): step["name"]
+                  for step in steps}
+        failed = defaultdict(list)
+        for task in self._stopped_tasks():
+            name = groups.get(task.get("group"))
+            reason = task.get("stoppedReason", "")
+            if name and not reason.startswith(SCALING_STOP_REASON) and \
+                    not any(host_reason in reason
+                            for host_reason in HOST_STOP_REASONS) and \
+                    self._task_failed(task):
+                failed[name].append(task)
+
+        failures = {}
+        for name, tasks in failed.items():
+            task = max(tasks, key=lambda x: (x.get("stoppedAt") is not None,
+                                             x.get("stoppedAt")))
+            exit_codes = [container["exitCode"]
+                          for container in task.get("containers", [])
+                          if container.get("exitCode") not in (None, 0)]
+            failures[name] = dict(
+                failures=len(tasks),
+                reason="; ".join(reason for reason in
+                                 self._stop_reasons(task) if reason),
+                exit_code=exit_codes[0] if exit_codes else None
+            )
+        return failures
+
+    def find_stragglers(self, grace=STRAGGLER_GRACE):
+        # type: (int) -> List[str]
+        """Find the load-generating instances holding up the cluster
+
+        An instance running for longer than grace seconds is a straggler
+        when it never joined the cluster, its ECS agent is disconnected or
+        tasks repeatedly failed to start on it. Failures on most of the
+        instances point at the steps rather than the instances, so they
+        aren't counted then. Returns the EC2 instance id's of the
+        stragglers.
+
+        """
+        containers = self._container_instances()
+        failures = self._task_start_failures(self._stopped_tasks())
+        failing = set(
+            instance_id for instance_id, container in containers.items()
+            if failures.get(container["containerInstanceArn"], 0) >=
+            STRAGGLER_TASK_FAILURES
+        )
+        if len(failing) * 2 > len(containers):
+            logger.warning("Tasks failing to start on most instances")
+            failing = set()
+
+        now = time.time()
+        stragglers = []
+        for instance in self.query_instances():
+            tags = {tag["Key"]: tag["Value"]
+                    for tag in instance.get("Tags", [])}
+            if tags.get("Role") == "metrics":
+                continue
+            # Only running instances, pending ones are still booting
+            if instance["State"]["Code"] != 16:
+                continue
+            launched = calendar.timegm(instance["LaunchTime"].utctimetuple())
+            if now - launched < grace:
+                continue
+
+            instance_id = instance["InstanceId"]
+            container = containers.get(instance_id)
+            if not container or not container.get("agentConnected", True) \
+                    or instance_id in failing:
+                stragglers.append(instance_id)
+        return stragglers
+
+    def run_log_streams(self, steps, since):
+        # type: (List[Dict[str, Any]], float) -> Dict[str, List[str]]
+        """List the log streams of the step tasks created since the run's
+        services were, by step name"""
+        groups = {"service:{}".format(step["name"]): step["name"]
+                  for step in steps}
+        streams = defaultdict(list)
+        for status in ("RUNNING", "STOPPED"):
+            for task in self._described_tasks(status):
+                name = groups.get(task.get("group"))
+                created = task.get("createdAt")
+                if not name or not created or \
+                        calendar.timegm(created.utctimetuple()) < int(since):
+                    continue
+                task_id = task["taskArn"].rsplit("/", 1)[-1]
+                streams[name].extend(
+                    "{}/{}/{}".format(STEP_LOG_STREAM_PREFIX,
+                                      container["name"], task_id)
+                    for container in task.get("containers", []))
+        return {name: sorted(names) for name, names in streams.items()}
+
+    def terminate_instances(self, instance_ids):
+        # type: (List[str]) -> None
+        """Terminate instances, their tasks are rescheduled by ECS"""
+        logger.info("Terminating instances: {}".format(instance_ids))
+        self._ec2_call("terminate_instances", InstanceIds=instance_ids)
+
     def calculate_missing_instances(self, desired, current):
         # type: (Dict[str, int], Dict[str, int]) -> Dict[str, int]
         """Determine how many of what instance types are needed to ensure
@@ -276,33 +1129,114 @@ class ECSManager(object):
         return bool(response["taskArns"])
 
     def request_instances(self, instances, security_group_ids,
-                          additional_tags=None):
-        # type: (Dict[str, int], List[str], Optional[Dict[str, str]]) -> None
-        """Create requested types/quantities of instances for this cluster"""
+                          additional_tags=None, fallback=False, spot=False):
+        # type: (Dict[str, int], List[str], Optional[Dict[str, str]], bool, bool) -> Dict[str, Dict[str, int]]  # noqa
+        """Create requested types/quantities of instances for this cluster
+
+        With fallback, instance types EC2 is out of capacity for are
+        substituted with equivalent types, partial launches are accepted
+        and the remainder is requested from the next equivalent type.
+
+        With spot, instances are requested as one-time spot instances
+        first, whatever spot can't fulfil is launched on-demand.
+
+        Returns a dict of the requested instance types to a dict of the
+        instance types and counts actually launched for them.
+
+        """
         ami_id = self.ecs_ami_ids["us-east-1"]
         tags = dict(Name=self._ecs_name, Owner="ardere",
-                    ECSCluster=self._ecs_name)
+                    ECSCluster=self._ecs_name, Pool="warm",
+                    LastUsed=str(int(time.time())))
         if additional_tags:
             tags.update(additional_tags)
+
+        launched = {}
         for instance_type, instance_count in instances.items():
-            self._ec2_client.run_instances(
-                ImageId=ami_id,
-                MinCount=instance_count,
-                MaxCount=instance_count,
-                InstanceType=instance_type,
-                UserData=EC2_USER_DATA.format(ecs_name=self._ecs_name),
-                IamInstanceProfile={"Arn": self.ecs_profile},
-                SecurityGroupIds=security_group_ids,
-                TagSpecifications=[
-                    {
-                        "ResourceType": "instance",
-                        "Tags": [
-                            dict(Key=tag_name, Value=tag_value)
-                            for tag_name, tag_value in tags.items()
-                        ]
+            candidates = [instance_type]
+            if fallback:
+                candidates += equivalent_instance_types(instance_type)
+
+            # Try every candidate on spot before paying for on-demand
+            attempts = [(candidate, False) for candidate in candidates]
+            if spot:
+                attempts = [(candidate, True) for candidate in candidates] + \
+                    attempts
+
+            launched[instance_type] = {}
+            remaining = instance_count
+            for candidate, use_spot in attempts:
+                partial = fallback or spot
+                market_tags = dict(tags, Market="spot" if use_spot
+                                   else "on-demand")
+                if candidate != instance_type:
+                    market_tags[SUBSTITUTE_TAG] = instance_type
+                launch_args = dict(
+                    ImageId=ami_id,
+                    MinCount=1 if partial else remaining,
+                    MaxCount=remaining,
+                    InstanceType=candidate,
+                    UserData=EC2_USER_DATA.format(ecs_name=self._ecs_name),
+                    IamInstanceProfile={"Arn": self.ecs_profile},
+                    SecurityGroupIds=security_group_ids,
+                    TagSpecifications=[
+                        {
+                            "ResourceType": "instance",
+                            "Tags": [
+                                dict(Key=tag_name, Value=tag_value)
+                                for tag_name, tag_value in
+                                market_tags.items()
+                            ]
+                        }
+                    ]
+                )
+                if use_spot:
+                    launch_args["InstanceMarketOptions"] = {
+                        "MarketType": "spot",
+                        "SpotOptions": {
+                            "SpotInstanceType": "one-time",
+                            "InstanceInterruptionBehavior": "terminate"
+                        }
                     }
-                ]
-            )
+
+                try:
+                    response = self._ec2_call("run_instances", **launch_args)
+                except botocore.exceptions.ClientError as exc:
+                    code = exc.response.get("Error", {}).get("Code")
+                    if use_spot and code in SPOT_ERROR_CODES:
+                        logger.info("No spot capacity for {}: {}".format(
+                            candidate, exc))
+                        continue
+                    if not fallback or code not in CAPACITY_ERROR_CODES:
+                        raise
+                    logger.info("No capacity for {}: {}".format(
+                        candidate, exc))
+                    continue
+
+                # Only a partial request can be partially fulfilled
+                count = len(response["Instances"]) if partial else remaining
+                launched[instance_type][candidate] = \
+                    launched[instance_type].get(candidate, 0) + count
+                remaining -= count
+                if not remaining:
+                    break
+
+            if remaining:
+                raise InsufficientCapacityException(
+                    "Unable to launch {} of {} {} instances".format(
+                        remaining, instance_count, instance_type))
+        return launched
+
+    def instance_type_expression(self, instance_type):
+        # type: (str) -> str
+        """Build the placement expression confining a task to an instance
+        type, or the types substituted for it"""
+        substitutes = self._plan.get("instance_substitutes", {}).get(
+            instance_type)
+        if not substitutes:
+            return "attribute:ecs.instance-type == {}".format(instance_type)
+        return "attribute:ecs.instance-type in [{}]".format(
+            ", ".join([instance_type] + substitutes))
 
     def locate_metrics_container_ip(self):
         # type: () -> Tuple[Optional[str], Optional[str]]
@@ -380,7 +1314,7 @@ class ECSManager(object):
                 {
                     "name": "metricsetup",
                     "image": self.python_container,
-                    "cpu": 128,
+                    "cpu": METRICS_SETUP_CPU_UNITS,
                     "entryPoint": mc_cmd,
                     "memoryReservation": 256,
                     "privileged": True,
@@ -390,39 +1324,48 @@ class ECSManager(object):
             networkMode="host"
         )
 
+        container_definitions = [
+            {
+                "name": "grafana",
+                "image": self.grafana_container,
+                "cpu": GRAFANA_CPU_UNITS,
+                "memoryReservation": 256,
+                "entryPoint": cmd,
+                "portMappings": [
+                    {"containerPort": 3000}
+                ],
+                "privileged": True,
+                "environment": [
+                    {"name": key, "value": value} for key, value in
+                    gf_env.items()
+                ],
+                "logConfiguration": self.log_config
+            }
+        ]
+        if options.get("aggregation") == "step":
+            container_definitions.append(
+                self._metrics_aggregator_definition())
+
+        # InfluxDB gets what the other containers and tasks leave
+        influxdb_cpu = ec2_vcpu_by_type[options["instance_type"]] * 1024 - \
+            METRICS_SETUP_CPU_UNITS * METRICS_SETUP_TASKS - \
+            sum(container["cpu"] for container in container_definitions)
+        container_definitions.insert(0, {
+            "name": "influxdb",
+            "image": self.influxdb_container,
+            "cpu": influxdb_cpu,
+            "memoryReservation": 256,
+            "privileged": True,
+            "portMappings": [
+                {"containerPort": 8086},
+                {"containerPort": 8088}
+            ],
+            "logConfiguration": self.log_config
+        })
+
         task_response = self._ecs_client.register_task_definition(
             family=self.metrics_family_name(),
-            containerDefinitions=[
-                {
-                    "name": "influxdb",
-                    "image": self.influxdb_container,
-                    "cpu": cpu_units_for_instance_type(
-                        options["instance_type"]),
-                    "memoryReservation": 256,
-                    "privileged": True,
-                    "portMappings": [
-                        {"containerPort": 8086},
-                        {"containerPort": 8088}
-                    ],
-                    "logConfiguration": self.log_config
-                },
-                {
-                    "name": "grafana",
-                    "image": self.grafana_container,
-                    "cpu": 256,
-                    "memoryReservation": 256,
-                    "entryPoint": cmd,
-                    "portMappings": [
-                        {"containerPort": 3000}
-                    ],
-                    "privileged": True,
-                    "environment": [
-                        {"name": key, "value": value} for key, value in
-                        gf_env.items()
-                    ],
-                    "logConfiguration": self.log_config
-                }
-            ],
+            containerDefinitions=container_definitions,
             # use host network mode for optimal performance
             networkMode="host",
 
@@ -454,6 +1397,42 @@ class ECSManager(object):
         service_arn = service_result["service"]["serviceArn"]
         return dict(task_arn=task_arn, service_arn=service_arn)
 
+    def _metrics_aggregator_definition(self):
+        # type: () -> Dict[str, Any]
+        """Return the container definition of the aggregator rolling the
+        metrics of plans aggregating them up per step"""
+        cmd = """\
+        echo "${__ARDERE_PYTHON_SCRIPT__}" > metrics_aggregator.py && \
+        exec python metrics_aggregator.py
+        """
+        return {
+            "name": METRICS_AGGREGATOR_CONTAINER,
+            "image": self.python_container,
+            "cpu": METRICS_AGGREGATOR_CPU_UNITS,
+            "memoryReservation": 128,
+            "entryPoint": ['sh', '-c', '{}'.format(cmd)],
+            "portMappings": [
+                {"containerPort": METRICS_AGGREGATOR_PORT}
+            ],
+            "environment": [
+                {"name": "__ARDERE_PYTHON_SCRIPT__",
+                 "value": self.metrics_aggregator_script}
+            ],
+            "logConfiguration": self.log_config
+        }
+
+    def metrics_service_aggregates(self, metric_service):
+        # type: (Dict[str, Any]) -> bool
+        """Return whether the metrics service runs the metrics aggregator,
+        which only those created for plans aggregating metrics do"""
+        response = self._ecs_call(
+            "describe_task_definition",
+            taskDefinition=metric_service["taskDefinition"]
+        )
+        return any(container["name"] == METRICS_AGGREGATOR_CONTAINER
+                   for container in
+                   response["taskDefinition"]["containerDefinitions"])
+
     def run_metric_creation_task(self, container_instance, grafana_auth,
                                  dashboard=None,
                                  dashboard_name=None):
@@ -488,58 +1467,256 @@ class ECSManager(object):
             startedBy=self.plan_uuid
         )
 
-    def create_service(self, step):
-        # type: (Dict[str, Any]) -> Dict[str, Any]
-        """Creates an ECS service for a step and returns its info"""
+    def run_histogram_merger_task(self, container_instance, until):
+        # type: (str, float) -> None
+        """Starts the task merging the latency histograms of the run's
+        metrics database until the run ends
+
+        Like the annotations, the histograms are merged by the metric setup
+        container, so the metrics service kept between runs doesn't need
+        to know of them.
+
+        """
+        env = {
+            "__ARDERE_PYTHON_SCRIPT__": self.histogram_merger_script,
+            "__ARDERE_INFLUXDB_NAME__": self.influx_db_name,
+            "__ARDERE_MERGE_UNTIL__": "{:.3f}".format(until)
+        }
+        self._ecs_call(
+            "start_task",
+            cluster=self._ecs_name,
+            taskDefinition=self.metrics_setup_family_name(),
+            overrides={
+                'containerOverrides': [
+                    {
+                        "name": "metricsetup",
+                        "environment": [
+                            {"name": key, "value": value} for key, value in
+                            env.items()
+                        ]
+                    }
+                ]
+            },
+            containerInstances=[container_instance],
+            startedBy=HISTOGRAM_MERGER_STARTED_BY
+        )
+
+    def run_annotation_task(self, container_instance, annotations):
+        # type: (str, List[Dict[str, Any]]) -> List[str]
+        """Starts the tasks writing annotations into the run's metrics
+        database, returning their ARN's
+
+        The metrics instance is only reachable from within the cluster,
+        so the annotations are written by the metric setup container. They
+        are passed in its environment, split across tasks so the overrides
+        of each stay within what ECS takes.
+
+        """
+        task_arns = []
+        for points in self._annotation_chunks(annotations):
+            response = self._ecs_call(
+                "start_task",
+                cluster=self._ecs_name,
+                taskDefinition=self.metrics_setup_family_name(),
+                overrides=self._annotation_overrides(points),
+                containerInstances=[container_instance],
+                startedBy=ANNOTATION_TASK_STARTED_BY
+            )
+            task_arns.extend(task["taskArn"]
+                             for task in response.get("tasks", []))
+        return task_arns
+
+    def _annotation_overrides(self, annotations):
+        # type: (List[Dict[str, Any]]) -> Dict[str, Any]
+        env = {
+            "__ARDERE_PYTHON_SCRIPT__": self.annotate_script,
+            "__ARDERE_INFLUXDB_NAME__": self.influx_db_name,
+            "__ARDERE_ANNOTATIONS__": json.dumps(annotations)
+        }
+        return {
+            'containerOverrides': [
+                {
+                    "name": "metricsetup",
+                    "environment": [
+                        {"name": key, "value": value} for key, value in
+                        env.items()
+                    ]
+                }
+            ]
+        }
+
+    def _annotation_chunks(self, annotations):
+        # type: (List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]
+        """Split annotations into the chunks written by a task each"""
+        chunks = []  # type: List[List[Dict[str, Any]]]
+        chunk = []  # type: List[Dict[str, Any]]
+        for point in annotations:
+            overrides = self._annotation_overrides(chunk + [point])
+            if chunk and \
+                    len(json.dumps(overrides)) > MAX_CONTAINER_OVERRIDES_SIZE:
+                chunks.append(chunk)
+                chunk = []
+            chunk.append(point)
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def tasks_stopped(self, task_arns):
+        # type: (List[str]) -> bool
+        """Return whether all the tasks have stopped, tasks ECS no longer
+        knows of included"""
+        response = self._ecs_call(
+            "describe_tasks",
+            cluster=self._ecs_name,
+            tasks=task_arns
+        )
+        return all(task["lastStatus"] == "STOPPED"
+                   for task in response["tasks"])
+
+    def _statsd_relay_definition(self, step, statsd_port, telegraf_port,
+                                 precision):
+        # type: (Dict[str, Any], int, int, int) -> Dict[str, Any]
+        """Return the container definition of the relay keeping latency
+        histograms of a step's statsd timings"""
+        cmd = """\
+        echo "${__ARDERE_PYTHON_SCRIPT__}" > statsd_relay.py && \
+        exec python statsd_relay.py
+        """
+        env = {
+            "__ARDERE_PYTHON_SCRIPT__": self.statsd_relay_script,
+            "__ARDERE_STATSD_PORT__": str(statsd_port),
+            "__ARDERE_TELEGRAF_PORT__": str(telegraf_port),
+            "__ARDERE_TELEGRAF_STEP__": step["name"],
+            "__ARDERE_RUN_URL__": self.s3_run_file,
+            "__ARDERE_HISTOGRAM_PRECISION__": str(precision)
+        }
+        return {
+            "name": "statsd-relay",
+            "image": self.python_container,
+            "cpu": STATSD_RELAY_CPU_UNITS,
+            "memoryReservation": STATSD_RELAY_MEMORY_RESERVATION,
+            "entryPoint": ['sh', '-c', '{}'.format(cmd)],
+            "portMappings": [
+                {"containerPort": statsd_port}
+            ],
+            "environment": [
+                {"name": key, "value": value} for key, value in
+                sorted(env.items())
+            ],
+            "logConfiguration": self.step_log_config
+        }
+
+    def create_service(self, step, existing=None):
+        # type: (Dict[str, Any], Optional[Dict[str, Any]]) -> Dict[str, Any]
+        """Creates an ECS service for a step and returns its info
+
+        An existing snapshot of the step's service may be given, an active
+        service already running the step's task definition is kept rather
+        than created again.
+
+        """
         logger.info("CreateService called with: {}".format(step))
 
-        # Prep the shell command
+        # Prep the shell command, the step's command is run by runstep.sh
+        # which stops it at the end of its run window
         wfc_var = '__ARDERE_WAITFORCLUSTER_SH__'
-        wfc_cmd = 'sh -c "${}" waitforcluster.sh {} {}'.format(
+        runstep_var = '__ARDERE_RUNSTEP_SH__'
+        step_cmd_var = '__ARDERE_STEP_CMD__'
+        wfc_cmd = 'sh -c "${}" waitforcluster.sh {} {} {}'.format(
             wfc_var,
-            self.s3_ready_file,
-            step.get("run_delay", 0)
+            self.s3_run_file,
+            step.get("run_delay", 0),
+            START_TIME_FILE
+        )
+        runstep_cmd = 'exec sh -c "${}" runstep.sh {} {} {} {} "${}"'.format(
+            runstep_var,
+            START_TIME_FILE,
+            step.get("run_delay", 0),
+            step["run_max_time"],
+            step.get("stop_grace", DEFAULT_STOP_GRACE),
+            step_cmd_var
         )
-        service_cmd = step["cmd"]
-        cmd = ['sh', '-c', '{} && {}'.format(wfc_cmd, service_cmd)]
+        cmd = ['sh', '-c', '{} && {}'.format(wfc_cmd, runstep_cmd)]
 
         # Prep the env vars
-        env_vars = [{"name": wfc_var, "value": self.wait_script}]
+        env_vars = [{"name": wfc_var, "value": self.wait_script},
+                    {"name": runstep_var, "value": self.runstep_script},
+                    {"name": step_cmd_var, "value": step["cmd"]}]
         for name, value in step.get("env", {}).items():
             env_vars.append({"name": name, "value": value})
 
-        # ECS wants a family name for task definitions, no spaces, 255 chars
-        family_name = step["name"] + "-" + self._plan_uuid
-
         # Use cpu_unit if provided, otherwise monopolize
         cpu_units = step.get(
             "cpu_units",
             cpu_units_for_instance_type(step["instance_type"])
         )
+        statsd_port = step.get("statsd_port", DEFAULT_STATSD_PORT)
+        env_vars.append({"name": "ARDERE_STATSD_PORT",
+                         "value": str(statsd_port)})
+
+        # Run a copy of the container per task slot, splitting the cpu
+        tasks_per_instance = step.get("tasks_per_instance", 1)
+        container_defs = []
+        for slot in range(tasks_per_instance):
+            if tasks_per_instance > 1:
+                name = "{}-{}".format(step["name"], slot)
+            else:
+                name = step["name"]
+            slot_env = [
+                {"name": "ARDERE_TASK_SLOT", "value": str(slot)},
+                {"name": "ARDERE_TASKS_PER_INSTANCE",
+                 "value": str(tasks_per_instance)}
+            ]
 
-        # Setup the container definition
-        container_def = {
-            "name": step["name"],
-            "image": step["container_name"],
-            "cpu": cpu_units,
-
-            # using only memoryReservation sets no hard limit
-            "memoryReservation": 256,
-            "privileged": True,
-            "environment": env_vars,
-            "entryPoint": cmd,
-            "ulimits": [
-                dict(name="nofile", softLimit=1000000, hardLimit=1000000)
-            ],
-            "logConfiguration": self.log_config
-        }
-        if "port_mapping" in step:
-            ports = [{"containerPort": port} for port in step["port_mapping"]]
-            container_def["portMappings"] = ports
-
-        # Setup the telegraf container definition
+            # Setup the container definition
+            container_def = {
+                "name": name,
+                "image": step["container_name"],
+                "cpu": cpu_units // tasks_per_instance,
+
+                # using only memoryReservation sets no hard limit
+                "memoryReservation": step.get("memory_reservation",
+                                              DEFAULT_MEMORY_RESERVATION),
+                "privileged": True,
+                "environment": env_vars + slot_env,
+                "entryPoint": cmd,
+                "ulimits": [
+                    dict(name="nofile", softLimit=1000000,
+                         hardLimit=1000000)
+                ],
+                "logConfiguration": self.step_log_config
+            }
+            if "port_mapping" in step:
+                ports = [{"containerPort": port}
+                         for port in step["port_mapping"]]
+                container_def["portMappings"] = ports
+            container_defs.append(container_def)
+
+        # With latency histograms a relay keeping them receives the step's
+        # statsd metrics first and passes them on to telegraf
+        metrics_options = self._plan.get("metrics_options", {})
+        telegraf_port = statsd_port
+        if metrics_options.get("histograms"):
+            telegraf_port = statsd_port + STATSD_RELAY_PORT_OFFSET
+            container_defs.append(self._statsd_relay_definition(
+                step, statsd_port, telegraf_port,
+                metrics_options.get("histogram_precision",
+                                    DEFAULT_HISTOGRAM_PRECISION)
+            ))
+
+        # Setup the telegraf container definition, where to send metrics
+        # differs per run so it's read from the run file, which is parsed
+        # rather than sourced. With a host sample rate in it, hosts picked
+        # at random tag their metrics to be kept as is along with the
+        # step's aggregates.
         cmd = """\
         echo "${__ARDERE_TELEGRAF_CONF__}" > /etc/telegraf/telegraf.conf && \
+        RUN_VALUES=`wget -qO- ${__ARDERE_RUN_URL__}` && \
+        run_value() { echo "${RUN_VALUES}" | sed -n "s/^$1='\\([^']*\\)'$/\\1/p"; } && \
+        SAMPLE_RATE=`run_value ARDERE_HOST_SAMPLE_RATE` && \
+        if [ -n "${SAMPLE_RATE}" ] && [ `od -An -N2 -tu2 /dev/urandom` -lt `awk -v rate="${SAMPLE_RATE}" 'BEGIN { print int(rate * 65536) }'` ]; then sed -i '/^\\[global_tags\\]/a ardere_sampled = "1"' /etc/telegraf/telegraf.conf; fi && \
+        export __ARDERE_INFLUX_ADDR__=`run_value ARDERE_INFLUX_ADDR` && \
+        export __ARDERE_INFLUX_DB__=`run_value ARDERE_INFLUX_DB` && \
         export __ARDERE_TELEGRAF_HOST__=`wget -qO- http://169.254.169.254/latest/meta-data/instance-id` && \
         telegraf \
         """  # noqa
@@ -547,11 +1724,11 @@ class ECSManager(object):
         telegraf_def = {
             "name": "telegraf",
             "image": self.telegraf_container,
-            "cpu": 512,
-            "memoryReservation": 256,
+            "cpu": TELEGRAF_CPU_UNITS,
+            "memoryReservation": TELEGRAF_MEMORY_RESERVATION,
             "entryPoint": cmd,
             "portMappings": [
-                {"containerPort": 8125}
+                {"containerPort": telegraf_port}
             ],
             "privileged": True,
             "environment": [
@@ -559,22 +1736,18 @@ class ECSManager(object):
                  "value": self.telegraf_script},
                 {"name": "__ARDERE_TELEGRAF_STEP__",
                  "value": step["name"]},
-                {"name": "__ARDERE_INFLUX_ADDR__",
-                 "value": "{}:8086".format(self._plan["influxdb_private_ip"])},
-                {"name": "__ARDERE_INFLUX_DB__",
-                 "value": self.influx_db_name},
+                {"name": "__ARDERE_RUN_URL__",
+                 "value": self.s3_run_file},
                 {"name": "__ARDERE_TELEGRAF_TYPE__",
-                 "value": step["docker_series"]}
+                 "value": step["docker_series"]},
+                {"name": "__ARDERE_STATSD_PORT__",
+                 "value": str(telegraf_port)}
             ],
-            "logConfiguration": self.log_config
+            "logConfiguration": self.step_log_config
         }
 
-        task_response = self._ecs_client.register_task_definition(
-            family=family_name,
-            containerDefinitions=[
-                container_def,
-                telegraf_def
-            ],
+        task_definition = dict(
+            containerDefinitions=container_defs + [telegraf_def],
             # use host network mode for optimal performance
             networkMode="host",
 
@@ -582,18 +1755,32 @@ class ECSManager(object):
                 # Ensure the service is confined to the right instance type
                 {
                     "type": "memberOf",
-                    "expression": "attribute:ecs.instance-type == {}".format(
+                    "expression": self.instance_type_expression(
                         step["instance_type"]),
                 }
             ]
         )
-        task_arn = task_response["taskDefinition"]["taskDefinitionArn"]
+        step["task_family"] = self.family_name(step, task_definition)
+        task_arn = self._ensure_task_definition(step["task_family"],
+                                                task_definition)
         step["taskArn"] = task_arn
-        service_result = self._ecs_client.create_service(
+
+        # Steps reusing instances of earlier steps are created without any
+        # tasks, they're scaled up once the earlier steps are done
+        deferred = step.get("defer_start", False)
+
+        if existing and existing["status"] == "ACTIVE" and \
+                existing["taskDefinition"] == task_arn:
+            logger.info("Service {} already created".format(step["name"]))
+            step["serviceArn"] = existing["serviceArn"]
+            step["service_status"] = "DEFERRED" if deferred else "STARTED"
+            return step
+
+        service_args = dict(
             cluster=self._ecs_name,
             serviceName=step["name"],
             taskDefinition=task_arn,
-            desiredCount=step["instance_count"],
+            desiredCount=0 if deferred else step["instance_count"],
             deploymentConfiguration={
                 "minimumHealthyPercent": 0,
                 "maximumPercent": 100
@@ -604,58 +1791,237 @@ class ECSManager(object):
                 }
             ]
         )
+        if self._plan.get("pack_steps"):
+            # Fill up instances already running other steps first
+            service_args["placementStrategy"] = [
+                {"type": "binpack", "field": "cpu"},
+                {"type": "binpack", "field": "memory"}
+            ]
+        service_result = self._ecs_call("create_service", **service_args)
         step["serviceArn"] = service_result["service"]["serviceArn"]
-        step["service_status"] = "STARTED"
+        step["service_status"] = "DEFERRED" if deferred else "STARTED"
         return step
 
+    def _ensure_task_definition(self, family, task_definition):
+        # type: (str, Dict[str, Any]) -> str
+        """Return the ARN of the active task definition of a family,
+        registering it if there's none
+
+        Families are named by a hash of their contents, so any active
+        revision is identical to the task definition given.
+
+        """
+        try:
+            response = self._ecs_call("describe_task_definition",
+                                      taskDefinition=family)
+        except botocore.exceptions.ClientError:
+            response = None
+        if response and \
+                response["taskDefinition"].get("status") == "ACTIVE":
+            return response["taskDefinition"]["taskDefinitionArn"]
+
+        response = self._ecs_call("register_task_definition",
+                                  family=family, **task_definition)
+        return response["taskDefinition"]["taskDefinitionArn"]
+
+    def publish_run_file(self):
+        # type: () -> None
+        """Drop a run file in S3 with the values that differ between runs
+        of the plan
+
+        Step task definitions are reused across runs, their containers
+        read this file on start instead. It holds a NAME='value' line per
+        value, which the containers parse rather than source.
+
+        """
+        # Hosts write to the aggregator instead when it rolls their metrics
+        # up per step
+        metrics_options = self._plan.get("metrics_options", {})
+        aggregate = metrics_options.get("aggregation") == "step" and \
+            self._plan.get("metrics_aggregator", True)
+        influx_port = METRICS_AGGREGATOR_PORT if aggregate else 8086
+        run_values = [
+            ("ARDERE_PLAN_RUN", self._plan_uuid),
+            ("ARDERE_READY_URL", self.s3_ready_file),
+            ("ARDERE_READY_POLL", ready_poll_interval(self._plan["steps"])),
+            ("ARDERE_INFLUX_ADDR",
+             "{}:{}".format(self._plan.get("influxdb_private_ip"),
+                            influx_port)),
+            ("ARDERE_INFLUX_DB", self.influx_db_name),
+        ]
+        if aggregate:
+            run_values.append((
+                "ARDERE_HOST_SAMPLE_RATE",
+                metrics_options.get("host_sample_rate",
+                                    DEFAULT_HOST_SAMPLE_RATE)
+            ))
+        cached_client(self.boto, 's3').put_object(
+            ACL="public-read",
+            Body="".join("{}='{}'\n".format(name, value)
+                         for name, value in run_values).encode("utf-8"),
+            Bucket=self.s3_ready_bucket,
+            Key="{}.run".format(self._ecs_name),
+            Metadata={
+                "ECSCluster": self._ecs_name
+            }
+        )
+
     def create_services(self, steps):
         # type: (List[Dict[str, Any]]) -> None
-        """Create ECS Services given a list of steps"""
-        with ThreadPoolExecutor(max_workers=8) as executer:
-            executer.map(self.create_service, steps)
+        """Create ECS Services given a list of steps
+
+        Services a previous attempt already created are kept, so this can
+        be retried after a partial failure.
+
+        """
+        self.publish_run_file()
+        existing = self.describe_service_statuses(steps)
+        failures = [result for result in
+                    self.api.map(lambda step: self.create_service(
+                        step, existing.get(step["name"])), steps)
+                    if result.error]
+        if failures:
+            for failure in failures:
+                logger.error("Failed creating service {}: {}".format(
+                    failure.item["name"], failure.error))
+            raise CreateServicesException(
+                "Failed creating services: {}".format(", ".join(
+                    "{} ({})".format(failure.item["name"], failure.error)
+                    for failure in failures
+                )))
+
+    def describe_service_statuses(self, steps):
+        # type: (List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]
+        """Query the status of every step's service in as few calls as
+        possible
+
+        Service names are grouped into batches of the maximum size
+        DescribeServices accepts. Returns a dict of step name to a status
+        snapshot of the service. Services ECS doesn't know about are
+        reported with a status of ``MISSING``.
+
+        """
+        names = [step["name"] for step in steps]
+        batches = [names[i:i + DESCRIBE_SERVICES_BATCH_SIZE]
+                   for i in range(0, len(names),
+                                  DESCRIBE_SERVICES_BATCH_SIZE)]
+
+        def describe(batch):
+            return self._ecs_call("describe_services",
+                                  cluster=self._ecs_name, services=batch)
+
+        statuses = {}
+        for result in self.api.map(describe, batches):
+            if result.error:
+                raise result.error
+            for service in result.result.get("services", []):
+                statuses[service["serviceName"]] = \
+                    self._service_snapshot(service)
+
+        for name in names:
+            if name not in statuses:
+                statuses[name] = dict(
+                    status="MISSING",
+                    desiredCount=0,
+                    runningCount=0,
+                    pendingCount=0,
+                    deployment_status=None,
+                    deployments=0
+                )
+        return statuses
+
+    @staticmethod
+    def _service_snapshot(service):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        """Pull the counts we care about out of a service description
+
+        Counts are taken from the PRIMARY deployment as that reflects the
+        latest desiredCount we've set for the service.
+
+        """
+        deployments = service.get("deployments") or []
+        primary = next(
+            (d for d in deployments if d.get("status") == "PRIMARY"),
+            deployments[0] if deployments else {}
+        )
+        return dict(
+            status=service.get("status"),
+            serviceArn=service.get("serviceArn"),
+            taskDefinition=service.get("taskDefinition"),
+            desiredCount=primary.get("desiredCount", 0),
+            runningCount=primary.get("runningCount", 0),
+            pendingCount=primary.get("pendingCount", 0),
+            deployment_status=primary.get("status"),
+            deployments=len(deployments)
+        )
+
+    @staticmethod
+    def _snapshot_ready(snapshot, threshold=1.0):
+        # type: (Dict[str, Any], float) -> bool
+        """Return whether enough of the tasks of a service snapshot are
+        running
+
+        All the tasks must be running unless a threshold below 1 says what
+        share of them is enough.
+
+        """
+        if not snapshot["deployments"]:
+            return False
+        if threshold >= 1:
+            return snapshot["desiredCount"] == snapshot["runningCount"]
+        return snapshot["runningCount"] >= \
+            math.ceil(snapshot["desiredCount"] * threshold)
+
+    @staticmethod
+    def _snapshot_done(snapshot):
+        # type: (Dict[str, Any]) -> bool
+        """Return whether a service snapshot is fully drained
+
+        A service that has already been deleted no longer shows up in
+        DescribeServices, so it's considered done as well.
+
+        """
+        return snapshot["status"] in ("INACTIVE", "MISSING")
 
     def service_ready(self, step):
         # type: (Dict[str, Any]) -> bool
         """Query a service and return whether all its tasks are running"""
-        service_name = step["name"]
-        response = self._ecs_client.describe_services(
-            cluster=self._ecs_name,
-            services=[service_name]
-        )
+        snapshot = self.describe_service_statuses([step])[step["name"]]
+        return self._snapshot_ready(snapshot)
 
-        try:
-            deploy = response["services"][0]["deployments"][0]
-        except (TypeError, IndexError):
-            return False
-        return deploy["desiredCount"] == deploy["runningCount"]
+    def all_services_ready(self, steps, thresholds=None):
+        # type: (List[Dict[str, Any]], Optional[Dict[str, float]]) -> bool
+        """Queries all service ARN's in the plan to see if they're ready
 
-    def all_services_ready(self, steps):
-        # type: (List[Dict[str, Any]]) -> bool
-        """Queries all service ARN's in the plan to see if they're ready"""
-        with ThreadPoolExecutor(max_workers=8) as executer:
-            results = executer.map(self.service_ready, steps)
-        return all(results)
+        thresholds maps step names to the share of their tasks that must be
+        running, by default all of them. The desired and running task
+        counts seen are recorded in each step.
+
+        """
+        thresholds = thresholds or {}
+        statuses = self.describe_service_statuses(steps)
+        for step in steps:
+            snapshot = statuses.get(step["name"])
+            if snapshot:
+                step["tasks_desired"] = snapshot["desiredCount"]
+                step["tasks_running"] = snapshot["runningCount"]
+        return all(self._snapshot_ready(snapshot, thresholds.get(name, 1.0))
+                   for name, snapshot in statuses.items())
 
     def service_done(self, step):
         # type: (Dict[str, Any]) -> bool
         """Query a service to return whether its fully drained and back to
         INACTIVE"""
-        service_name = step["name"]
-        response = self._ecs_client.describe_services(
-            cluster=self._ecs_name,
-            services=[service_name]
-        )
-
-        service = response["services"][0]
-        return service["status"] == "INACTIVE"
+        snapshot = self.describe_service_statuses([step])[step["name"]]
+        return self._snapshot_done(snapshot)
 
     def all_services_done(self, steps):
         # type: (List[Dict[str, Any]]) -> bool
         """Queries all service ARN's in the plan to see if they're fully
         DRAINED and now INACTIVE"""
-        with ThreadPoolExecutor(max_workers=8) as executer:
-            results = executer.map(self.service_done, steps)
-        return all(results)
+        statuses = self.describe_service_statuses(steps)
+        return all(self._snapshot_done(snapshot)
+                   for snapshot in statuses.values())
 
     def stop_finished_service(self, start_time, step):
         # type: (start_time, Dict[str, Any]) -> None
@@ -669,24 +2035,80 @@ class ECSManager(object):
         if now < (start_time + step_duration):
             return
 
-        # Running long enough to shutdown
-        self._ecs_client.update_service(
+        # Running long enough to shutdown, the containers already stopped
+        # the step's command at the end of its window
+        self._ecs_call(
+            "update_service",
             cluster=self._ecs_name,
             service=step["name"],
             desiredCount=0
         )
         step["service_status"] = "STOPPED"
+        step["stopped_at"] = time.time()
 
     def stop_finished_services(self, start_time, steps):
         # type: (int, List[Dict[str, Any]]) -> None
-        """Shuts down any services that have run for their max time"""
-        for step in steps:
-            self.stop_finished_service(start_time, step)
+        """Shuts down any services that have run for their max time
 
-    def shutdown_plan(self, steps):
-        # type: (List[Dict[str, Any]]) -> None
+        Services that fail to stop are tried again on the next call.
+
+        """
+        results = self.api.map(
+            lambda step: self.stop_finished_service(start_time, step), steps)
+        for result in results:
+            if result.error:
+                logger.error("Failed stopping service {}: {}".format(
+                    result.item["name"], result.error))
+
+    def start_deferred_service(self, start_time, step):
+        # type: (int, Dict[str, Any]) -> None
+        """Scales up a deferred service once the instances it reuses are
+        free"""
+        if step["service_status"] != "DEFERRED":
+            return
+
+        scale_up_time = start_time + step.get("run_delay", 0) - \
+            HOST_REUSE_DELAY
+        if time.time() < scale_up_time:
+            return
+
+        self._ecs_call(
+            "update_service",
+            cluster=self._ecs_name,
+            service=step["name"],
+            desiredCount=step["instance_count"]
+        )
+        step["service_status"] = "STARTED"
+
+    def start_deferred_services(self, start_time, steps):
+        # type: (int, List[Dict[str, Any]]) -> None
+        """Scales up any deferred services that are due to start
+
+        Services that fail to scale up are tried again on the next call.
+
+        """
+        results = self.api.map(
+            lambda step: self.start_deferred_service(start_time, step), steps)
+        for result in results:
+            if result.error:
+                logger.error("Failed starting service {}: {}".format(
+                    result.item["name"], result.error))
+
+    def shutdown_plan(self, steps, keep_metrics_service=False):
+        # type: (List[Dict[str, Any]], bool) -> Dict[str, List[str]]
         """Terminate the entire plan, ensure all services and task
-        definitions are completely cleaned up and removed"""
+        definitions are completely cleaned up and removed
+
+        Services are removed and task definitions deregistered in parallel
+        through the shared API executor. The step task definitions the plan
+        ran are kept for later runs to reuse, those of earlier versions of
+        its steps are deregistered. Every revision of the metrics task
+        definition families is deregistered when tear_down is set, the
+        metrics service is removed along unless keep_metrics_service is
+        set. Returns the ARN's of the services and task definitions
+        removed.
+
+        """
         # Locate all the services for the ECS Cluster
         paginator = self._ecs_client.get_paginator('list_services')
         response_iterator = paginator.paginate(
@@ -700,52 +2122,207 @@ class ECSManager(object):
 
         # Avoid shutting down metrics if tear down was not requested
         # We have to exclude it from the services discovered above if we
-        # should NOT tear it down
-        if not self._plan["metrics_options"]["tear_down"]:
+        # should NOT tear it down, or not yet
+        if keep_metrics_service or \
+                not self._plan["metrics_options"]["tear_down"]:
             metric_service = self.locate_metrics_service()
             if metric_service and metric_service["serviceArn"] in service_arns:
                 service_arns.remove(metric_service["serviceArn"])
 
-        for service_arn in service_arns:
-            try:
-                self._ecs_client.update_service(
-                    cluster=self._ecs_name,
-                    service=service_arn,
-                    desiredCount=0
-                )
-            except botocore.exceptions.ClientError:
-                continue
-
-            try:
-                self._ecs_client.delete_service(
-                    cluster=self._ecs_name,
-                    service=service_arn
-                )
-            except botocore.exceptions.ClientError:
-                pass
+        removed_services = self.api.map(self._remove_service, service_arns)
 
-        # Locate all the task definitions for this plan
-        step_family_names = [self.family_name(step) for step in steps]
+        # Locate the task definitions of earlier versions of the steps
+        family_names = [
+            family for listed in self.api.map(
+                self._stale_task_families,
+                [step for step in steps if step.get("task_family")])
+            for family in listed.result or []
+        ]
 
-        # Add in the metrics family name if we need to tear_down
+        # And the metrics task definitions if we need to tear_down
         if self._plan["metrics_options"]["tear_down"]:
-            step_family_names.append(self.metrics_family_name())
-            step_family_names.append(self.metrics_setup_family_name())
+            family_names.append(self.metrics_family_name())
+            family_names.append(self.metrics_setup_family_name())
+
+        task_arns = [
+            arn for listed in self.api.map(self._list_task_definitions,
+                                           family_names)
+            for arn in listed.result or []
+        ]
+        deregistered = self.api.map(self._deregister_task_definition,
+                                    task_arns)
+
+        return dict(
+            services=[removed.result for removed in removed_services
+                      if removed.result],
+            task_definitions=[removed.result for removed in deregistered
+                              if removed.result]
+        )
 
-        for family_name in step_family_names:
-            try:
-                response = self._ecs_client.describe_task_definition(
-                    taskDefinition=family_name
-                )
-            except botocore.exceptions.ClientError:
-                continue
+    def remove_metrics_service(self):
+        # type: () -> Optional[str]
+        """Remove the metrics service, returning its ARN if it was
+        removed"""
+        metric_service = self.locate_metrics_service()
+        if not metric_service:
+            return None
+        return self._remove_service(metric_service["serviceArn"])
 
-            task_arn = response["taskDefinition"]["taskDefinitionArn"]
+    def _remove_service(self, service_arn):
+        # type: (str) -> Optional[str]
+        """Scale a service down and delete it, returning its ARN if it was
+        deleted"""
+        try:
+            self._ecs_call(
+                "update_service",
+                cluster=self._ecs_name,
+                service=service_arn,
+                desiredCount=0
+            )
+        except botocore.exceptions.ClientError:
+            return None
 
-            # Deregister the task
-            try:
-                self._ecs_client.deregister_task_definition(
-                    taskDefinition=task_arn
-                )
-            except botocore.exceptions.ClientError:
-                pass
+        try:
+            self._ecs_call(
+                "delete_service",
+                cluster=self._ecs_name,
+                service=service_arn
+            )
+        except botocore.exceptions.ClientError:
+            return None
+        return service_arn
+
+    def _stale_task_families(self, step):
+        # type: (Dict[str, Any]) -> List[str]
+        """List the active task definition families of a step other than
+        the one it runs, left by earlier versions of it"""
+        pattern = re.compile("^{}-[0-9a-f]{{{}}}$".format(
+            re.escape(step["name"]), TASK_FAMILY_HASH_LEN))
+        paginator = self._ecs_client.get_paginator(
+            'list_task_definition_families')
+        families = []
+        try:
+            for page in paginator.paginate(
+                    familyPrefix="{}-".format(step["name"]),
+                    status="ACTIVE"):
+                families.extend(page["families"])
+        except botocore.exceptions.ClientError as exc:
+            logger.warning("Failed listing task definition families of "
+                           "{}: {}".format(step["name"], exc))
+            return []
+        return [family for family in families
+                if pattern.match(family) and family != step["task_family"]]
+
+    def _list_task_definitions(self, family_name):
+        # type: (str) -> List[str]
+        """List the ARN's of all active revisions of a task definition
+        family"""
+        paginator = self._ecs_client.get_paginator('list_task_definitions')
+        task_arns = []
+        try:
+            for page in paginator.paginate(familyPrefix=family_name,
+                                           status="ACTIVE"):
+                task_arns.extend(page["taskDefinitionArns"])
+        except botocore.exceptions.ClientError:
+            return []
+
+        # The prefix also matches families that merely start with the name
+        return [arn for arn in task_arns
+                if arn.rsplit("/", 1)[-1].rsplit(":", 1)[0] == family_name]
+
+    def _deregister_task_definition(self, task_arn):
+        # type: (str) -> Optional[str]
+        """Deregister a task definition, returning its ARN if it was"""
+        try:
+            self._ecs_call(
+                "deregister_task_definition",
+                taskDefinition=task_arn
+            )
+        except botocore.exceptions.ClientError:
+            return None
+        return task_arn
+
+
+class PlanStateStore(object):
+    """Keeps the state of running plans in S3
+
+    Only a reference to the plan, its id and version, is passed between
+    the states of the state machine, keeping large plans under the Step
+    Functions payload limit. Every version is stored compressed under its
+    own key, so a retried state always loads the version it was given.
+    A new version is only written when the plan changed.
+
+    """
+    # For testing purposes
+    boto = boto3
+
+    # Versions recently loaded or saved by this container, by key
+    _cache = {}  # type: Dict[str, bytes]
+
+    def __init__(self, bucket):
+        # type: (str) -> None
+        self.bucket = bucket
+
+    @staticmethod
+    def _key(plan_id, version):
+        # type: (str, int) -> str
+        return "{}/{:08d}.json.zlib".format(plan_id, version)
+
+    @staticmethod
+    def _serialize(plan):
+        # type: (Dict[str, Any]) -> bytes
+        body = {key: value for key, value in plan.items()
+                if key not in PLAN_REFERENCE_KEYS + ("plan_version",)}
+        return json.dumps(body, sort_keys=True).encode("utf-8")
+
+    @staticmethod
+    def is_reference(event):
+        # type: (Dict[str, Any]) -> bool
+        return "plan_id" in event and "plan_version" in event
+
+    def load(self, event):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        """Return the plan a reference refers to
+
+        Anything else in the reference, such as error details added by the
+        state machine, is laid over the stored plan.
+
+        """
+        key = self._key(event["plan_id"], event["plan_version"])
+        body = self._cache.get(key)
+        if body is None:
+            response = cached_client(self.boto, 's3').get_object(
+                Bucket=self.bucket, Key=key)
+            body = zlib.decompress(response["Body"].read())
+            self._cache.clear()
+            self._cache[key] = body
+
+        plan = json.loads(body.decode("utf-8"))
+        plan.update({key: value for key, value in event.items()
+                     if key not in ("plan_id", "plan_version")})
+        plan["plan_version"] = event["plan_version"]
+        return plan
+
+    def save(self, plan):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        """Store the plan if it changed, and return its reference"""
+        plan_id = plan["plan_run_uuid"]
+        version = plan.get("plan_version", 0)
+        body = self._serialize(plan)
+        if body != self._cache.get(self._key(plan_id, version)):
+            version += 1
+            key = self._key(plan_id, version)
+            cached_client(self.boto, 's3').put_object(
+                Bucket=self.bucket,
+                Key=key,
+                Body=zlib.compress(body)
+            )
+            self._cache.clear()
+            self._cache[key] = body
+            plan["plan_version"] = version
+
+        reference = dict(plan_id=plan_id, plan_version=version)
+        for key in PLAN_REFERENCE_KEYS:
+            if key in plan:
+                reference[key] = plan[key]
+        return reference
@@ -16,3 +16,11 @@ class UndrainedInstancesException(Exception):
 
 class CreatingMetricSourceException(Exception):
     """Metric creation task hasn't completed yet"""
+
+
+class InsufficientCapacityException(Exception):
+    """EC2 couldn't provide the instances requested"""
+
+
+class CreateServicesException(Exception):
+    """Some of the plan's services couldn't be created"""
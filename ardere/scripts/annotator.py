@@ -0,0 +1,38 @@
+import logging
+import json
+import os
+
+import influxdb
+
+try:
+    from typing import Any, Dict  # noqa
+except ImportError:  # pragma: nocover
+    pass
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+
+class Annotator(object):
+    # For testing purposes
+    influx = influxdb
+
+    def __init__(self):
+        self.influx_db_name = os.environ["__ARDERE_INFLUXDB_NAME__"]
+        self.annotations = json.loads(os.environ["__ARDERE_ANNOTATIONS__"])
+
+    def write_annotations(self):
+        # type: () -> None
+        """Write the annotations of the plan run as points of its
+        database"""
+        logger.info("Writing %d annotations", len(self.annotations))
+        influx_client = self.influx.InfluxDBClient()
+        influx_client.write_points(self.annotations,
+                                   time_precision="ms",
+                                   database=self.influx_db_name)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    logger.info("Writing annotations")
+    Annotator().write_annotations()
+    logger.info("Finished.")
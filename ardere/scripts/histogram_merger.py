@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import time
+
+try:
+    from urllib.parse import urlencode
+    from urllib.request import Request, urlopen
+except ImportError:  # pragma: nocover
+    from urllib import urlencode
+    from urllib2 import Request, urlopen
+
+try:
+    from typing import Any, Dict, List, Optional, Tuple  # noqa
+except ImportError:  # pragma: nocover
+    pass
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+# Seconds each merged histogram covers, the interval the relays flush at
+MERGE_INTERVAL = 10
+
+# Intervals to hold off merging for, so late writes of relays make it in,
+# also when they go through the metrics aggregator first
+MERGE_LAG = 4
+
+# Measurements the relays write histograms to and the percentiles of the
+# merged histograms are written to
+HISTOGRAM_MEASUREMENT = "ardere_histogram"
+PERCENTILE_MEASUREMENT = "ardere_percentiles"
+
+# Percentiles computed of the merged histograms, by field name
+PERCENTILES = [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p99_9", 0.999)]
+
+
+def escape(value):
+    # type: (str) -> str
+    """Escape a tag value for the InfluxDB line protocol"""
+    for char in ("\\", ",", "=", " "):
+        value = value.replace(char, "\\" + char)
+    return value
+
+
+def merge(series):
+    # type: (List[Dict[str, Any]]) -> Dict[Tuple[str, str], Dict[float, float]]  # noqa
+    """Sum the histograms of all hosts by step and metric
+
+    Takes the series of a query grouped by step and metric, where every
+    column other than time and host is a bucket.
+
+    """
+    merged = {}  # type: Dict[Tuple[str, str], Dict[float, float]]
+    for result in series:
+        key = (result["tags"]["step"], result["tags"]["metric"])
+        histogram = merged.setdefault(key, {})
+        buckets = []
+        for index, column in enumerate(result["columns"]):
+            try:
+                buckets.append((index, float(column)))
+            except ValueError:
+                continue
+        for row in result["values"]:
+            for index, value in buckets:
+                if row[index]:
+                    histogram[value] = histogram.get(value, 0) + row[index]
+    return merged
+
+
+def percentiles(histogram):
+    # type: (Dict[float, float]) -> Dict[str, float]
+    """Compute the percentiles of a histogram, to the precision of its
+    buckets"""
+    total = sum(histogram.values())
+    result = dict(count=float(total))
+    ordered = sorted(histogram.items())
+    for name, quantile in PERCENTILES:
+        seen = 0.0
+        for value, count in ordered:
+            seen += count
+            if seen >= quantile * total:
+                result[name] = value
+                break
+    return result
+
+
+class HistogramMerger(object):
+    """Merges the histograms the relays of every host of a plan run wrote
+    into fleet wide percentiles, per step and metric"""
+    def __init__(self, database, influx_url="http://127.0.0.1:8086"):
+        # type: (str, str) -> None
+        self.database = database
+        self.influx_url = influx_url
+
+    def _query(self, query):
+        # type: (str) -> List[Dict[str, Any]]
+        params = dict(q=query, epoch="ms", db=self.database)
+        response = urlopen("{}/query?{}".format(self.influx_url,
+                                                 urlencode(params)))
+        results = json.loads(response.read().decode("utf-8"))["results"]
+        return results[0].get("series", [])
+
+    def _write(self, lines):
+        # type: (List[str]) -> None
+        request = Request(
+            "{}/write?{}".format(self.influx_url,
+                                 urlencode(dict(db=self.database,
+                                                precision="ms"))),
+            data="\n".join(lines).encode("utf-8"))
+        urlopen(request).read()
+
+    def merge_interval(self, start):
+        # type: (int) -> None
+        """Write the percentiles of an interval starting at start, in
+        seconds"""
+        series = self._query(
+            "SELECT * FROM {} WHERE time >= {}s AND time < {}s "
+            "GROUP BY step, metric".format(HISTOGRAM_MEASUREMENT, start,
+                                            start + MERGE_INTERVAL)
+        )
+        lines = []
+        for (step, metric), histogram in sorted(merge(series).items()):
+            if not histogram:
+                continue
+            fields = ",".join(
+                "{}={}".format(name, value) for name, value in
+                sorted(percentiles(histogram).items()))
+            lines.append("{},metric={},step={} {} {}".format(
+                PERCENTILE_MEASUREMENT, escape(metric), escape(step),
+                fields, start * 1000))
+        if lines:
+            self._write(lines)
+
+    def run(self, until):  # pragma: no cover
+        # type: (float) -> None
+        """Merge every interval until the end of the run, in seconds since
+        epoch"""
+        start = int(time.time()) // MERGE_INTERVAL * MERGE_INTERVAL - \
+            MERGE_LAG * MERGE_INTERVAL
+        while start < until:
+            due = start + (MERGE_LAG + 1) * MERGE_INTERVAL
+            if time.time() < due:
+                time.sleep(due - time.time())
+            try:
+                self.merge_interval(start)
+            except Exception as exc:
+                logger.warning("Failed merging histograms: %s", exc)
+            start += MERGE_INTERVAL
+
+
+if __name__ == "__main__":  # pragma: no cover
+    logger.info("Merging histograms")
+    HistogramMerger(os.environ["__ARDERE_INFLUXDB_NAME__"],
+                    os.environ.get("__ARDERE_INFLUX_URL__",
+                                   "http://127.0.0.1:8086")).run(
+        float(os.environ["__ARDERE_MERGE_UNTIL__"]))
+    logger.info("Finished.")
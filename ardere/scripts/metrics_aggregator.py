@@ -0,0 +1,332 @@
+import logging
+import os
+import threading
+import time
+import zlib
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:  # pragma: nocover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+    from urllib2 import HTTPError, Request, urlopen
+
+try:
+    from typing import Any, Dict, List, Optional, Tuple  # noqa
+except ImportError:  # pragma: nocover
+    pass
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+# Port the aggregator takes writes on, in place of InfluxDB
+AGGREGATOR_PORT = 8186
+
+# Seconds after its timestamp an interval is rolled up and written. This
+# leaves telegraf its collection and flush intervals to send it in, points
+# arriving later are dropped.
+AGGREGATION_DELAY = 30
+
+# Seconds telegraf collects metrics at. Points are grouped by the interval
+# they fall in, statsd metrics and the like aren't rounded to it by telegraf
+# so hosts write them at timestamps of their own.
+COLLECTION_INTERVAL = 10
+
+# Tag value the rolled up series of a step are written under, in place of
+# the host
+AGGREGATE_HOST = "aggregate"
+
+# Tag marking the points of sampled hosts, which are also written as is
+SAMPLED_TAG = "ardere_sampled"
+
+# Measurements whose fields are summed across hosts rather than rolled up
+# into mean, sum and max, and never written as is
+SUMMED_MEASUREMENTS = ("ardere_histogram",)
+
+# Nanoseconds per unit of the precisions InfluxDB takes writes in
+PRECISIONS = {"n": 1, "ns": 1, "u": 10 ** 3, "ms": 10 ** 6,
+              "s": 10 ** 9, "m": 60 * 10 ** 9, "h": 3600 * 10 ** 9}
+
+
+def split_unescaped(text, separator, quoted=False):
+    # type: (str, str, bool) -> List[str]
+    """Split line protocol at separators that aren't escaped, or within
+    a quoted string field when quoted"""
+    parts = []
+    current = []
+    in_quotes = False
+    escaped = False
+    for char in text:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif quoted and char == '"':
+            in_quotes = not in_quotes
+        elif char == separator and not in_quotes:
+            parts.append("".join(current))
+            current = []
+            continue
+        current.append(char)
+    parts.append("".join(current))
+    return parts
+
+
+def parse_line(line):
+    # type: (str) -> Optional[Tuple[str, List[Tuple[str, str]], List[Tuple[str, str]], Optional[int]]]  # noqa
+    """Parse a point of line protocol into its measurement, tags, fields
+    and timestamp, keeping keys and values escaped"""
+    sections = [section for section in
+                split_unescaped(line.strip(), " ", quoted=True) if section]
+    if len(sections) not in (2, 3):
+        return None
+    series = split_unescaped(sections[0], ",")
+    try:
+        tags = [tuple(split_unescaped(tag, "=")) for tag in series[1:]]
+        fields = [tuple(split_unescaped(field, "="))
+                  for field in split_unescaped(sections[1], ",",
+                                               quoted=True)]
+        timestamp = int(sections[2]) if len(sections) == 3 else None
+    except ValueError:
+        return None
+    if any(len(pair) != 2 for pair in tags + fields):
+        return None
+    return series[0], tags, fields, timestamp
+
+
+def field_value(value):
+    # type: (str) -> Optional[Tuple[bool, float]]
+    """Return whether a field value is an integer and its number, None
+    for strings and booleans"""
+    try:
+        if value.endswith("i"):
+            return True, int(value[:-1])
+        return False, float(value)
+    except ValueError:
+        return None
+
+
+def format_value(is_int, value):
+    # type: (bool, float) -> str
+    if is_int:
+        return "{}i".format(int(round(value)))
+    return repr(float(value))
+
+
+def format_line(measurement, tags, fields, timestamp):
+    # type: (str, List[Tuple[str, str]], List[Tuple[str, str]], int) -> str
+    series = ",".join([measurement] + ["{}={}".format(key, value)
+                                       for key, value in sorted(tags)])
+    return "{} {} {}".format(
+        series, ",".join("{}={}".format(key, value)
+                         for key, value in fields), timestamp)
+
+
+class MetricsAggregator(object):
+    """Rolls the metrics of every host up per step and interval
+
+    Points are grouped by measurement, tags other than the host and the
+    collection interval of their timestamp. Numeric fields are written as
+    their mean across hosts under their own name, along with their sum and
+    max, and the amount of hosts that reported. The fields of summed
+    measurements are only summed. Points of sampled hosts are written as
+    is as well.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups = {}  # type: Dict[Tuple[str, str, Tuple[Tuple[str, str], ...], int], Dict[str, Any]]  # noqa
+        self._sampled = {}  # type: Dict[str, List[str]]
+        self._flushed = {}  # type: Dict[str, int]
+        self.dropped = 0
+
+    def ingest(self, database, body, precision="ns", now=None):
+        # type: (str, str, str, Optional[float]) -> None
+        """Take in the points of a write to a database"""
+        scale = PRECISIONS.get(precision or "ns", 1)
+        default_time = int(now or time.time()) * 10 ** 9
+        with self._lock:
+            for line in body.splitlines():
+                if not line.strip() or line.startswith("#"):
+                    continue
+                point = parse_line(line)
+                if not point:
+                    continue
+                measurement, tags, fields, timestamp = point
+                timestamp = timestamp * scale if timestamp is not None \
+                    else default_time
+                interval = timestamp - timestamp % (COLLECTION_INTERVAL *
+                                                    10 ** 9)
+                if interval <= self._flushed.get(database, 0):
+                    self.dropped += 1
+                    continue
+
+                sampled = any(key == SAMPLED_TAG for key, _ in tags)
+                tags = [(key, value) for key, value in tags
+                        if key != SAMPLED_TAG]
+                if sampled and measurement not in SUMMED_MEASUREMENTS:
+                    self._sampled.setdefault(database, []).append(
+                        format_line(measurement, tags, fields, timestamp))
+
+                host = [value for key, value in tags if key == "host"]
+                group_tags = tuple(sorted(
+                    (key, value) for key, value in tags if key != "host"))
+                group = self._groups.setdefault(
+                    (database, measurement, group_tags, interval),
+                    dict(hosts=set(), fields={}))
+                group["hosts"].add(host[0] if host else "")
+                for key, value in fields:
+                    parsed = field_value(value)
+                    if parsed is None:
+                        continue
+                    is_int, number = parsed
+                    stats = group["fields"].setdefault(
+                        key, dict(is_int=is_int, sum=0, max=number,
+                                  count=0))
+                    stats["sum"] += number
+                    stats["max"] = max(stats["max"], number)
+                    stats["count"] += 1
+
+    def _rolled_up(self, measurement, group):
+        # type: (str, Dict[str, Any]) -> List[Tuple[str, str]]
+        fields = []
+        for key, stats in sorted(group["fields"].items()):
+            is_int = stats["is_int"]
+            if measurement in SUMMED_MEASUREMENTS:
+                fields.append((key, format_value(is_int, stats["sum"])))
+                continue
+            fields.extend([
+                (key, format_value(is_int,
+                                   float(stats["sum"]) / stats["count"])),
+                (key + "_sum", format_value(is_int, stats["sum"])),
+                (key + "_max", format_value(is_int, stats["max"]))
+            ])
+        if fields and measurement not in SUMMED_MEASUREMENTS:
+            fields.append(("ardere_hosts", "{}i".format(len(group["hosts"]))))
+        return fields
+
+    def flush(self, now=None):
+        # type: (Optional[float]) -> Dict[str, List[str]]
+        """Return the lines to write to each database, the intervals due
+        rolled up and the points of sampled hosts"""
+        due = int((now or time.time()) - AGGREGATION_DELAY) * 10 ** 9
+        with self._lock:
+            writes = self._sampled
+            self._sampled = {}
+            for key in sorted(self._groups):
+                database, measurement, tags, timestamp = key
+                if timestamp > due:
+                    continue
+                group = self._groups.pop(key)
+                self._flushed[database] = max(
+                    self._flushed.get(database, 0), timestamp)
+                fields = self._rolled_up(measurement, group)
+                if not fields:
+                    continue
+                if measurement not in SUMMED_MEASUREMENTS:
+                    tags = tags + (("host", AGGREGATE_HOST),)
+                writes.setdefault(database, []).append(
+                    format_line(measurement, list(tags), fields, timestamp))
+        return writes
+
+
+class InfluxProxy(object):
+    """Writes to the InfluxDB the aggregator sits in front of"""
+    def __init__(self, influx_url):
+        # type: (str) -> None
+        self.influx_url = influx_url
+
+    def write(self, database, lines):
+        # type: (str, List[str]) -> None
+        request = Request(
+            "{}/write?db={}&precision=ns".format(self.influx_url, database),
+            data="\n".join(lines).encode("utf-8"))
+        urlopen(request, timeout=10).read()
+
+    def forward(self, method, path, body, headers):
+        # type: (str, str, Optional[bytes], Dict[str, str]) -> Tuple[int, bytes]  # noqa
+        request = Request(self.influx_url + path, data=body,
+                          headers=headers)
+        request.get_method = lambda: method
+        try:
+            response = urlopen(request, timeout=10)
+            return response.getcode(), response.read()
+        except HTTPError as exc:
+            return exc.code, exc.read()
+
+
+def make_handler(aggregator, influx):  # pragma: no cover
+    class Handler(BaseHTTPRequestHandler):
+        def _body(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length",
+                                                        0)))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            return body
+
+        def _respond(self, status, body=b""):
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _forward(self, method):
+            body = self._body() if method == "POST" else None
+            headers = {}
+            if self.headers.get("Content-Type"):
+                headers["Content-Type"] = self.headers["Content-Type"]
+            self._respond(*influx.forward(method, self.path, body, headers))
+
+        def do_GET(self):
+            self._forward("GET")
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/write":
+                return self._forward("POST")
+            params = parse_qs(url.query)
+            aggregator.ingest(params.get("db", [""])[0],
+                              self._body().decode("utf-8"),
+                              params.get("precision", ["ns"])[0])
+            self._respond(204)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):  # pragma: no cover
+    daemon_threads = True
+
+
+def main():  # pragma: no cover
+    aggregator = MetricsAggregator()
+    influx = InfluxProxy(os.environ.get("__ARDERE_INFLUX_URL__",
+                                       "http://127.0.0.1:8086"))
+    server = ThreadingHTTPServer(("", AGGREGATOR_PORT),
+                                 make_handler(aggregator, influx))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        time.sleep(1)
+        for database, lines in aggregator.flush().items():
+            try:
+                influx.write(database, lines)
+            except Exception as exc:
+                logger.warning("Failed writing %d points to %s: %s",
+                               len(lines), database, exc)
+        if aggregator.dropped:
+            logger.warning("Dropped %d late points", aggregator.dropped)
+            aggregator.dropped = 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    logger.info("Aggregating metrics")
+    main()
@@ -0,0 +1,177 @@
+import logging
+import os
+import select
+import socket
+import time
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:  # pragma: nocover
+    from urllib2 import Request, urlopen
+
+try:
+    from typing import Any, Dict, List, Tuple  # noqa
+except ImportError:  # pragma: nocover
+    pass
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+# Seconds of timings each histogram covers, in step with telegraf's
+# collection interval
+FLUSH_INTERVAL = 10
+
+# Measurement the histograms are written to
+HISTOGRAM_MEASUREMENT = "ardere_histogram"
+
+# statsd metric types whose values are counted in histograms
+HISTOGRAM_TYPES = ("ms", "h")
+
+# Largest statsd packet accepted
+MAX_PACKET_SIZE = 65535
+
+
+def bucket(value, precision):
+    # type: (float, int) -> str
+    """Return the bucket a value is counted in, the value rounded to
+    precision significant digits
+
+    The bucket doubles as the field key it's written under, hosts using
+    the same precision count a value in the same bucket so their
+    histograms can be summed.
+
+    """
+    if value <= 0:
+        return "0"
+    return "{:.{}e}".format(value, precision - 1)
+
+
+def escape(value):
+    # type: (str) -> str
+    """Escape a tag or field key for the InfluxDB line protocol"""
+    for char in ("\\", ",", "=", " "):
+        value = value.replace(char, "\\" + char)
+    return value
+
+
+def parse_run_file(contents):
+    # type: (str) -> Dict[str, str]
+    """Parse the NAME='value' lines of a run file"""
+    values = {}
+    for line in contents.splitlines():
+        name, sep, value = line.partition("=")
+        if sep:
+            values[name.strip()] = value.strip().strip("'")
+    return values
+
+
+class HistogramRelay(object):
+    """Keeps histograms of the statsd timings of a step's container"""
+    def __init__(self, step, host, precision):
+        # type: (str, str, int) -> None
+        self.step = step
+        self.host = host
+        self.precision = precision
+        self.histograms = {}  # type: Dict[str, Dict[str, float]]
+
+    def record(self, packet):
+        # type: (str) -> None
+        """Count the timings in a statsd packet, other metrics are left
+        to telegraf"""
+        for line in packet.splitlines():
+            try:
+                name, rest = line.split(":", 1)
+                parts = rest.split("|")
+                if parts[1] not in HISTOGRAM_TYPES:
+                    continue
+                value = float(parts[0])
+                rate = 1.0
+                for part in parts[2:]:
+                    if part.startswith("@"):
+                        rate = float(part[1:])
+            except (IndexError, ValueError):
+                continue
+            if rate <= 0:
+                continue
+            histogram = self.histograms.setdefault(name, {})
+            key = bucket(value, self.precision)
+            histogram[key] = histogram.get(key, 0) + 1 / rate
+
+    def flush(self, timestamp):
+        # type: (int) -> List[str]
+        """Return the histograms as line protocol points at a timestamp
+        in milliseconds, starting new ones"""
+        lines = []
+        for name, histogram in sorted(self.histograms.items()):
+            fields = ",".join(
+                "{}={}".format(escape(key), float(count))
+                for key, count in sorted(histogram.items()))
+            lines.append("{},host={},metric={},step={} {} {}".format(
+                HISTOGRAM_MEASUREMENT, escape(self.host), escape(name),
+                escape(self.step), fields, timestamp))
+        self.histograms = {}
+        return lines
+
+
+def fetch(url, timeout=2):
+    # type: (str, int) -> str
+    return urlopen(url, timeout=timeout).read().decode("utf-8")
+
+
+def write_points(influx_addr, database, lines):
+    # type: (str, str, List[str]) -> None
+    request = Request(
+        "http://{}/write?db={}&precision=ms".format(influx_addr, database),
+        data="\n".join(lines).encode("utf-8"))
+    urlopen(request, timeout=5).read()
+
+
+def main():  # pragma: no cover
+    listen_port = int(os.environ["__ARDERE_STATSD_PORT__"])
+    telegraf_port = int(os.environ["__ARDERE_TELEGRAF_PORT__"])
+    precision = int(os.environ["__ARDERE_HISTOGRAM_PRECISION__"])
+
+    # Listen right away, metrics are passed on while the run file loads
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(("", listen_port))
+    forwarder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    run_values = {}
+    while "ARDERE_INFLUX_ADDR" not in run_values:
+        try:
+            run_values = parse_run_file(
+                fetch(os.environ["__ARDERE_RUN_URL__"]))
+        except Exception as exc:
+            logger.warning("Failed fetching the run file: %s", exc)
+            time.sleep(FLUSH_INTERVAL)
+    try:
+        host = fetch("http://169.254.169.254/latest/meta-data/instance-id")
+    except Exception:
+        host = socket.gethostname()
+
+    relay = HistogramRelay(os.environ["__ARDERE_TELEGRAF_STEP__"], host,
+                           precision)
+
+    interval_start = int(time.time()) // FLUSH_INTERVAL * FLUSH_INTERVAL
+    while True:
+        remaining = interval_start + FLUSH_INTERVAL - time.time()
+        if remaining > 0 and select.select([listener], [], [], remaining)[0]:
+            packet = listener.recv(MAX_PACKET_SIZE)
+            forwarder.sendto(packet, ("127.0.0.1", telegraf_port))
+            relay.record(packet.decode("utf-8", "replace"))
+            continue
+
+        lines = relay.flush(interval_start * 1000)
+        interval_start += FLUSH_INTERVAL
+        if not lines:
+            continue
+        try:
+            write_points(run_values["ARDERE_INFLUX_ADDR"],
+                         run_values["ARDERE_INFLUX_DB"], lines)
+        except Exception as exc:
+            logger.warning("Failed writing histograms: %s", exc)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    logger.info("Relaying statsd metrics")
+    main()
@@ -1,24 +1,37 @@
+import functools
 import logging
+import math
 import os
-import re
 import time
 from collections import defaultdict
 
 import boto3
 import botocore
-import toml
-from marshmallow import (
-    Schema,
-    decorators,
-    fields,
-    validate,
-    ValidationError,
-)
-from typing import Any, Dict, List  # noqa
+from typing import Any, Dict, List, Optional, Tuple  # noqa
 
 from ardere.aws import (
+    DEFAULT_CRASH_LOOP_THRESHOLD,
+    DEFAULT_MEMORY_RESERVATION,
+    DEFAULT_READY_GRACE,
+    DEFAULT_READY_POLICY,
+    DEFAULT_READY_THRESHOLD,
+    DEFAULT_READY_TIMEOUT,
+    DEFAULT_STATSD_PORT,
     ECSManager,
+    HOST_REUSE_DELAY,
+    PlanStateStore,
+    STATSD_RELAY_CPU_UNITS,
+    STATSD_RELAY_MEMORY_RESERVATION,
+    STATSD_RELAY_PORT_OFFSET,
+    TELEGRAF_CPU_UNITS,
+    TELEGRAF_MEMORY_RESERVATION,
+    api_calls,
+    cached_client,
+    cpu_units_for_instance_type,
     ec2_vcpu_by_type,
+    equivalent_instance_types,
+    memory_units_for_instance_type,
+    ready_poll_interval,
 )
 from ardere.exceptions import (
     CreatingMetricSourceException,
@@ -31,88 +44,50 @@ from ardere.exceptions import (
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Step name is used as the Log stream name.
-# Log stream names are limited to 512 characters (no ":" or "*")
-# Name format is
-# ardere-UUID/STEP_NAME/LUUID
-# where UUID is dashed, and LUUID is not
-# therefore: 512 - (9 + 36 + 32) = max name len
-MAX_NAME_LEN = 435
-INVALID_NAME_CHECK = re.compile("([:\*]+)")
-
-
-class StepValidator(Schema):
-    name = fields.String(required=True)
-    instance_count = fields.Int(required=True)
-    instance_type = fields.String(
-        required=True,
-        validate=validate.OneOf(ec2_vcpu_by_type.keys())
-    )
-    run_max_time = fields.Int(required=True)
-    run_delay = fields.Int(missing=0)
-    container_name = fields.String(required=True)
-    cmd = fields.String(required=True)
-    port_mapping = fields.List(fields.Int())
-    env = fields.Dict()
-    docker_series = fields.String(missing="default")
-
-    @decorators.validates("name")
-    def validate_name(self, value):
-        if len(value) == 0:
-            raise ValidationError("Step name missing")
-        if len(value) > MAX_NAME_LEN:
-            raise ValidationError("Step name too long")
-        if INVALID_NAME_CHECK.search(value):
-            raise ValidationError("Step name contains invalid characters")
-
-
-class DashboardOptions(Schema):
-    admin_user = fields.String(missing="admin")
-    admin_password = fields.String(required=True)
-    name = fields.String(required=True)
-    filename = fields.String(required=True)
-
-
-class MetricsOptions(Schema):
-    enabled = fields.Bool(missing=True)
-    instance_type = fields.String(
-        missing="c4.large",
-        validate=validate.OneOf(ec2_vcpu_by_type.keys())
-    )
-    dashboard = fields.Nested(DashboardOptions)
-    tear_down = fields.Bool(missing=False)
-
-
-class PlanValidator(Schema):
-    ecs_name = fields.String(required=True)
-    name = fields.String(required=True)
-    metrics_options = fields.Nested(MetricsOptions, missing={})
-
-    steps = fields.Nested(StepValidator, many=True)
-
-    def _log_validate_name(self, value, name_type):
-        if len(value) == 0:
-            raise ValidationError("{} missing".format(name_type))
-        if len(value) > MAX_NAME_LEN:
-            raise ValidationError("{} too long".format(name_type))
-        if INVALID_NAME_CHECK.search(value):
-            raise ValidationError(
-                "{} contained invalid characters".format(name_type))
-
-    @decorators.validates("ecs_name")
-    def validate_ecs_name(self, value):
-        """Verify a cluster exists for this name"""
-        self._log_validate_name(value, "Plan ecs_name")
-        client = self.context["boto"].client('ecs')
-        response = client.describe_clusters(
-            clusters=[value]
-        )
-        if not response.get("clusters"):
-            raise ValidationError("No cluster with the provided name.")
+# Seconds a pooled instance may sit idle before the reaper terminates it
+DEFAULT_POOL_IDLE_TTL = 3600
+
+# Longest the state machine waits between done checks, so an aborted run
+# or lost instances are still noticed while no step is due to stop
+MAX_DONE_CHECK_WAIT = 60
+
+# Seconds the state machine waits before checking readiness again when the
+# check changed the plan, the interval of its retries otherwise
+READY_CHECK_WAIT = 10
+
+# Measurement the events of a plan run are written to in its metrics
+# database, for dashboards to annotate the load graphs with
+ANNOTATION_MEASUREMENT = "ardere_events"
+
+# Seconds tear down holds off removing the metrics service for the task
+# writing the last annotations of a run, within the drain check's retries
+ANNOTATION_WRITE_TIMEOUT = 60
 
-    @decorators.validates("name")
-    def validate_name(self, value):
-        self._log_validate_name(value, "Step name")
+# S3 error codes of a ready file that was removed, or replaced by another
+# run's. Other errors accessing it are left to the state machine to retry.
+READY_FILE_GONE_CODES = ("404", "NoSuchKey", "NotFound", "412",
+                         "PreconditionFailed")
+
+
+def plan_phase(name):
+    """Record when a phase of the plan ran and the AWS calls it made
+
+    A phase is taken to start when the one before it ended, as attempts
+    that raise to be retried by the state machine can't record anything.
+    Phases run more than once in a row, like the done checks, are
+    recorded once with the calls of all of their invocations.
+
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self):
+            started = time.time()
+            calls = api_calls.snapshot()
+            result = method(self)
+            self._record_phase(name, started, api_calls.since(calls))
+            return result
+        return wrapper
+    return decorator
 
 
 class AsynchronousPlanRunner(object):
@@ -130,13 +105,132 @@ class AsynchronousPlanRunner(object):
         logger.info("Called with {}".format(event))
         logger.info("Environ: {}".format(os.environ))
 
-        # Load our TOML if needed
+        # Load the plan state the event refers to, or our TOML if needed
+        if PlanStateStore.is_reference(event):
+            event = self._plan_state().load(event)
         event = self._load_toml(event)
 
         self.event = event
         self.context = context
         self.ecs = ECSManager(plan=event)
 
+    def _plan_state(self):
+        # type: () -> PlanStateStore
+        store = PlanStateStore(os.environ["plan_state_bucket"])
+        store.boto = self.boto
+        return store
+
+    def save_state(self, event):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        """Store the plan state, returning the reference to it that's
+        passed on to the next state
+
+        Without a plan state bucket configured the plan itself is passed
+        on.
+
+        """
+        if not os.environ.get("plan_state_bucket"):
+            return event
+        return self._plan_state().save(event)
+
+    def _record_phase(self, name, started, calls):
+        # type: (str, float, Dict[str, int]) -> None
+        """Record an invocation of a phase
+
+        The phase being run is kept apart from the earlier ones, and out of
+        the stored plan, so polls that change nothing else don't store a
+        new version of it. It joins the earlier ones once the next starts.
+
+        """
+        now = time.time()
+        current = self.event.get("current_phase")
+        if current and current["name"] == name:
+            current["end"] = now
+            current["invocations"] += 1
+            for api, count in calls.items():
+                current["aws_calls"][api] = \
+                    current["aws_calls"].get(api, 0) + count
+            return
+
+        phases = self.event.setdefault("phases", [])
+        if current:
+            phases.append(current)
+        self.event["current_phase"] = dict(
+            name=name,
+            start=phases[-1]["end"] if phases else started,
+            end=now,
+            invocations=1,
+            aws_calls=calls
+        )
+
+    def _phases(self):
+        # type: () -> List[Dict[str, Any]]
+        """Return the phases of the plan run so far, the one being run
+        last"""
+        phases = list(self.event.get("phases", []))
+        if self.event.get("current_phase"):
+            phases.append(self.event["current_phase"])
+        return phases
+
+    def _annotations(self):
+        # type: () -> List[Tuple[str, Dict[str, Any]]]
+        """Return the events of the plan run so far as points for its
+        metrics database, along with a key identifying each
+
+        The last annotations are written during cleanup, the cleanup and
+        drain phases are recorded after that and aren't annotated.
+
+        """
+        events = []
+        for phase in self._phases():
+            calls = sum(phase["aws_calls"].values())
+            events.append(("phase:" + phase["name"], phase["end"], dict(
+                title=phase["name"],
+                text="{:.1f}s, {} AWS calls".format(
+                    phase["end"] - phase["start"], calls),
+                duration=float(phase["end"] - phase["start"]),
+                aws_calls=calls
+            )))
+        if "start_time" in self.event:
+            events.append(("start", self.event["start_time"], dict(
+                title="start", text="Plan started")))
+        for step in self.event["steps"]:
+            if "stopped_at" in step:
+                events.append(("stop:" + step["name"], step["stopped_at"],
+                               dict(title="stop " + step["name"],
+                                    text="Step stopped")))
+        return [(key, dict(measurement=ANNOTATION_MEASUREMENT,
+                           time=int(when * 1000),
+                           tags=dict(event=key.split(":")[0]),
+                           fields=fields))
+                for key, when, fields in events]
+
+    def _write_annotations(self):
+        # type: () -> List[str]
+        """Write the events of the plan run not written yet into its
+        metrics database, returning the ARN's of the tasks writing them"""
+        if not self.event["metrics_options"]["enabled"] or \
+                not self.event.get("metric_container_arn"):
+            return []
+
+        written = self.event.setdefault("annotations_written", [])
+        pending = [(key, point) for key, point in self._annotations()
+                   if key not in written]
+        if not pending:
+            return []
+        try:
+            # Points of tasks started before one failed are written again
+            # next time, InfluxDB overwrites them with the same values
+            task_arns = self.ecs.run_annotation_task(
+                self.event["metric_container_arn"],
+                [point for _, point in pending]
+            )
+        except botocore.exceptions.ClientError as exc:
+            logger.warning("Failed writing annotations: {}".format(exc))
+            return []
+        written.extend(key for key, _ in pending)
+        return task_arns
+
     @property
     def grafana_auth(self):
         if not self.event["metrics_options"].get("dashboard"):
@@ -152,11 +246,137 @@ class AsynchronousPlanRunner(object):
     def _build_instance_map(self):
         """Given a JSON test-plan, build and return a dict of instance types
         and how many should exist for each type."""
-        instances = defaultdict(int)
+        steps_by_type = defaultdict(list)
         for step in self.event["steps"]:
-            instances[step["instance_type"]] += step["instance_count"]
+            steps_by_type[step["instance_type"]].append(step)
+
+        instances = defaultdict(int)
+        for instance_type, steps in steps_by_type.items():
+            if self.event.get("pack_steps"):
+                instances[instance_type] = self._pack_steps(
+                    instance_type, steps)
+            else:
+                instances[instance_type] = self._share_over_time(steps)
         return instances
 
+    def _share_over_time(self, steps):
+        # type: (List[Dict[str, Any]]) -> int
+        """Calculates how many instances steps of one instance type need
+
+        Steps whose run windows don't overlap share instances, so only the
+        peak concurrent demand is needed. Steps that only fit by reusing
+        the instances of steps before them are flagged with
+        ``defer_start`` so their service is scaled up once those steps
+        are done.
+
+        """
+        peak = self._peak_demand([self._step_window(step) for step in steps])
+
+        # Services are started with the plan unless holding their
+        # instances from the start would exceed the peak
+        held = []
+        for step in sorted(steps, key=lambda x: x.get("run_delay", 0)):
+            _, end, count = window = self._step_window(step)
+            if self._peak_demand(
+                    held + [(-HOST_REUSE_DELAY, end, count)]) <= peak:
+                step["defer_start"] = False
+                held.append((-HOST_REUSE_DELAY, end, count))
+            else:
+                step["defer_start"] = True
+                held.append(window)
+        return peak
+
+    def _pack_steps(self, instance_type, steps):
+        # type: (str, List[Dict[str, Any]]) -> int
+        """Bin-pack the tasks of steps of one instance type onto as few
+        instances as their cpu and memory reservations allow
+
+        Steps are placed first-fit-decreasing by cpu, with each task of a
+        step on a different instance. Every step is given its own statsd
+        port as the telegraf containers of steps sharing an instance can't
+        listen on the same one. Returns the amount of instances needed.
+
+        With capacity fallback the steps are packed by the memory of the
+        smallest type that may be launched in place of the instance type,
+        so they fit whichever gets launched.
+
+        """
+        candidates = [instance_type]
+        if self.event.get("capacity_fallback"):
+            candidates += equivalent_instance_types(instance_type)
+        cpu_capacity = ec2_vcpu_by_type[instance_type] * 1024
+        memory_capacity = min(memory_units_for_instance_type(candidate)
+                              for candidate in candidates)
+
+        # Steps keeping latency histograms run a statsd relay as well
+        relay = self.event.get("metrics_options", {}).get("histograms")
+        sidecar_cpu = TELEGRAF_CPU_UNITS + \
+            (STATSD_RELAY_CPU_UNITS if relay else 0)
+        sidecar_memory = TELEGRAF_MEMORY_RESERVATION + \
+            (STATSD_RELAY_MEMORY_RESERVATION if relay else 0)
+
+        def demand(step):
+            cpu = step.get("cpu_units",
+                           cpu_units_for_instance_type(instance_type))
+            memory = step.get("memory_reservation",
+                              DEFAULT_MEMORY_RESERVATION) * \
+                step.get("tasks_per_instance", 1)
+            return cpu + sidecar_cpu, memory + sidecar_memory
+
+        # Each bin is [cpu used, memory used, ports used]
+        bins = []  # type: List[List[Any]]
+        ordered = sorted(steps, key=demand, reverse=True)
+        for index, step in enumerate(ordered):
+            step["defer_start"] = False
+            step["statsd_port"] = DEFAULT_STATSD_PORT + index
+            cpu, memory = demand(step)
+            ports = set(step.get("port_mapping", [])) | {step["statsd_port"]}
+            if relay:
+                ports.add(step["statsd_port"] + STATSD_RELAY_PORT_OFFSET)
+
+            placed = 0
+            for instance in bins:
+                if placed == step["instance_count"]:
+                    break
+                if instance[0] + cpu > cpu_capacity or \
+                        instance[1] + memory > memory_capacity or \
+                        instance[2] & ports:
+                    continue
+                instance[0] += cpu
+                instance[1] += memory
+                instance[2] |= ports
+                placed += 1
+
+            for _ in range(step["instance_count"] - placed):
+                bins.append([cpu, memory, set(ports)])
+        return len(bins)
+
+    @staticmethod
+    def _step_window(step):
+        # type: (Dict[str, Any]) -> Tuple[int, int, int]
+        """Returns the (start, end, instance_count) window a step needs its
+        instances for, relative to the plan start"""
+        run_delay = step.get("run_delay", 0)
+        return (run_delay - HOST_REUSE_DELAY,
+                run_delay + step["run_max_time"],
+                step["instance_count"])
+
+    @staticmethod
+    def _peak_demand(windows):
+        # type: (List[Tuple[int, int, int]]) -> int
+        """Calculates the most instances needed at once by a list of
+        (start, end, instance_count) windows"""
+        # Ends sort before starts at the same time as windows are half-open
+        events = sorted(
+            [(start, 1, count) for start, _, count in windows] +
+            [(end, 0, -count) for _, end, count in windows]
+        )
+        peak = current = 0
+        for _, _, count in events:
+            current += count
+            peak = max(peak, current)
+        return peak
+
     def _find_test_plan_duration(self):
         # type: (Dict[str, Any]) -> int
         """Locates and calculates the longest test plan duration from its
@@ -168,10 +388,17 @@ class AsynchronousPlanRunner(object):
 
     def _load_toml(self, event):
         """Loads TOML if necessary"""
-        return toml.loads(event["toml"]) if "toml" in event else event
+        if "toml" not in event:
+            return event
+        # Only the first state gets TOML, the others shouldn't pay to import
+        # the parser on a cold start
+        import toml
+        return toml.loads(event["toml"])
 
     def _validate_plan(self):
         """Validates that the loaded plan is correct"""
+        # Only the first state validates, see _load_toml
+        from ardere.validation import PlanValidator
         schema = PlanValidator()
         schema.context["boto"] = self.boto
         data, errors = schema.load(self.event)
@@ -181,6 +408,7 @@ class AsynchronousPlanRunner(object):
         # Replace our event with the validated
         self.event = data
 
+    @plan_phase("instances_provisioned")
     def populate_missing_instances(self):
         """Populate any missing EC2 instances needed for the test plan in the
         cluster
@@ -211,18 +439,128 @@ class AsynchronousPlanRunner(object):
                 )
 
         logger.info("Plan instances needed: {}".format(needed))
-        current_instances = self.ecs.query_active_instances()
-        missing_instances = self.ecs.calculate_missing_instances(
-            desired=needed, current=current_instances
-        )
+        self.event["instances_needed"] = dict(needed)
+
+        # Claim whatever is left in the pool before counting it, along with
+        # the substitutes an earlier attempt or plan launched
+        self.ecs.touch_instances()
+        self._record_substitutes(self.ecs.query_instance_substitutes())
+        missing_instances = self._missing_instances(needed)
         if missing_instances:
             logger.info("Requesting instances: {}".format(missing_instances))
-            self.ecs.request_instances(
+            launched = self.ecs.request_instances(
                 instances=missing_instances,
-                security_group_ids=[os.environ["ec2_sg"]]
+                security_group_ids=[os.environ["ec2_sg"]],
+                fallback=self.event.get("capacity_fallback", False),
+                spot=self.event.get("spot_instances", False)
             )
+            self._record_substitutes(launched)
         return self.event
 
+    def _replace_lost_instances(self):
+        """Request replacements for spot instances reclaimed by EC2
+
+        ECS reschedules the tasks of lost instances by itself once there
+        are instances for them to run on again.
+
+        """
+        if self.event.get("spot_instances"):
+            self._request_missing_instances()
+
+    def _replace_stragglers(self):
+        # type: () -> List[str]
+        """Terminate and replace instances that never joined the cluster,
+        lost their ECS agent or keep failing to start tasks, returning the
+        id's of those replaced"""
+        stragglers = self.ecs.find_stragglers()
+        if not stragglers:
+            return []
+
+        logger.warning("Replacing stragglers: {}".format(stragglers))
+        self.ecs.terminate_instances(stragglers)
+        self._request_missing_instances(terminated=stragglers)
+        return stragglers
+
+    def _check_crash_loops(self):
+        """Record the steps whose tasks keep failing, aborting the plan
+        if it asks for that
+
+        A step is crash looping once crash_loop_threshold of its tasks
+        failed for every task it runs, see ECSManager.task_failures.
+
+        """
+        threshold = self.event.get("crash_loop_threshold",
+                                   DEFAULT_CRASH_LOOP_THRESHOLD)
+        failures = self.ecs.task_failures(self.event["steps"])
+        looping = {}
+        for step in self.event["steps"]:
+            failed = failures.get(step["name"])
+            if failed and \
+                    failed["failures"] >= threshold * step["instance_count"]:
+                looping[step["name"]] = failed
+        if not looping:
+            return
+
+        self.event["crash_loops"] = looping
+        summary = ", ".join(
+            "{} ({} stopped, exit code {}: {})".format(
+                name, failed["failures"], failed["exit_code"],
+                failed["reason"])
+            for name, failed in sorted(looping.items()))
+        logger.error("Steps crash looping: {}".format(summary))
+        if self.event.get("abort_on_crash_loop"):
+            raise ShutdownPlanException(
+                "Steps crash looping: {}".format(summary))
+
+    def _missing_instances(self, needed, terminated=None):
+        # type: (Dict[str, int], Optional[List[str]]) -> Dict[str, int]
+        """Calculate how many instances of each type the plan needs that
+        aren't running or pending, substitutes count towards the instance
+        type they stand in for"""
+        return self.ecs.calculate_missing_instances(
+            desired=needed,
+            current=self.ecs.query_active_instances(exclude=terminated)
+        )
+
+    def _request_missing_instances(self, terminated=None):
+        # type: (Optional[List[str]]) -> None
+        """Request instances for any the plan needs that are no longer
+        running, counting the instances just terminated as gone"""
+        needed = self.event.get("instances_needed")
+        if not needed:
+            return
+
+        missing = self._missing_instances(needed, terminated)
+        if not missing:
+            return
+
+        logger.info("Replacing lost instances: {}".format(missing))
+        launched = self.ecs.request_instances(
+            instances=missing,
+            security_group_ids=[os.environ["ec2_sg"]],
+            fallback=self.event.get("capacity_fallback", False),
+            spot=self.event.get("spot_instances", False)
+        )
+        self._record_substitutes(launched)
+        self.event["replaced_instances"] = \
+            self.event.get("replaced_instances", 0) + sum(missing.values())
+
+    def _record_substitutes(self, launched):
+        # type: (Dict[str, Dict[str, int]]) -> None
+        """Note the instance types launched in place of the ones requested
+        so steps can be placed on either"""
+        substitutes = self.event.setdefault("instance_substitutes", {})
+        for instance_type, types in launched.items():
+            for launched_type in types:
+                if launched_type == instance_type:
+                    continue
+                substitutes.setdefault(instance_type, [])
+                if launched_type not in substitutes[instance_type]:
+                    substitutes[instance_type].append(launched_type)
+        if substitutes:
+            logger.info("Instance substitutes: {}".format(substitutes))
+
+    @plan_phase("metrics_available")
     def ensure_metrics_available(self):
         """Start the metrics service, ensure its running, and its IP is known
 
@@ -254,8 +592,18 @@ class AsynchronousPlanRunner(object):
 
         self.event["influxdb_private_ip"] = metric_ip
         self.event["metric_container_arn"] = container_arn
+
+        # A metrics service kept from a plan that didn't aggregate metrics
+        # has no aggregator, hosts then write their own series
+        if self.event["metrics_options"].get("aggregation") == "step":
+            aggregates = self.ecs.metrics_service_aggregates(metrics)
+            if not aggregates:
+                logger.warning("Metrics service has no aggregator, "
+                               "metrics are kept per host")
+            self.event["metrics_aggregator"] = aggregates
         return self.event
 
+    @plan_phase("metric_sources_created")
     def ensure_metric_sources_created(self):
         """Ensure the metrics db and grafana datasource are configured"""
         if not self.event["metrics_options"]["enabled"]:
@@ -284,69 +632,236 @@ class AsynchronousPlanRunner(object):
         self.event["grafana_dashboard"] = "http://{}:3000".format(metric_ip)
         return self.event
 
+    @plan_phase("services_created")
     def create_ecs_services(self):
         """Create all the ECS services needed
 
         """
+        # Taken before creating them, tasks created since belong to the run
+        created_at = int(time.time())
         self.ecs.create_services(self.event["steps"])
+        self.event["services_created_at"] = created_at
         return self.event
 
+    @plan_phase("services_ready")
     def wait_for_cluster_ready(self):
         """Check all the ECS services to see if they're ready
 
+        Once the ready grace period is over a step is ready when its
+        ready_threshold share of tasks is running, so a few instances that
+        never come up don't hold up the plan. After the ready timeout the
+        ready policy either aborts the plan or starts it anyway. Instances
+        holding up the services are replaced while waiting. How many
+        tasks were running at the start is recorded in the plan.
+
+        While waiting the state is retried, except after replacing
+        instances. A retried state is given the plan it was given before,
+        so the plan is returned instead for the state machine to wait and
+        check again.
+
         """
-        if not self.ecs.all_services_ready(self.event["steps"]):
-            raise ServicesStartingException()
+        steps = self.event["steps"]
+        waited = time.time() - self.event.get("services_created_at",
+                                              time.time())
+        thresholds = {}
+        if waited >= self.event.get("ready_grace", DEFAULT_READY_GRACE):
+            plan_threshold = self.event.get("ready_threshold",
+                                            DEFAULT_READY_THRESHOLD)
+            thresholds = {step["name"]: step.get("ready_threshold",
+                                                 plan_threshold)
+                          for step in steps}
+
+        if not self.ecs.all_services_ready(steps, thresholds):
+            self._check_crash_loops()
+            if waited < self.event.get("ready_timeout",
+                                       DEFAULT_READY_TIMEOUT):
+                # Only worth replacing instances for while still waiting
+                if self._replace_stragglers():
+                    self.event["services_ready"] = False
+                    self.event["next_check_wait"] = READY_CHECK_WAIT
+                    return self.event
+                raise ServicesStartingException()
+            if self.event.get("ready_policy",
+                              DEFAULT_READY_POLICY) == "abort":
+                raise ShutdownPlanException(
+                    "Services not ready after {}s".format(int(waited)))
+            logger.warning("Services not ready after {}s, starting "
+                           "anyway".format(int(waited)))
+
+        self.event["tasks_at_start"] = dict(
+            desired=sum(step.get("tasks_desired", 0) for step in steps),
+            running=sum(step.get("tasks_running", 0) for step in steps)
+        )
+        logger.info("Tasks at start: {}".format(self.event["tasks_at_start"]))
+        self.event["services_ready"] = True
         return self.event
 
+    @plan_phase("start_signalled")
     def signal_cluster_start(self):
         """Drop a ready file in S3 to trigger the test plan to being
 
+        The start time in it lies a couple of poll intervals ahead, to the
+        millisecond, the containers poll for the file at a slow, jittered
+        pace and sleep until that instant once they've read it.
+
         """
-        s3_client = self.boto.client('s3')
-        s3_client.put_object(
+        start_time = round(
+            time.time() + 2 * ready_poll_interval(self.event["steps"]), 3)
+        response = cached_client(self.boto, 's3').put_object(
             ACL="public-read",
-            Body=b'{}'.format(int(time.time())),
+            Body="{:.3f}".format(start_time).encode("utf-8"),
             Bucket=os.environ["s3_ready_bucket"],
             Key="{}.ready".format(self.ecs.plan_uuid),
             Metadata={
                 "ECSCluster": self.event["ecs_name"]
             }
         )
+
+        # Carry the start time along so the done checks needn't fetch it
+        self.event["start_time"] = start_time
+        self.event["ready_etag"] = response.get("ETag")
+
+        # Mark how long it took to get here on the run's graphs
+        self._write_annotations()
+        self._start_histogram_merger()
         return self.event
 
+    def _start_histogram_merger(self):
+        """Start merging the latency histograms of the run's steps, if
+        they keep them, until the run ends"""
+        metrics_options = self.event["metrics_options"]
+        if not metrics_options["enabled"] or \
+                not metrics_options.get("histograms") or \
+                not self.event.get("metric_container_arn"):
+            return
+
+        until = self.event["start_time"] + self._find_test_plan_duration()
+        try:
+            self.ecs.run_histogram_merger_task(
+                self.event["metric_container_arn"], until)
+        except botocore.exceptions.ClientError as exc:
+            logger.warning("Failed starting histogram merger: {}".format(
+                exc))
+
+    def _load_start_time(self):
+        # type: () -> float
+        """Return the plan start time, aborting the plan if the ready file
+        is gone
+
+        The start time is carried in the plan since it was started, the
+        ready file is only checked for with a HEAD request. Plans started
+        before the start time was carried fall back to reading it. Errors
+        checking for it other than it missing or being replaced are
+        raised.
+
+        """
+        bucket = os.environ["s3_ready_bucket"]
+        key = "{}.ready".format(self.ecs.plan_uuid)
+        if "start_time" not in self.event:
+            # Check to see if the S3 file is still around
+            s3 = self.boto.resource('s3')
+            try:
+                ready_file = s3.Object(bucket, key)
+            except botocore.exceptions.ClientError:
+                # Error getting to the bucket/key, abort test run
+                raise ShutdownPlanException("Error accessing ready file")
+
+            file_contents = ready_file.get()['Body'].read().decode('utf-8')
+            return float(file_contents)
+
+        head_args = dict(Bucket=bucket, Key=key)
+        if self.event.get("ready_etag"):
+            # A ready file that was replaced doesn't belong to this run
+            head_args["IfMatch"] = self.event["ready_etag"]
+        try:
+            cached_client(self.boto, 's3').head_object(**head_args)
+        except botocore.exceptions.ClientError as exc:
+            self._raise_unless_ready_file_gone(exc)
+            raise ShutdownPlanException("Ready file removed or replaced")
+        return self.event["start_time"]
+
+    @staticmethod
+    def _raise_unless_ready_file_gone(exc):
+        # type: (botocore.exceptions.ClientError) -> None
+        code = exc.response.get("Error", {}).get("Code")
+        if code not in READY_FILE_GONE_CODES:
+            raise exc
+
+    @plan_phase("run")
     def check_for_cluster_done(self):
         """Check all the ECS services to see if they've run for their
         specified duration
 
         """
-        # Check to see if the S3 file is still around
-        s3 = self.boto.resource('s3')
-        try:
-            ready_file = s3.Object(
-                os.environ["s3_ready_bucket"],
-                "{}.ready".format(self.ecs.plan_uuid)
-            )
-        except botocore.exceptions.ClientError:
-            # Error getting to the bucket/key, abort test run
-            raise ShutdownPlanException("Error accessing ready file")
-
-        file_contents = ready_file.get()['Body'].read().decode('utf-8')
-        start_time = int(file_contents)
+        start_time = self._load_start_time()
 
         # Update to running count 0 any services that should halt by now
         self.ecs.stop_finished_services(start_time, self.event["steps"])
 
+        # Scale up services waiting on instances the stopped ones freed
+        self.ecs.start_deferred_services(start_time, self.event["steps"])
+
+        # Keep the load up if spot instances were reclaimed
+        self._replace_lost_instances()
+
+        # Note, or abort on, steps whose tasks keep failing
+        self._check_crash_loops()
+
         # If we're totally done, exit.
         now = time.time()
         plan_duration = self._find_test_plan_duration()
-        if now > (start_time + plan_duration):
+        if now >= (start_time + plan_duration):
             raise ShutdownPlanException("Test Plan has completed")
+
+        self.event["next_check_wait"] = self._next_check_wait(start_time,
+                                                              now)
         return self.event
 
+    def _next_check_wait(self, start_time, now):
+        # type: (float, float) -> int
+        """Calculate how many seconds to wait until the next step is due
+        to be stopped or scaled up"""
+        due = [start_time + self._find_test_plan_duration()]
+        for step in self.event["steps"]:
+            run_delay = step.get("run_delay", 0)
+            status = step.get("service_status")
+            if status == "DEFERRED":
+                due.append(start_time + run_delay - HOST_REUSE_DELAY)
+            if status != "STOPPED":
+                due.append(start_time + run_delay + step["run_max_time"])
+
+        upcoming = [when for when in due if when > now]
+        if not upcoming:
+            return 1
+        wait = int(math.ceil(min(upcoming) - now))
+        return max(1, min(wait, MAX_DONE_CHECK_WAIT))
+
+    @plan_phase("cleanup")
     def cleanup_cluster(self):
         """Shutdown all ECS services and deregister all task definitions"""
-        self.ecs.shutdown_plan(self.event["steps"])
+        # The task writing the last annotations needs the metrics service,
+        # tearing it down is left to the drain check once the task is done
+        annotation_tasks = self._write_annotations()
+        keep_metrics_service = bool(annotation_tasks) and \
+            self.event["metrics_options"].get("tear_down", False)
+        if keep_metrics_service:
+            self.event["annotation_tasks"] = annotation_tasks
+            self.event["annotations_started_at"] = time.time()
+
+        # Step task definitions are shared between runs, note which log
+        # streams belong to this one while ECS still knows of its tasks
+        if "services_created_at" in self.event:
+            try:
+                self.event["log_streams"] = self.ecs.run_log_streams(
+                    self.event["steps"], self.event["services_created_at"])
+            except botocore.exceptions.ClientError as exc:
+                logger.warning("Failed listing log streams: {}".format(exc))
+
+        self.event["cleanup_report"] = self.ecs.shutdown_plan(
+            self.event["steps"], keep_metrics_service=keep_metrics_service)
+
+        # Return the instances to the pool, starting their idle time
+        self.ecs.touch_instances()
 
         # Attempt to remove the S3 object
         s3 = self.boto.resource('s3')
@@ -360,9 +875,64 @@ class AsynchronousPlanRunner(object):
             pass
         return self.event
 
+    @plan_phase("drained")
     def check_drained(self):
         """Ensure that all services are shut down before allowing restart"""
+        self._tear_down_metrics()
         if self.ecs.all_services_done(self.event["steps"]):
             return self.event
         else:
             raise UndrainedInstancesException("Services still draining")
+
+    def _tear_down_metrics(self):
+        """Remove the metrics service cleanup kept up for the last
+        annotations, once they're written or waited on long enough"""
+        task_arns = self.event.get("annotation_tasks")
+        if not task_arns:
+            return
+
+        waited = time.time() - self.event["annotations_started_at"]
+        if waited < ANNOTATION_WRITE_TIMEOUT:
+            try:
+                written = self.ecs.tasks_stopped(task_arns)
+            except botocore.exceptions.ClientError as exc:
+                logger.warning("Failed checking annotation tasks: {}".format(
+                    exc))
+                written = False
+            if not written:
+                raise UndrainedInstancesException(
+                    "Annotations still being written")
+        self.ecs.remove_metrics_service()
+
+
+class InstancePoolReaper(object):
+    """Warm Instance Pool Reaper
+
+    Instances launched for a plan stay in the cluster so later plans can
+    claim them instead of waiting for new ones to boot. The reaper runs
+    on a schedule and terminates the pooled instances that have been idle
+    for longer than the pool's TTL.
+
+    """
+    # For testing purposes
+    ecs_manager = ECSManager
+
+    def __init__(self, event, context):
+        logger.info("Called with {}".format(event))
+        self.event = event
+        self.context = context
+        self.idle_ttl = int(event.get(
+            "idle_ttl",
+            os.environ.get("pool_idle_ttl", DEFAULT_POOL_IDLE_TTL)
+        ))
+
+    def reap_idle_instances(self):
+        """Terminate idle pooled instances in every cluster with a pool"""
+        clusters = self.event.get("ecs_names") or \
+            self.ecs_manager.pooled_clusters()
+        terminated = {}
+        for ecs_name in clusters:
+            ecs = self.ecs_manager(plan=dict(ecs_name=ecs_name))
+            terminated[ecs_name] = ecs.reap_idle_instances(self.idle_ttl)
+        self.event["terminated"] = terminated
+        return self.event
@@ -0,0 +1,183 @@
+"""Test plan validation schemas"""
+import re
+
+from marshmallow import (
+    Schema,
+    decorators,
+    fields,
+    validate,
+    ValidationError,
+)
+
+from ardere.aws import (
+    DEFAULT_CRASH_LOOP_THRESHOLD,
+    DEFAULT_HISTOGRAM_PRECISION,
+    DEFAULT_HOST_SAMPLE_RATE,
+    DEFAULT_MEMORY_RESERVATION,
+    DEFAULT_READY_GRACE,
+    DEFAULT_READY_POLICY,
+    DEFAULT_READY_THRESHOLD,
+    DEFAULT_READY_TIMEOUT,
+    DEFAULT_STOP_GRACE,
+    MAX_CONTAINERS_PER_TASK,
+    MAX_READY_TIMEOUT,
+    cached_client,
+    ec2_vcpu_by_type,
+)
+
+# Step name is used in the task definition family and Log stream names.
+# Family names are limited to 255 characters, Log stream names to 512
+# characters (no ":" or "*")
+# Name formats are
+# STEP_NAME-HASH and ardere/STEP_NAME-SLOT/TASK_ID
+# where HASH is 32 hex digits, and the family is the tighter limit
+# therefore: 255 - (1 + 32) = max name len
+MAX_NAME_LEN = 222
+INVALID_NAME_CHECK = re.compile("([:\*]+)")
+
+
+def validate_ready_threshold(value):
+    """A step is never ready without any of its tasks running"""
+    if not 0 < value <= 1:
+        raise ValidationError("Must be greater than 0 and at most 1.")
+
+
+class StepValidator(Schema):
+    name = fields.String(required=True)
+    instance_count = fields.Int(required=True)
+    instance_type = fields.String(
+        required=True,
+        validate=validate.OneOf(ec2_vcpu_by_type.keys())
+    )
+    run_max_time = fields.Int(required=True)
+    run_delay = fields.Int(missing=0)
+    stop_grace = fields.Int(missing=DEFAULT_STOP_GRACE,
+                            validate=validate.Range(min=0))
+    cpu_units = fields.Int(validate=validate.Range(min=1))
+    memory_reservation = fields.Int(missing=DEFAULT_MEMORY_RESERVATION,
+                                    validate=validate.Range(min=4))
+    tasks_per_instance = fields.Int(
+        missing=1,
+        validate=validate.Range(min=1, max=MAX_CONTAINERS_PER_TASK - 1)
+    )
+    task_per_vcpu = fields.Bool(missing=False)
+    ready_threshold = fields.Float(validate=validate_ready_threshold)
+    container_name = fields.String(required=True)
+    cmd = fields.String(required=True)
+    port_mapping = fields.List(fields.Int())
+    env = fields.Dict()
+    docker_series = fields.String(missing="default")
+
+    @decorators.validates("name")
+    def validate_name(self, value):
+        if len(value) == 0:
+            raise ValidationError("Step name missing")
+        if len(value) > MAX_NAME_LEN:
+            raise ValidationError("Step name too long")
+        if INVALID_NAME_CHECK.search(value):
+            raise ValidationError("Step name contains invalid characters")
+
+    @decorators.validates_schema(skip_on_field_errors=True)
+    def validate_tasks_per_instance(self, data):
+        several = data.get("tasks_per_instance", 1) > 1 or \
+            data.get("task_per_vcpu")
+        if several and data.get("port_mapping"):
+            raise ValidationError(
+                "port_mapping can't be used with several tasks per instance",
+                "tasks_per_instance")
+
+    @decorators.post_load
+    def resolve_tasks_per_instance(self, data):
+        """Replace task_per_vcpu with the instance type's vcpu count"""
+        if data.pop("task_per_vcpu", False):
+            data["tasks_per_instance"] = \
+                ec2_vcpu_by_type[data["instance_type"]]
+        return data
+
+
+class DashboardOptions(Schema):
+    admin_user = fields.String(missing="admin")
+    admin_password = fields.String(required=True)
+    name = fields.String(required=True)
+    filename = fields.String(required=True)
+
+
+class MetricsOptions(Schema):
+    enabled = fields.Bool(missing=True)
+    instance_type = fields.String(
+        missing="c4.large",
+        validate=validate.OneOf(ec2_vcpu_by_type.keys())
+    )
+    dashboard = fields.Nested(DashboardOptions)
+    tear_down = fields.Bool(missing=False)
+    histograms = fields.Bool(missing=False)
+    histogram_precision = fields.Int(missing=DEFAULT_HISTOGRAM_PRECISION,
+                                     validate=validate.Range(min=1, max=5))
+    aggregation = fields.String(missing="host",
+                                validate=validate.OneOf(["host", "step"]))
+    host_sample_rate = fields.Float(missing=DEFAULT_HOST_SAMPLE_RATE,
+                                    validate=validate.Range(min=0, max=1))
+
+
+class PlanValidator(Schema):
+    ecs_name = fields.String(required=True)
+    name = fields.String(required=True)
+    plan_run_uuid = fields.String()
+    metrics_options = fields.Nested(MetricsOptions, missing={})
+    pack_steps = fields.Bool(missing=False)
+    capacity_fallback = fields.Bool(missing=False)
+    spot_instances = fields.Bool(missing=False)
+    ready_threshold = fields.Float(missing=DEFAULT_READY_THRESHOLD,
+                                   validate=validate_ready_threshold)
+    ready_grace = fields.Int(missing=DEFAULT_READY_GRACE,
+                             validate=validate.Range(min=0))
+    ready_timeout = fields.Int(
+        missing=DEFAULT_READY_TIMEOUT,
+        validate=validate.Range(min=0, max=MAX_READY_TIMEOUT)
+    )
+    ready_policy = fields.String(missing=DEFAULT_READY_POLICY,
+                                 validate=validate.OneOf(["abort", "start"]))
+    crash_loop_threshold = fields.Int(missing=DEFAULT_CRASH_LOOP_THRESHOLD,
+                                      validate=validate.Range(min=1))
+    abort_on_crash_loop = fields.Bool(missing=False)
+
+    steps = fields.Nested(StepValidator, many=True)
+
+    def _log_validate_name(self, value, name_type):
+        if len(value) == 0:
+            raise ValidationError("{} missing".format(name_type))
+        if len(value) > MAX_NAME_LEN:
+            raise ValidationError("{} too long".format(name_type))
+        if INVALID_NAME_CHECK.search(value):
+            raise ValidationError(
+                "{} contained invalid characters".format(name_type))
+
+    @decorators.validates_schema(skip_on_field_errors=True)
+    def validate_containers_per_task(self, data):
+        """Verify every step's copies fit in a task definition along with
+        its sidecars"""
+        sidecars = 1
+        if data.get("metrics_options", {}).get("histograms"):
+            sidecars += 1
+        for step in data.get("steps", []):
+            if step["tasks_per_instance"] + sidecars > \
+                    MAX_CONTAINERS_PER_TASK:
+                raise ValidationError(
+                    "Step {} can run at most {} tasks per instance".format(
+                        step["name"], MAX_CONTAINERS_PER_TASK - sidecars),
+                    "steps")
+
+    @decorators.validates("ecs_name")
+    def validate_ecs_name(self, value):
+        """Verify a cluster exists for this name"""
+        self._log_validate_name(value, "Plan ecs_name")
+        client = cached_client(self.context["boto"], 'ecs')
+        response = client.describe_clusters(
+            clusters=[value]
+        )
+        if not response.get("clusters"):
+            raise ValidationError("No cluster with the provided name.")
+
+    @decorators.validates("name")
+    def validate_name(self, value):
+        self._log_validate_name(value, "Step name")
@@ -5,48 +5,56 @@ import os
 dir_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(dir_path)
 
-from ardere.step_functions import AsynchronousPlanRunner
+from ardere.step_functions import (
+    AsynchronousPlanRunner,
+    InstancePoolReaper,
+)
 
 
 def populate_missing_instances(event, context):
     runner = AsynchronousPlanRunner(event, context)
-    return runner.populate_missing_instances()
+    return runner.save_state(runner.populate_missing_instances())
 
 
 def ensure_metrics_available(event, context):
     runner = AsynchronousPlanRunner(event, context)
-    return runner.ensure_metrics_available()
+    return runner.save_state(runner.ensure_metrics_available())
 
 
 def ensure_metric_sources_created(event, context):
     runner = AsynchronousPlanRunner(event, context)
-    return runner.ensure_metric_sources_created()
+    return runner.save_state(runner.ensure_metric_sources_created())
 
 
 def create_ecs_services(event, context):
     runner = AsynchronousPlanRunner(event, context)
-    return runner.create_ecs_services()
+    return runner.save_state(runner.create_ecs_services())
 
 
 def wait_for_cluster_ready(event, context):
     runner = AsynchronousPlanRunner(event, context)
-    return runner.wait_for_cluster_ready()
+    return runner.save_state(runner.wait_for_cluster_ready())
 
 
 def signal_cluster_start(event, context):
     runner = AsynchronousPlanRunner(event, context)
-    return runner.signal_cluster_start()
+    return runner.save_state(runner.signal_cluster_start())
 
 
 def check_for_cluster_done(event, context):
     runner = AsynchronousPlanRunner(event, context)
-    return runner.check_for_cluster_done()
+    return runner.save_state(runner.check_for_cluster_done())
 
 
 def cleanup_cluster(event, context):
     runner = AsynchronousPlanRunner(event, context)
-    return runner.cleanup_cluster()
+    return runner.save_state(runner.cleanup_cluster())
 
 
 def check_drain(event, context):
-    return AsynchronousPlanRunner(event, context).check_drained()
+    runner = AsynchronousPlanRunner(event, context)
+    return runner.save_state(runner.check_drained())
+
+
+def reap_idle_instances(event, context):
+    return InstancePoolReaper(event, context).reap_idle_instances()
@@ -0,0 +1,64 @@
+#!/bin/sh
+#
+# runs a step's command until the end of its run window
+#
+# the window ends run_max_time seconds after the step started, which is
+# the cluster start time in start_file plus the run_delay. the command is
+# then sent a TERM, and a KILL if it's still running stop_grace seconds
+# later.
+#
+# once the window has ended the container idles until its service is
+# scaled down, as exiting would have ECS start the task again.
+#
+
+if [ $# != 5 ]; then
+    echo "usage $0: start_file run_delay run_max_time stop_grace cmd"
+    exit 1
+fi
+START_TIME=`cat $1`
+END_TIME=$(( ${START_TIME} + $2 + $3 ))
+STOP_GRACE=$4
+CMD=$5
+
+# Signal the whole process group of the command when it has its own
+signal_cmd() {
+    kill -$1 -${CMD_PID} 2>/dev/null || kill -$1 ${CMD_PID} 2>/dev/null
+}
+
+if command -v setsid > /dev/null 2>&1; then
+    setsid sh -c "${CMD}" &
+else
+    sh -c "${CMD}" &
+fi
+CMD_PID=$!
+
+# Pass on a stop from ECS before the window ended
+trap 'signal_cmd TERM; exit 143' TERM INT
+
+(
+    REMAINING=$(( ${END_TIME} - `date +%s` ))
+    if [ ${REMAINING} -gt 0 ]; then
+        sleep ${REMAINING}
+    fi
+    signal_cmd TERM
+    sleep ${STOP_GRACE}
+    signal_cmd KILL
+) &
+WATCHDOG_PID=$!
+
+wait ${CMD_PID}
+STATUS=$?
+
+if [ `date +%s` -lt ${END_TIME} ]; then
+    # The command stopped by itself within the window
+    kill ${WATCHDOG_PID} 2>/dev/null
+    exit ${STATUS}
+fi
+
+echo "Run window ended @ `date '+%FT%T+00:00' -d @${END_TIME}`" \
+     "(idling until the service is scaled down)"
+trap 'exit 0' TERM INT
+while true; do
+    sleep 60 &
+    wait $!
+done
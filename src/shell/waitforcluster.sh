@@ -2,40 +2,132 @@
 #
 # waits for a cluster to be ready + a run_delay
 #
+# the run_url holds the values that differ between runs of a plan as
+# NAME='value' lines, among them the ready_url of the current run and the
+# interval to poll it at, which grows with the size of the plan to keep
+# the requests all containers make together flat. the values are parsed,
+# never sourced.
+#
 # cluster readiness is indicated by existence of ready_url, containing
-# a timestamp (seconds since epoch) of when it was made so. timestamp
-# is factored into the run_delay.
+# a timestamp (seconds since epoch, to the millisecond) of when the plan
+# starts, a bit ahead of when it was made so. the container sleeps until
+# that instant plus the run_delay, and writes the whole seconds of it to
+# start_file if given.
+#
+# once awake it reports how far off the intended instant it woke, and
+# how far its clock is off the one of the ready_url's server, both in
+# milliseconds, to its log and as statsd gauges when it can.
 #
 
-# Polling frequency in seconds
+# Polling frequency in seconds, unless the run file says otherwise
 POLL_TIME=4
 
-if [ $# != 2 ]; then
-    echo "usage $0: ready_url run_delay"
+if [ $# -lt 2 ]; then
+    echo "usage $0: run_url run_delay [start_file]"
     exit 1
 fi
-READY_URL=$1
+RUN_URL=$1
 RUN_DELAY=$2
+START_FILE=$3
+
+# value of the run file line named $1
+run_value() {
+    echo "${RUN_VALUES}" | sed -n "s/^$1='\([^']*\)'\$/\1/p"
+}
+
+# random number in [0, $1)
+random() {
+    R=`od -An -N2 -tu2 /dev/urandom 2>/dev/null | tr -d ' '`
+    echo $(( ${R:-$$} % $1 ))
+}
+
+# milliseconds since epoch, to the second where date lacks %N
+now_ms() {
+    T=`date +%s%N 2>/dev/null`
+    case "${T}" in
+        ""|*[!0-9]*) echo $(( `date +%s` * 1000 )) ;;
+        *) echo ${T%??????} ;;
+    esac
+}
+
+# milliseconds since epoch of a timestamp in seconds, with up to three
+# decimals
+to_ms() {
+    case "$1" in
+        *.*) S=${1%%.*}; F=`printf '%.3s' "${1#*.}000"` ;;
+        *) S=$1; F=000 ;;
+    esac
+    # a leading 1 keeps the decimals from being read as octal
+    echo $(( ${S} * 1000 + 1${F} - 1000 ))
+}
+
+# sleep for $1 milliseconds, to the second where sleep lacks fractions
+sleep_ms() {
+    sleep `printf '%d.%03d' $(( $1 / 1000 )) $(( $1 % 1000 ))` \
+        2>/dev/null || sleep $(( ($1 + 999) / 1000 ))
+}
 
-# XXX: a random jitter, backoff?
-JITTER=0
+# seconds since epoch of the Date header in wget's headers on stdin
+server_time() {
+    D=`sed -n 's/^ *Date: *//p' | head -n 1 | tr -d '\r'`
+    [ -n "${D}" ] || return 1
+    date -d "${D}" +%s 2>/dev/null || \
+        date -D '%a, %d %b %Y %H:%M:%S' -d "${D% GMT}" +%s 2>/dev/null
+}
 
+# sleep for $1 seconds on average, anywhere between half and one and a
+# half of it, so containers started together drift apart
+jittered_sleep() {
+    sleep $(( $1 / 2 + `random $1` ))
+}
+
+while true; do
+    RUN_VALUES=`wget -qO- ${RUN_URL}` && break
+    jittered_sleep ${POLL_TIME}
+done
+READY_URL=`run_value ARDERE_READY_URL`
+READY_POLL=`run_value ARDERE_READY_POLL`
+case "${READY_POLL}" in
+    ""|*[!0-9]*) ;;
+    *) POLL_TIME=${READY_POLL} ;;
+esac
+
+HEADERS=/tmp/ardere_ready_headers
 while true; do
-    START_TIME=`wget -qO- ${READY_URL}` && break
-    sleep $(( ${POLL_TIME} + ${JITTER} ))
+    START_TIME=`wget -S -qO- ${READY_URL} 2>${HEADERS}` && break
+    jittered_sleep ${POLL_TIME}
 done
+RECEIVED_MS=`now_ms`
 
-CURRENT_TIME=`date +%s`
-SINCE=$(( ${CURRENT_TIME} - ${START_TIME} ))
-if [ ${SINCE} -lt 0 ]; then
-    echo "Clock skew: ${SINCE}" >&2
-    SINCE=0
+if [ -n "${START_FILE}" ]; then
+    echo ${START_TIME%%.*} > ${START_FILE}
 fi
 
-RUN_DELAY=$(( ${RUN_DELAY} - ${SINCE} ))
-if [ ${RUN_DELAY} -gt 0 ]; then
-    FMT_START_TIME=`date '+%FT%T+00:00' -d @${START_TIME}`
+# the Date header only has whole seconds, the middle of it is the best
+# guess of the server's time
+SKEW_MS=unknown
+SERVER_TIME=`server_time < ${HEADERS}` && \
+    SKEW_MS=$(( ${RECEIVED_MS} - ${SERVER_TIME} * 1000 - 500 ))
+
+WAKE_MS=$(( `to_ms ${START_TIME}` + ${RUN_DELAY} * 1000 ))
+DELAY_MS=$(( ${WAKE_MS} - `now_ms` ))
+if [ ${DELAY_MS} -gt 0 ]; then
+    FMT_START_TIME=`date '+%FT%T+00:00' -d @${START_TIME%%.*}`
     echo "Cluster ready @ ${FMT_START_TIME}" \
-         "(sleeping for run_delay=${RUN_DELAY}s)"
-    sleep $RUN_DELAY
+         "(sleeping for ${DELAY_MS}ms, run_delay=${RUN_DELAY}s)"
+    sleep_ms ${DELAY_MS}
+fi
+
+OFFSET_MS=$(( `now_ms` - ${WAKE_MS} ))
+echo "Started ${OFFSET_MS}ms off the start instant" \
+     "(clock skew: ${SKEW_MS}ms)"
+if [ -n "${ARDERE_STATSD_PORT}" ] && command -v nc > /dev/null 2>&1; then
+    GAUGES="ardere.start_offset_ms:${OFFSET_MS}|g"
+    if [ "${SKEW_MS}" != unknown ]; then
+        GAUGES="${GAUGES}
+ardere.clock_skew_ms:${SKEW_MS}|g"
+    fi
+    echo "${GAUGES}" | nc -u -w 1 127.0.0.1 ${ARDERE_STATSD_PORT} \
+        > /dev/null 2>&1
 fi
+exit 0
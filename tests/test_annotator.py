@@ -0,0 +1,27 @@
+import json
+import os
+import unittest
+
+import mock
+from nose.tools import eq_
+
+
+class TestAnnotator(unittest.TestCase):
+    def _make_FUT(self, annotations):
+        from ardere.scripts.annotator import Annotator
+        # Setup the env vars we need
+        os.environ["__ARDERE_INFLUXDB_NAME__"] = "ardere"
+        os.environ["__ARDERE_ANNOTATIONS__"] = json.dumps(annotations)
+        return Annotator()
+
+    def test_write_annotations(self):
+        points = [dict(measurement="events", time=1000,
+                       tags=dict(phase="start"),
+                       fields=dict(title="start", text=""))]
+        annotator = self._make_FUT(points)
+        annotator.influx = mock.Mock()
+        annotator.write_annotations()
+        client = annotator.influx.InfluxDBClient.return_value
+        client.write_points.assert_called_with(
+            points, time_precision="ms", database="ardere")
+        eq_(annotator.annotations, points)
@@ -4,19 +4,20 @@ import time
 import unittest
 
 import mock
-from nose.tools import eq_, ok_
+from nose.tools import assert_raises, eq_, ok_
 
 from tests import fixtures
 
 
 class TestECSManager(unittest.TestCase):
     def _make_FUT(self, plan=None):
-        from ardere.aws import ECSManager
+        from ardere.aws import ApiExecutor, ECSManager
         os.environ["s3_ready_bucket"] = "test_bucket"
         os.environ["ecs_profile"] = "arn:something:fantastic:::"
         os.environ["container_log_group"] = "ardere"
         self.boto_mock = mock.Mock()
         ECSManager.boto = self.boto_mock
+        ECSManager.api = ApiExecutor()
         if not plan:
             plan = json.loads(fixtures.sample_basic_test_plan)
             plan["metrics_options"] = dict(
@@ -26,7 +27,13 @@ class TestECSManager(unittest.TestCase):
                 ),
                 tear_down=False
             )
-        return ECSManager(plan)
+        ecs = ECSManager(plan)
+
+        # No task definitions are registered yet
+        from botocore.exceptions import ClientError
+        ecs._ecs_client.describe_task_definition.side_effect = ClientError(
+            {"Error": {"Code": "ClientException"}}, "DescribeTaskDefinition")
+        return ecs
 
     def test_init(self):
         ecs = self._make_FUT()
@@ -61,6 +68,311 @@ class TestECSManager(unittest.TestCase):
         instance_dct = ecs.query_active_instances()
         eq_(len(instance_dct.values()), 1)
 
+    def test_query_active_substitutes(self):
+        ecs = self._make_FUT()
+        ecs._ec2_client.get_paginator.return_value = self._pool_paginator(
+            {"State": {"Code": 16}, "InstanceType": "c4.large",
+             "InstanceId": "i-2"},
+            {"State": {"Code": 0}, "InstanceType": "m4.large",
+             "InstanceId": "i-3",
+             "Tags": [{"Key": "StandsInFor", "Value": "c4.large"}]},
+            {"State": {"Code": 16}, "InstanceType": "m4.large",
+             "InstanceId": "i-1"},
+        )
+        eq_(ecs.query_active_instances(), {"c4.large": 2, "m4.large": 1})
+        eq_(ecs.query_active_instances(exclude=["i-1"]), {"c4.large": 2})
+        eq_(ecs.query_instance_substitutes(),
+            {"c4.large": {"m4.large": 1}})
+
+    def _pool_paginator(self, *instances):
+        mock_paginator = mock.Mock()
+        mock_paginator.paginate.return_value = [
+            {"Reservations": [{"Instances": list(instances)}]}
+        ]
+        return mock_paginator
+
+    def test_touch_instances(self):
+        ecs = self._make_FUT()
+        ecs._ec2_client.get_paginator.return_value = self._pool_paginator(
+            {"InstanceId": "i-1", "State": {"Code": 16},
+             "InstanceType": "t2.medium"},
+            {"InstanceId": "i-2", "State": {"Code": 48},
+             "InstanceType": "t2.medium"}
+        )
+        eq_(ecs.touch_instances(), ["i-1"])
+        _, kwargs = ecs._ec2_client.create_tags.call_args
+        eq_(kwargs["Resources"], ["i-1"])
+        eq_(kwargs["Tags"][0]["Key"], "LastUsed")
+
+    def test_touch_instances_empty(self):
+        ecs = self._make_FUT()
+        ecs._ec2_client.get_paginator.return_value = self._pool_paginator()
+        eq_(ecs.touch_instances(), [])
+        ecs._ec2_client.create_tags.assert_not_called()
+
+    def test_reap_idle_instances(self):
+        ecs = self._make_FUT()
+        old = str(int(time.time()) - 7200)
+        recent = str(int(time.time()) - 60)
+
+        def instance(instance_id, last_used):
+            tags = [{"Key": "Pool", "Value": "warm"}]
+            if last_used:
+                tags.append({"Key": "LastUsed", "Value": last_used})
+            return {"InstanceId": instance_id, "State": {"Code": 16},
+                    "InstanceType": "t2.medium", "Tags": tags}
+
+        ec2_paginator = self._pool_paginator(
+            instance("i-idle", old),
+            instance("i-busy", old),
+            instance("i-recent", recent),
+            instance("i-untagged", None),
+            instance("i-unregistered", old)
+        )
+        ecs_paginator = mock.Mock()
+        ecs_paginator.paginate.return_value = [
+            {"containerInstanceArns": ["arn:1", "arn:2", "arn:3"]},
+            {"containerInstanceArns": []}
+        ]
+        services_paginator = mock.Mock()
+        services_paginator.paginate.return_value = [
+            {"serviceArns": ["arn:aws:ecs:::service/metrics"]}]
+        paginators = dict(describe_instances=ec2_paginator,
+                          list_container_instances=ecs_paginator,
+                          list_services=services_paginator)
+        ecs._ec2_client.get_paginator.side_effect = paginators.get
+        ecs._ecs_client.describe_container_instances.return_value = {
+            "containerInstances": [
+                {"ec2InstanceId": "i-idle", "runningTasksCount": 0,
+                 "pendingTasksCount": 0},
+                {"ec2InstanceId": "i-busy", "runningTasksCount": 1,
+                 "pendingTasksCount": 0},
+                {"ec2InstanceId": "i-recent", "runningTasksCount": 0,
+                 "pendingTasksCount": 0}
+            ]
+        }
+
+        result = ecs.reap_idle_instances(3600)
+        eq_(result, ["i-idle", "i-unregistered"])
+        ecs._ec2_client.terminate_instances.assert_called_with(
+            InstanceIds=["i-idle", "i-unregistered"])
+
+        # A running plan keeps the pool, tasks or not
+        ecs._ec2_client.terminate_instances.reset_mock()
+        services_paginator.paginate.return_value = [
+            {"serviceArns": ["arn:aws:ecs:::service/metrics"]},
+            {"serviceArns": ["arn:aws:ecs:::service/TestCluster"]}]
+        eq_(ecs.reap_idle_instances(3600), [])
+        ecs._ec2_client.terminate_instances.assert_not_called()
+
+    def test_reap_idle_instances_none_idle(self):
+        ecs = self._make_FUT()
+        ecs_paginator = mock.Mock()
+        ecs_paginator.paginate.return_value = []
+        paginators = dict(describe_instances=self._pool_paginator(),
+                          list_container_instances=ecs_paginator,
+                          list_services=ecs_paginator)
+        ecs._ec2_client.get_paginator.side_effect = paginators.get
+
+        eq_(ecs.reap_idle_instances(3600), [])
+        ecs._ec2_client.terminate_instances.assert_not_called()
+
+    def test_clients_reused(self):
+        from ardere.aws import CLIENT_CONFIG, ECSManager
+        first = self._make_FUT()
+        second = ECSManager(first._plan)
+        ok_(first._ecs_client is second._ecs_client)
+        ok_(first._ec2_client is second._ec2_client)
+        eq_(self.boto_mock.client.call_count, 2)
+        self.boto_mock.client.assert_called_with('ec2', config=CLIENT_CONFIG)
+
+    def test_clients_count_calls(self):
+        from ardere.aws import api_calls
+        ecs = self._make_FUT()
+        events = ecs._ecs_client.meta.events
+        events.register.assert_called_with("before-call", api_calls.record)
+
+        before = api_calls.snapshot()
+        api_calls.record("before-call.ecs.ListTasks", params={})
+        api_calls.record("before-call.ecs.ListTasks", params={})
+        api_calls.record("before-call.ec2.DescribeInstances", params={})
+        eq_(api_calls.since(before), {"ecs.ListTasks": 2,
+                                      "ec2.DescribeInstances": 1})
+
+    def test_find_stragglers(self):
+        import datetime
+
+        ecs = self._make_FUT()
+        now = datetime.datetime.utcnow()
+        old = now - datetime.timedelta(seconds=600)
+
+        def instance(instance_id, launched, code=16, role=None):
+            tags = [{"Key": "Role", "Value": role}] if role else []
+            return {"InstanceId": instance_id, "State": {"Code": code},
+                    "InstanceType": "c4.large", "LaunchTime": launched,
+                    "Tags": tags}
+
+        ec2_paginator = self._pool_paginator(
+            instance("i-good", old),
+            instance("i-unregistered", old),
+            instance("i-booting", now),
+            instance("i-pending", old, code=0),
+            instance("i-disconnected", old),
+            instance("i-failing", old),
+            instance("i-metrics", old, role="metrics"),
+            instance("i-good2", old),
+            instance("i-good3", old)
+        )
+        containers = mock.Mock()
+        containers.paginate.return_value = [
+            {"containerInstanceArns": ["arn:1"]}
+        ]
+        tasks = mock.Mock()
+        tasks.paginate.return_value = [{"taskArns": ["t1", "t2", "t3"]}]
+        paginators = dict(describe_instances=ec2_paginator,
+                          list_container_instances=containers,
+                          list_tasks=tasks)
+        ecs._ec2_client.get_paginator.side_effect = paginators.get
+
+        def container(instance_id, connected=True):
+            return {"ec2InstanceId": instance_id,
+                    "containerInstanceArn": "arn:" + instance_id,
+                    "agentConnected": connected}
+
+        ecs._ecs_client.describe_container_instances.return_value = {
+            "containerInstances": [
+                container("i-good"), container("i-good2"),
+                container("i-good3"), container("i-failing"),
+                container("i-disconnected", connected=False)
+            ]
+        }
+        ecs._ecs_client.describe_tasks.return_value = {"tasks": [
+            {"containerInstanceArn": "arn:i-failing",
+             "stoppedReason": "Task failed to start",
+             "containers": [{"reason": "CannotStartContainerError: oops"}]}
+            for _ in range(3)
+        ] + [{"containerInstanceArn": "arn:i-good",
+              "stoppedReason": "Essential container in task exited"}]}
+
+        eq_(sorted(ecs.find_stragglers()),
+            ["i-disconnected", "i-failing", "i-unregistered"])
+
+    def test_find_stragglers_failing_everywhere(self):
+        import datetime
+
+        ecs = self._make_FUT()
+        old = datetime.datetime.utcnow() - datetime.timedelta(seconds=600)
+        ec2_paginator = self._pool_paginator(
+            {"InstanceId": "i-1", "State": {"Code": 16}, "LaunchTime": old,
+             "InstanceType": "c4.large"}
+        )
+        containers = mock.Mock()
+        containers.paginate.return_value = [
+            {"containerInstanceArns": ["arn:1"]}
+        ]
+        tasks = mock.Mock()
+        tasks.paginate.return_value = [{"taskArns": ["t1", "t2", "t3"]}]
+        paginators = dict(describe_instances=ec2_paginator,
+                          list_container_instances=containers,
+                          list_tasks=tasks)
+        ecs._ec2_client.get_paginator.side_effect = paginators.get
+        ecs._ecs_client.describe_container_instances.return_value = {
+            "containerInstances": [{"ec2InstanceId": "i-1",
+                                    "containerInstanceArn": "arn:1",
+                                    "agentConnected": True}]
+        }
+        ecs._ecs_client.describe_tasks.return_value = {"tasks": [
+            {"containerInstanceArn": "arn:1",
+             "stoppedReason": "CannotPullContainerError: no such image"}
+            for _ in range(3)
+        ]}
+
+        # A step's image that can't be pulled isn't the instance's fault
+        eq_(ecs.find_stragglers(), [])
+
+    def test_task_failures(self):
+        import calendar
+        import datetime
+
+        ecs = self._make_FUT()
+        step = ecs._plan["steps"][0]
+        earlier = datetime.datetime(2017, 5, 1, 12, 0)
+        later = datetime.datetime(2017, 5, 1, 12, 5)
+        ecs._plan["services_created_at"] = calendar.timegm(
+            datetime.datetime(2017, 5, 1, 11, 30).utctimetuple())
+        tasks = mock.Mock()
+        tasks.paginate.return_value = [{"taskArns": ["t1", "t2"]},
+                                       {"taskArns": ["t3", "t4"]}]
+        ecs._ecs_client.get_paginator.side_effect = \
+            dict(list_tasks=tasks).get
+        group = "service:{}".format(step["name"])
+        ecs._ecs_client.describe_tasks.side_effect = [
+            {"tasks": [
+                {"group": group, "stoppedAt": later,
+                 "stoppedReason": "Essential container in task exited",
+                 "containers": [{"exitCode": 2, "reason": ""}]},
+                {"group": group, "stoppedAt": earlier,
+                 "stoppedReason": "Task failed to start",
+                 "containers": [{"reason": "CannotStartContainerError"}]}
+            ]},
+            {"tasks": [
+                {"group": group,
+                 "stoppedReason": "Scaling activity initiated by "
+                                  "(deployment ecs-svc/123)"},
+                {"group": "service:other", "stoppedAt": later,
+                 "stoppedReason": "Essential container in task exited"},
+                {"group": group, "stoppedAt": later,
+                 "stoppedReason": "Host EC2 (instance i-1) terminated."},
+                # The step finished early, telegraf was stopped after it
+                {"group": group, "stoppedAt": later,
+                 "stoppedReason": "Essential container in task exited",
+                 "containers": [{"name": "TestCluster", "exitCode": 0},
+                                {"name": "telegraf", "exitCode": 143}]},
+                # Of an earlier run
+                {"group": group, "stoppedAt": earlier,
+                 "createdAt": datetime.datetime(2017, 5, 1, 11, 0),
+                 "stoppedReason": "Essential container in task exited"}
+            ]}
+        ]
+
+        with mock.patch("ardere.aws.DESCRIBE_TASKS_BATCH_SIZE", 2):
+            failures = ecs.task_failures(ecs._plan["steps"])
+        eq_(failures, {step["name"]: dict(
+            failures=2,
+            reason="Essential container in task exited",
+            exit_code=2
+        )})
+
+        # The stopped tasks are described once per state
+        ecs._container_instances = mock.Mock(return_value={})
+        ecs.query_instances = mock.Mock(return_value=[])
+        ecs.find_stragglers()
+        eq_(ecs._ecs_client.describe_tasks.call_count, 2)
+        tasks.paginate.assert_called_once()
+
+    def test_terminate_instances(self):
+        ecs = self._make_FUT()
+        ecs.terminate_instances(["i-1"])
+        ecs._ec2_client.terminate_instances.assert_called_with(
+            InstanceIds=["i-1"])
+
+    def test_pooled_clusters(self):
+        from ardere.aws import ECSManager
+        self._make_FUT()
+        ECSManager.boto = mock.Mock()
+        ec2_client = mock.Mock()
+        ECSManager.boto.client.return_value = ec2_client
+        ec2_client.get_paginator.return_value = self._pool_paginator(
+            {"State": {"Code": 16},
+             "Tags": [{"Key": "ECSCluster", "Value": "b"}]},
+            {"State": {"Code": 0},
+             "Tags": [{"Key": "ECSCluster", "Value": "a"}]},
+            {"State": {"Code": 16},
+             "Tags": [{"Key": "ECSCluster", "Value": "b"}]},
+            {"State": {"Code": 16}, "Tags": []}
+        )
+        eq_(ECSManager.pooled_clusters(), ["a", "b"])
+
     def test_calculate_missing_instances(self):
         ecs = self._make_FUT()
         result = ecs.calculate_missing_instances(
@@ -111,6 +423,92 @@ class TestECSManager(unittest.TestCase):
         ecs.request_instances(instances, ["i-382842"], {"Role": "metrics"})
         ecs._ec2_client.run_instances.assert_called()
 
+    def test_request_instances_fallback(self):
+        from botocore.exceptions import ClientError
+
+        ecs = self._make_FUT()
+        capacity_error = ClientError(
+            {"Error": {"Code": "InsufficientInstanceCapacity"}},
+            "RunInstances"
+        )
+        ecs._ec2_client.run_instances.side_effect = [
+            {"Instances": [{"InstanceId": 1}] * 4},
+            capacity_error,
+            {"Instances": [{"InstanceId": 2}] * 6},
+        ]
+        result = ecs.request_instances({"c4.large": 10}, ["sg"],
+                                       fallback=True)
+        eq_(result, {"c4.large": {"c4.large": 4, "m4.large": 6}})
+        calls = ecs._ec2_client.run_instances.call_args_list
+        eq_([call[1]["InstanceType"] for call in calls],
+            ["c4.large", "m3.large", "m4.large"])
+        eq_([(call[1]["MinCount"], call[1]["MaxCount"]) for call in calls],
+            [(1, 10), (1, 6), (1, 6)])
+        tags = [{tag["Key"]: tag["Value"] for tag in
+                 call[1]["TagSpecifications"][0]["Tags"]} for call in calls]
+        ok_("StandsInFor" not in tags[0])
+        eq_(tags[2]["StandsInFor"], "c4.large")
+
+    def test_request_instances_spot(self):
+        from botocore.exceptions import ClientError
+
+        ecs = self._make_FUT()
+        ecs._ec2_client.run_instances.side_effect = [
+            {"Instances": [{"InstanceId": 1}] * 3},
+            ClientError({"Error": {"Code": "SpotMaxPriceTooLow"}},
+                        "RunInstances"),
+            {"Instances": [{"InstanceId": 2}] * 2},
+        ]
+        result = ecs.request_instances({"t2.medium": 5}, ["sg"], spot=True,
+                                       fallback=True)
+        eq_(result, {"t2.medium": {"t2.medium": 5}})
+        calls = ecs._ec2_client.run_instances.call_args_list
+        eq_([(call[1]["InstanceType"], "InstanceMarketOptions" in call[1])
+             for call in calls],
+            [("t2.medium", True), ("t2.large", True),
+             ("t2.medium", False)])
+        tags = {tag["Key"]: tag["Value"] for tag in
+                calls[2][1]["TagSpecifications"][0]["Tags"]}
+        eq_(tags["Market"], "on-demand")
+
+    def test_request_instances_fallback_exhausted(self):
+        from botocore.exceptions import ClientError
+        from ardere.exceptions import InsufficientCapacityException
+
+        ecs = self._make_FUT()
+        ecs._ec2_client.run_instances.side_effect = ClientError(
+            {"Error": {"Code": "InsufficientInstanceCapacity"}},
+            "RunInstances"
+        )
+        assert_raises(InsufficientCapacityException, ecs.request_instances,
+                      {"c4.8xlarge": 2}, ["sg"], fallback=True)
+
+    def test_request_instances_no_fallback(self):
+        from botocore.exceptions import ClientError
+
+        ecs = self._make_FUT()
+        ecs._ec2_client.run_instances.side_effect = ClientError(
+            {"Error": {"Code": "InsufficientInstanceCapacity"}},
+            "RunInstances"
+        )
+        assert_raises(ClientError, ecs.request_instances,
+                      {"c4.large": 2}, ["sg"])
+        eq_(ecs._ec2_client.run_instances.call_count, 1)
+
+    def test_equivalent_instance_types(self):
+        from ardere.aws import equivalent_instance_types
+        eq_(equivalent_instance_types("t2.medium"), ["t2.large"])
+        ok_("t2.large" not in equivalent_instance_types("c4.large"))
+        ok_("c3.large" in equivalent_instance_types("c4.large"))
+
+    def test_instance_type_expression(self):
+        ecs = self._make_FUT()
+        eq_(ecs.instance_type_expression("c4.large"),
+            "attribute:ecs.instance-type == c4.large")
+        ecs._plan["instance_substitutes"] = {"c4.large": ["c3.large"]}
+        eq_(ecs.instance_type_expression("c4.large"),
+            "attribute:ecs.instance-type in [c4.large, c3.large]")
+
     def test_locate_metrics_container_ip(self):
         ecs = self._make_FUT()
         ecs._ecs_client.list_container_instances.return_value = {
@@ -168,6 +566,57 @@ class TestECSManager(unittest.TestCase):
         result = ecs.create_metrics_service(dict(instance_type="c4.large"))
         eq_(result["service_arn"], "arn:of:some:service::")
 
+        # Histograms are merged by a task of the run keeping them, the
+        # setup tasks still fit alongside the service
+        _, kwargs = ecs._ecs_client.register_task_definition.call_args
+        containers = kwargs["containerDefinitions"]
+        eq_([container["name"] for container in containers],
+            ["influxdb", "grafana"])
+        eq_(sum(container["cpu"] for container in containers), 1792)
+
+    def test_create_metrics_service_aggregator(self):
+        from ardere.aws import METRICS_SETUP_CPU_UNITS
+        ecs = self._make_FUT()
+        ecs._ecs_client.register_task_definition.return_value = {
+            "taskDefinition": {"taskDefinitionArn": "arn:of:some:task::"}
+        }
+        ecs._ecs_client.create_service.return_value = {
+            "service": {"serviceArn": "arn:of:some:service::"}
+        }
+
+        ecs.create_metrics_service(dict(instance_type="c4.large",
+                                        aggregation="step"))
+        _, kwargs = ecs._ecs_client.register_task_definition.call_args
+        containers = kwargs["containerDefinitions"]
+        eq_([container["name"] for container in containers],
+            ["influxdb", "grafana", "metrics-aggregator"])
+        ok_(2048 - sum(container["cpu"] for container in containers) >=
+            2 * METRICS_SETUP_CPU_UNITS)
+
+    def test_metrics_service_aggregates(self):
+        ecs = self._make_FUT()
+        ecs._ecs_client.describe_task_definition.side_effect = None
+        ecs._ecs_client.describe_task_definition.return_value = {
+            "taskDefinition": {"containerDefinitions": [
+                {"name": "influxdb"}, {"name": "grafana"}]}}
+        eq_(ecs.metrics_service_aggregates(
+            {"taskDefinition": "arn:metrics:1"}), False)
+        ecs._ecs_client.describe_task_definition.assert_called_with(
+            taskDefinition="arn:metrics:1")
+
+    def test_run_histogram_merger_task(self):
+        from ardere.aws import HISTOGRAM_MERGER_STARTED_BY
+        ecs = self._make_FUT()
+        ecs.run_histogram_merger_task("arn:::", 2000.5)
+        _, kwargs = ecs._ecs_client.start_task.call_args
+        eq_(kwargs["containerInstances"], ["arn:::"])
+        eq_(kwargs["startedBy"], HISTOGRAM_MERGER_STARTED_BY)
+        env = {var["name"]: var["value"] for var in
+               kwargs["overrides"]["containerOverrides"][0]["environment"]}
+        eq_(env["__ARDERE_PYTHON_SCRIPT__"], ecs.histogram_merger_script)
+        eq_(env["__ARDERE_INFLUXDB_NAME__"], ecs.influx_db_name)
+        eq_(env["__ARDERE_MERGE_UNTIL__"], "2000.500")
+
     def test_run_metric_creation_task(self):
         ecs = self._make_FUT()
         ecs.run_metric_creation_task("arn:::", ("admin", "admin"),
@@ -204,19 +653,348 @@ class TestECSManager(unittest.TestCase):
         container_def = kwargs["containerDefinitions"][0]
         ok_("portMappings" in container_def)
 
+        # The step's command is run for its run window by runstep.sh
+        entry_point = container_def["entryPoint"][-1]
+        ok_("runstep.sh /tmp/ardere_start_time 0 {} 10".format(
+            step["run_max_time"]) in entry_point)
+        ok_({"name": "__ARDERE_STEP_CMD__", "value": step["cmd"]} in
+            container_def["environment"])
+        ok_({"name": "__ARDERE_RUNSTEP_SH__", "value": ecs.runstep_script} in
+            container_def["environment"])
+
+    def test_create_service_histograms(self):
+        ecs = self._make_FUT()
+        ecs._plan["metrics_options"] = dict(histograms=True,
+                                            histogram_precision=3)
+
+        step = ecs._plan["steps"][0]
+        step["docker_series"] = "default"
+        step["statsd_port"] = 8126
+        ecs._ecs_client.register_task_definition.return_value = {
+            "taskDefinition": {
+                "taskDefinitionArn": "arn:of:some:task::"
+            }
+        }
+        ecs._ecs_client.create_service.return_value = {
+            "service": {"serviceArn": "arn:of:some:service::"}
+        }
+
+        ecs.create_service(step)
+        _, kwargs = ecs._ecs_client.register_task_definition.call_args
+        containers = {container["name"]: container
+                      for container in kwargs["containerDefinitions"]}
+
+        def env(container):
+            return {var["name"]: var["value"]
+                    for var in container["environment"]}
+
+        relay = containers["statsd-relay"]
+        eq_(relay["portMappings"], [{"containerPort": 8126}])
+        eq_(env(relay)["__ARDERE_TELEGRAF_PORT__"], "9126")
+        eq_(env(relay)["__ARDERE_HISTOGRAM_PRECISION__"], "3")
+        eq_(env(relay)["__ARDERE_PYTHON_SCRIPT__"], ecs.statsd_relay_script)
+        telegraf = containers["telegraf"]
+        eq_(telegraf["portMappings"], [{"containerPort": 9126}])
+        eq_(env(telegraf)["__ARDERE_STATSD_PORT__"], "9126")
+        # The step itself still sends to its own statsd port
+        eq_(env(containers[step["name"]])["ARDERE_STATSD_PORT"], "8126")
+
+    def test_create_service_deferred(self):
+        ecs = self._make_FUT()
+
+        step = ecs._plan["steps"][0]
+        ecs._plan["influxdb_private_ip"] = "1.1.1.1"
+        step["docker_series"] = "default"
+        step["defer_start"] = True
+
+        ecs._ecs_client.register_task_definition.return_value = {
+            "taskDefinition": {
+                "taskDefinitionArn": "arn:of:some:task::"
+            }
+        }
+        ecs._ecs_client.create_service.return_value = {
+            "service": {"serviceArn": "arn:of:some:service::"}
+        }
+
+        ecs.create_service(step)
+        _, kwargs = ecs._ecs_client.create_service.call_args
+        eq_(kwargs["desiredCount"], 0)
+        eq_(step["service_status"], "DEFERRED")
+
+    def test_create_service_packed(self):
+        ecs = self._make_FUT()
+        ecs._plan["pack_steps"] = True
+
+        step = ecs._plan["steps"][0]
+        ecs._plan["influxdb_private_ip"] = "1.1.1.1"
+        step["docker_series"] = "default"
+        step["statsd_port"] = 8127
+        step["cpu_units"] = 512
+        step["memory_reservation"] = 1024
+
+        ecs._ecs_client.register_task_definition.return_value = {
+            "taskDefinition": {
+                "taskDefinitionArn": "arn:of:some:task::"
+            }
+        }
+        ecs._ecs_client.create_service.return_value = {
+            "service": {"serviceArn": "arn:of:some:service::"}
+        }
+
+        ecs.create_service(step)
+        _, kwargs = ecs._ecs_client.register_task_definition.call_args
+        container_def, telegraf_def = kwargs["containerDefinitions"]
+        eq_(container_def["cpu"], 512)
+        eq_(container_def["memoryReservation"], 1024)
+        ok_({"name": "ARDERE_STATSD_PORT", "value": "8127"} in
+            container_def["environment"])
+        eq_(telegraf_def["portMappings"], [{"containerPort": 8127}])
+
+        _, kwargs = ecs._ecs_client.create_service.call_args
+        eq_(kwargs["placementStrategy"][0]["type"], "binpack")
+
+    def test_create_service_tasks_per_instance(self):
+        ecs = self._make_FUT()
+
+        step = ecs._plan["steps"][0]
+        ecs._plan["influxdb_private_ip"] = "1.1.1.1"
+        step["docker_series"] = "default"
+        step["instance_type"] = "c4.2xlarge"
+        step["tasks_per_instance"] = 4
+        del step["port_mapping"]
+
+        ecs._ecs_client.register_task_definition.return_value = {
+            "taskDefinition": {
+                "taskDefinitionArn": "arn:of:some:task::"
+            }
+        }
+        ecs._ecs_client.create_service.return_value = {
+            "service": {"serviceArn": "arn:of:some:service::"}
+        }
+
+        ecs.create_service(step)
+        _, kwargs = ecs._ecs_client.register_task_definition.call_args
+        container_defs = kwargs["containerDefinitions"]
+        eq_(len(container_defs), 5)
+        eq_(container_defs[-1]["name"], "telegraf")
+        for slot, container_def in enumerate(container_defs[:4]):
+            eq_(container_def["name"], "TestCluster-{}".format(slot))
+            eq_(container_def["cpu"], 1920)
+            ok_({"name": "ARDERE_TASK_SLOT", "value": str(slot)} in
+                container_def["environment"])
+
+    def test_family_name(self):
+        ecs = self._make_FUT()
+        step = ecs._plan["steps"][0]
+        task_definition = dict(containerDefinitions=[{"image": "bbangert"}])
+
+        family = ecs.family_name(step, task_definition)
+        ok_(family.startswith(step["name"] + "-"))
+        eq_(family, ecs.family_name(step, dict(task_definition)))
+        ok_(family != ecs.family_name(
+            step, dict(containerDefinitions=[{"image": "other"}])))
+
+    def test_create_service_reuses_task_definition(self):
+        ecs = self._make_FUT()
+
+        step = ecs._plan["steps"][0]
+        ecs._plan["influxdb_private_ip"] = "1.1.1.1"
+        step["docker_series"] = "default"
+
+        ecs._ecs_client.describe_task_definition.side_effect = None
+        ecs._ecs_client.describe_task_definition.return_value = {
+            "taskDefinition": {
+                "taskDefinitionArn": "arn:of:existing:task::",
+                "status": "ACTIVE"
+            }
+        }
+        ecs._ecs_client.create_service.return_value = {
+            "service": {"serviceArn": "arn:of:some:service::"}
+        }
+
+        ecs.create_service(step)
+        ecs._ecs_client.register_task_definition.assert_not_called()
+        ecs._ecs_client.describe_task_definition.assert_called_with(
+            taskDefinition=step["task_family"])
+        eq_(step["taskArn"], "arn:of:existing:task::")
+
+        # Nothing differing per run ends up in the task definition
+        other = self._make_FUT()
+        other._plan["influxdb_private_ip"] = "2.2.2.2"
+        other_step = other._plan["steps"][0]
+        other_step["docker_series"] = "default"
+        other._ecs_client.register_task_definition.return_value = {
+            "taskDefinition": {"taskDefinitionArn": "arn:of:some:task::"}
+        }
+        other._ecs_client.create_service.return_value = {
+            "service": {"serviceArn": "arn:of:some:service::"}
+        }
+        other.create_service(other_step)
+        ok_(other._plan_uuid != ecs._plan_uuid)
+        eq_(other_step["task_family"], step["task_family"])
+
+    def test_publish_run_file(self):
+        ecs = self._make_FUT()
+        ecs._plan["influxdb_private_ip"] = "1.1.1.1"
+        s3_client = self.boto_mock.client.return_value
+
+        ecs.publish_run_file()
+        _, kwargs = s3_client.put_object.call_args
+        eq_(kwargs["Key"], "{}.run".format(ecs._plan["ecs_name"]))
+        body = kwargs["Body"].decode("utf-8")
+        ok_("ARDERE_READY_URL='{}'".format(ecs.s3_ready_file) in body)
+        ok_("ARDERE_INFLUX_ADDR='1.1.1.1:8086'" in body)
+        ok_("ARDERE_READY_POLL='4'" in body)
+        ok_("ARDERE_HOST_SAMPLE_RATE" not in body)
+
+    def test_publish_run_file_aggregated(self):
+        ecs = self._make_FUT()
+        ecs._plan["influxdb_private_ip"] = "1.1.1.1"
+        ecs._plan["metrics_options"] = dict(aggregation="step",
+                                            host_sample_rate=0.05)
+        s3_client = self.boto_mock.client.return_value
+
+        ecs.publish_run_file()
+        _, kwargs = s3_client.put_object.call_args
+        body = kwargs["Body"].decode("utf-8")
+        ok_("ARDERE_INFLUX_ADDR='1.1.1.1:8186'" in body)
+        ok_("ARDERE_HOST_SAMPLE_RATE='0.05'" in body)
+
+        # Without the aggregator on the metrics instance hosts write as is
+        ecs._plan["metrics_aggregator"] = False
+        ecs.publish_run_file()
+        _, kwargs = s3_client.put_object.call_args
+        ok_("ARDERE_INFLUX_ADDR='1.1.1.1:8086'" in
+            kwargs["Body"].decode("utf-8"))
+
+    def test_ready_poll_interval(self):
+        from ardere.aws import ready_poll_interval
+
+        eq_(ready_poll_interval([dict(instance_count=1)]), 4)
+        eq_(ready_poll_interval([dict(instance_count=600),
+                                 dict(instance_count=400)]), 40)
+        eq_(ready_poll_interval([dict(instance_count=10000)]), 60)
+        eq_(ready_poll_interval([dict(instance_count=250,
+                                      tasks_per_instance=4)]), 40)
+
+    def test_run_annotation_task(self):
+        from ardere.aws import ANNOTATION_TASK_STARTED_BY
+        ecs = self._make_FUT()
+        points = [dict(measurement="ardere_events", time=1000,
+                       tags=dict(event="start"), fields=dict(title="start"))]
+
+        ecs._ecs_client.start_task.return_value = {
+            "tasks": [{"taskArn": "arn:task/1"}]}
+        eq_(ecs.run_annotation_task("arn:::", points), ["arn:task/1"])
+        _, kwargs = ecs._ecs_client.start_task.call_args
+        eq_(kwargs["containerInstances"], ["arn:::"])
+        eq_(kwargs["startedBy"], ANNOTATION_TASK_STARTED_BY)
+        env = {var["name"]: var["value"] for var in
+               kwargs["overrides"]["containerOverrides"][0]["environment"]}
+        eq_(json.loads(env["__ARDERE_ANNOTATIONS__"]), points)
+        eq_(env["__ARDERE_PYTHON_SCRIPT__"], ecs.annotate_script)
+
+    def test_run_annotation_task_chunked(self):
+        from ardere.aws import MAX_CONTAINER_OVERRIDES_SIZE
+        ecs = self._make_FUT()
+        points = [dict(measurement="ardere_events", time=index,
+                       tags=dict(event="stop"),
+                       fields=dict(title="stop Step{}".format(index),
+                                   text="Step stopped"))
+                  for index in range(200)]
+        ecs._ecs_client.start_task.return_value = {"tasks": []}
+
+        ecs.run_annotation_task("arn:::", points)
+        calls = ecs._ecs_client.start_task.call_args_list
+        ok_(len(calls) > 1)
+        written = []
+        for _, kwargs in calls:
+            ok_(len(json.dumps(kwargs["overrides"])) <=
+                MAX_CONTAINER_OVERRIDES_SIZE)
+            env = {var["name"]: var["value"] for var in
+                   kwargs["overrides"]["containerOverrides"][0][
+                       "environment"]}
+            written.extend(json.loads(env["__ARDERE_ANNOTATIONS__"]))
+        eq_(written, points)
+
+    def test_tasks_stopped(self):
+        ecs = self._make_FUT()
+        ecs._ecs_client.describe_tasks.return_value = {"tasks": [
+            {"lastStatus": "STOPPED"}, {"lastStatus": "RUNNING"}]}
+        eq_(ecs.tasks_stopped(["arn:task/1", "arn:task/2"]), False)
+        ecs._ecs_client.describe_tasks.return_value = {"tasks": [
+            {"lastStatus": "STOPPED"}]}
+        eq_(ecs.tasks_stopped(["arn:task/1", "arn:task/2"]), True)
+
+    def test_remove_metrics_service(self):
+        ecs = self._make_FUT()
+        ecs.locate_metrics_service = mock.Mock(return_value=None)
+        eq_(ecs.remove_metrics_service(), None)
+        ecs._ecs_client.delete_service.assert_not_called()
+
+        ecs.locate_metrics_service.return_value = {"serviceArn": "arn:m"}
+        eq_(ecs.remove_metrics_service(), "arn:m")
+        ecs._ecs_client.delete_service.assert_called_with(
+            cluster=ecs._ecs_name, service="arn:m")
+
     def test_create_services(self):
         ecs = self._make_FUT()
         ecs.create_service = mock.Mock()
+        ecs._ecs_client.describe_services.return_value = {"services": []}
         ecs.create_services(ecs._plan["steps"])
         ecs.create_service.assert_called()
 
+    def test_create_services_resumed(self):
+        ecs = self._make_FUT()
+        ecs._plan["influxdb_private_ip"] = "1.1.1.1"
+        second = dict(ecs._plan["steps"][0], name="SecondStep")
+        ecs._plan["steps"].append(second)
+        for step in ecs._plan["steps"]:
+            step["docker_series"] = "default"
+        ecs._ecs_client.register_task_definition.return_value = {
+            "taskDefinition": {"taskDefinitionArn": "arn:of:some:task::"}
+        }
+        ecs._ecs_client.create_service.return_value = {
+            "service": {"serviceArn": "arn:of:some:service::"}
+        }
+
+        # The first step's service was created by a previous attempt
+        created = ecs._plan["steps"][0]
+        ecs._ecs_client.describe_services.return_value = {"services": [
+            {"serviceName": created["name"],
+             "serviceArn": "arn:of:created:service::",
+             "taskDefinition": "arn:of:some:task::",
+             "status": "ACTIVE",
+             "deployments": []}
+        ]}
+
+        ecs.create_services(ecs._plan["steps"])
+        eq_(created["serviceArn"], "arn:of:created:service::")
+        eq_(created["service_status"], "STARTED")
+        eq_(second["serviceArn"], "arn:of:some:service::")
+        ecs._ecs_client.create_service.assert_called_once()
+
+    def test_create_services_failure(self):
+        from ardere.exceptions import CreateServicesException
+
+        ecs = self._make_FUT()
+        ecs.create_service = mock.Mock()
+        ecs.create_service.side_effect = Exception("boom")
+        ecs._ecs_client.describe_services.return_value = {"services": []}
+        with assert_raises(CreateServicesException) as cm:
+            ecs.create_services(ecs._plan["steps"])
+        ok_(ecs._plan["steps"][0]["name"] in str(cm.exception))
+
     def test_service_ready_true(self):
         ecs = self._make_FUT()
         step = ecs._plan["steps"][0]
 
         ecs._ecs_client.describe_services.return_value = {
             "services": [{
+                "serviceName": step["name"],
+                "status": "ACTIVE",
                 "deployments": [{
+                    "status": "PRIMARY",
                     "desiredCount": 2,
                     "runningCount": 2
                 }]
@@ -239,10 +1017,74 @@ class TestECSManager(unittest.TestCase):
 
     def test_all_services_ready(self):
         ecs = self._make_FUT()
-        ecs.service_ready = mock.Mock()
+        ecs.describe_service_statuses = mock.Mock()
+        ecs.describe_service_statuses.return_value = {
+            "TestCluster": dict(status="ACTIVE", desiredCount=1,
+                                runningCount=1, pendingCount=0,
+                                deployment_status="PRIMARY", deployments=1)
+        }
 
-        ecs.all_services_ready(ecs._plan["steps"])
-        ecs.service_ready.assert_called()
+        eq_(ecs.all_services_ready(ecs._plan["steps"]), True)
+        ecs.describe_service_statuses.assert_called_with(ecs._plan["steps"])
+
+    def test_all_services_ready_pending(self):
+        ecs = self._make_FUT()
+        ecs.describe_service_statuses = mock.Mock()
+        ecs.describe_service_statuses.return_value = {
+            "TestCluster": dict(status="ACTIVE", desiredCount=2,
+                                runningCount=1, pendingCount=1,
+                                deployment_status="PRIMARY", deployments=1)
+        }
+
+        eq_(ecs.all_services_ready(ecs._plan["steps"]), False)
+
+    def test_all_services_ready_threshold(self):
+        ecs = self._make_FUT()
+        step = ecs._plan["steps"][0]
+        ecs.describe_service_statuses = mock.Mock()
+        ecs.describe_service_statuses.return_value = {
+            step["name"]: dict(status="ACTIVE", desiredCount=10,
+                               runningCount=9, pendingCount=1,
+                               deployment_status="PRIMARY", deployments=1)
+        }
+
+        eq_(ecs.all_services_ready(ecs._plan["steps"]), False)
+        eq_(ecs.all_services_ready(ecs._plan["steps"],
+                                   {step["name"]: 0.9}), True)
+        eq_(ecs.all_services_ready(ecs._plan["steps"],
+                                   {step["name"]: 0.95}), False)
+        eq_(step["tasks_desired"], 10)
+        eq_(step["tasks_running"], 9)
+
+    def test_describe_service_statuses_batches(self):
+        ecs = self._make_FUT()
+        steps = [dict(name="step{}".format(i)) for i in range(25)]
+
+        def describe(cluster, services):
+            return {
+                "services": [
+                    {"serviceName": name, "status": "ACTIVE",
+                     "deployments": [
+                         {"status": "ACTIVE", "desiredCount": 1,
+                          "runningCount": 0, "pendingCount": 1},
+                         {"status": "PRIMARY", "desiredCount": 2,
+                          "runningCount": 1, "pendingCount": 1}
+                     ]}
+                    for name in services if name != "step24"
+                ],
+                "failures": [{"arn": "step24", "reason": "MISSING"}]
+            }
+        ecs._ecs_client.describe_services.side_effect = describe
+
+        statuses = ecs.describe_service_statuses(steps)
+        eq_(ecs._ecs_client.describe_services.call_count, 3)
+        eq_(len(statuses), 25)
+        eq_(statuses["step0"]["desiredCount"], 2)
+        eq_(statuses["step0"]["runningCount"], 1)
+        eq_(statuses["step0"]["pendingCount"], 1)
+        eq_(statuses["step0"]["deployment_status"], "PRIMARY")
+        eq_(statuses["step0"]["deployments"], 2)
+        eq_(statuses["step24"]["status"], "MISSING")
 
     def test_service_done_true(self):
         ecs = self._make_FUT()
@@ -250,6 +1092,7 @@ class TestECSManager(unittest.TestCase):
 
         ecs._ecs_client.describe_services.return_value = {
             "services": [{
+                "serviceName": step["name"],
                 "status": "INACTIVE"
             }]
         }
@@ -263,6 +1106,7 @@ class TestECSManager(unittest.TestCase):
 
         ecs._ecs_client.describe_services.return_value = {
             "services": [{
+                "serviceName": step["name"],
                 "status": "DRAINING"
             }]
         }
@@ -270,11 +1114,28 @@ class TestECSManager(unittest.TestCase):
         result = ecs.service_done(step)
         eq_(result, False)
 
+    def test_service_done_deleted(self):
+        ecs = self._make_FUT()
+        step = ecs._plan["steps"][0]
+
+        ecs._ecs_client.describe_services.return_value = {
+            "services": [],
+            "failures": [{"arn": step["name"], "reason": "MISSING"}]
+        }
+
+        result = ecs.service_done(step)
+        eq_(result, True)
+
     def test_all_services_done(self):
         ecs = self._make_FUT()
-        ecs.service_done = mock.Mock()
-        ecs.all_services_done(ecs._plan["steps"])
-        ecs.service_done.assert_called()
+        ecs._ecs_client.describe_services.return_value = {
+            "services": [{
+                "serviceName": "TestCluster",
+                "status": "INACTIVE"
+            }]
+        }
+        eq_(ecs.all_services_done(ecs._plan["steps"]), True)
+        ecs._ecs_client.describe_services.assert_called_once()
 
     def test_stop_finished_service_stopped(self):
         ecs = self._make_FUT()
@@ -285,6 +1146,7 @@ class TestECSManager(unittest.TestCase):
         ecs.stop_finished_service(past, step)
         ecs._ecs_client.update_service.assert_called()
         eq_(step["service_status"], "STOPPED")
+        ok_(step["stopped_at"] >= past)
 
     def test_stop_finished_service_stop_already_stopped(self):
         ecs = self._make_FUT()
@@ -314,117 +1176,402 @@ class TestECSManager(unittest.TestCase):
         ecs.stop_finished_services(past, ecs._plan["steps"])
         ecs.stop_finished_service.assert_called()
 
-    def test_shutdown_plan(self):
-        mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
+    def test_start_deferred_service(self):
+        ecs = self._make_FUT()
+        step = ecs._plan["steps"][0]
+        step["service_status"] = "DEFERRED"
+        step["run_delay"] = 330
+
+        ecs.start_deferred_service(time.time() - 200, step)
+        ecs._ecs_client.update_service.assert_not_called()
+        eq_(step["service_status"], "DEFERRED")
+
+        ecs.start_deferred_service(time.time() - 305, step)
+        ecs._ecs_client.update_service.assert_called_with(
+            cluster=ecs._ecs_name,
+            service=step["name"],
+            desiredCount=step["instance_count"]
+        )
+        eq_(step["service_status"], "STARTED")
+
+    def test_start_deferred_service_already_started(self):
+        ecs = self._make_FUT()
+        step = ecs._plan["steps"][0]
+        step["service_status"] = "STARTED"
+
+        ecs.start_deferred_service(time.time() - 400, step)
+        ecs._ecs_client.update_service.assert_not_called()
+
+    def test_start_deferred_services(self):
+        ecs = self._make_FUT()
+        ecs.start_deferred_service = mock.Mock()
+
+        ecs.start_deferred_services(time.time(), ecs._plan["steps"])
+        ecs.start_deferred_service.assert_called()
+
+    def _shutdown_paginators(self, ecs, task_arns=None):
+        services = mock.Mock()
+        services.paginate.return_value = [
             {"serviceArns": ["arn:123:::", "arn:456:::"]}
         ]
+        task_definitions = mock.Mock()
+        if task_arns is None:
+            task_arns = ["arn:task-definition/{}:{}".format(
+                ecs.metrics_family_name(), revision) for revision in (1, 2)]
+            task_arns.append("arn:task-definition/{}2:1".format(
+                ecs.metrics_family_name()))
+        task_definitions.paginate.return_value = [
+            {"taskDefinitionArns": task_arns}
+        ]
+        paginators = dict(list_services=services,
+                          list_task_definitions=task_definitions)
+        ecs._ecs_client.get_paginator.side_effect = paginators.get
+        return task_definitions
 
+    def test_shutdown_plan(self):
         ecs = self._make_FUT()
         ecs.locate_metrics_service = mock.Mock()
         ecs.locate_metrics_service.return_value = dict(
             serviceArn="arn:456:::"
         )
-        ecs._ecs_client.get_paginator.return_value = mock_paginator
-        ecs._ecs_client.describe_task_definition.return_value = {
-            "taskDefinition": {"taskDefinitionArn": "arn:task:::"}
-        }
+        task_definitions = self._shutdown_paginators(ecs)
 
-        ecs.shutdown_plan(ecs._plan["steps"])
-        ecs._ecs_client.deregister_task_definition.assert_called()
-        ecs._ecs_client.delete_service.assert_called()
+        report = ecs.shutdown_plan(ecs._plan["steps"])
+        eq_(report["services"], ["arn:123:::"])
 
-    def test_shutdown_plan_update_error(self):
+        # Step task definitions are kept for later runs
+        eq_(report["task_definitions"], [])
+        task_definitions.paginate.assert_not_called()
+        ecs._ecs_client.deregister_task_definition.assert_not_called()
+        ecs._ecs_client.delete_service.assert_called_once()
+
+    def test_shutdown_plan_stale_step_families(self):
+        ecs = self._make_FUT()
+        ecs.locate_metrics_service = mock.Mock()
+        ecs.locate_metrics_service.return_value = None
+        step = ecs._plan["steps"][0]
+        current = "{}-{}".format(step["name"], "a" * 32)
+        stale = "{}-{}".format(step["name"], "b" * 32)
+        step["task_family"] = current
+        task_definitions = self._shutdown_paginators(
+            ecs, task_arns=["arn:task-definition/{}:1".format(stale)])
+        families = mock.Mock()
+        families.paginate.return_value = [{"families": [
+            current, stale, "{}-other-{}".format(step["name"], "c" * 32)
+        ]}]
+        paginators = dict(list_task_definition_families=families,
+                          list_task_definitions=task_definitions,
+                          list_services=mock.Mock(
+                              paginate=mock.Mock(return_value=[])))
+        ecs._ecs_client.get_paginator.side_effect = paginators.get
+
+        report = ecs.shutdown_plan(ecs._plan["steps"])
+        _, kwargs = families.paginate.call_args
+        eq_(kwargs["familyPrefix"], "{}-".format(step["name"]))
+        prefixes = [call[1]["familyPrefix"] for call in
+                    task_definitions.paginate.call_args_list]
+        eq_(prefixes, [stale])
+        eq_(report["task_definitions"],
+            ["arn:task-definition/{}:1".format(stale)])
+
+    def test_stale_task_families_error(self):
         from botocore.exceptions import ClientError
+        ecs = self._make_FUT()
+        step = dict(ecs._plan["steps"][0], task_family="x")
+        families = mock.Mock()
+        families.paginate.side_effect = ClientError(
+            {"Error": {"Code": "AccessDeniedException"}},
+            "ListTaskDefinitionFamilies")
+        ecs._ecs_client.get_paginator.side_effect = \
+            dict(list_task_definition_families=families).get
 
-        mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
-            {"serviceArns": ["arn:123:::", "arn:456:::"]}
+        with mock.patch("ardere.aws.logger") as logger:
+            eq_(ecs._stale_task_families(step), [])
+        ok_("AccessDenied" in logger.warning.call_args[0][0])
+
+    def test_run_log_streams(self):
+        import datetime
+
+        ecs = self._make_FUT()
+        step = ecs._plan["steps"][0]
+        started = time.time()
+        tasks = mock.Mock()
+        tasks.paginate.return_value = [{"taskArns": ["t1"]}]
+        ecs._ecs_client.get_paginator.return_value = tasks
+
+        def task(task_id, created):
+            return {"taskArn": "arn:task/{}".format(task_id),
+                    "group": "service:{}".format(step["name"]),
+                    "createdAt": datetime.datetime.utcfromtimestamp(created),
+                    "containers": [{"name": step["name"]},
+                                   {"name": "telegraf"}]}
+
+        ecs._ecs_client.describe_tasks.side_effect = [
+            {"tasks": [task("abc", started + 10),
+                       dict(task("other", started), group="service:x")]},
+            {"tasks": [task("def", started + 20),
+                       task("earlier-run", started - 3600)]},
+        ]
+        streams = ecs.run_log_streams(ecs._plan["steps"], started)
+        eq_(streams, {step["name"]: sorted([
+            "ardere/{}/abc".format(step["name"]), "ardere/telegraf/abc",
+            "ardere/{}/def".format(step["name"]), "ardere/telegraf/def"
+        ])})
+        eq_([call[1]["desiredStatus"] for call in
+             tasks.paginate.call_args_list], ["RUNNING", "STOPPED"])
+
+    def test_shutdown_plan_tear_down_metrics(self):
+        ecs = self._make_FUT()
+        ecs._plan["metrics_options"]["tear_down"] = True
+        ecs.locate_metrics_service = mock.Mock()
+        task_definitions = self._shutdown_paginators(ecs)
+
+        report = ecs.shutdown_plan(ecs._plan["steps"])
+        family = ecs.metrics_family_name()
+        eq_(report["services"], ["arn:123:::", "arn:456:::"])
+        ecs.locate_metrics_service.assert_not_called()
+        prefixes = sorted(call[1]["familyPrefix"] for call in
+                          task_definitions.paginate.call_args_list)
+        eq_(prefixes, sorted([ecs.metrics_family_name(),
+                              ecs.metrics_setup_family_name()]))
+        eq_(sorted(set(report["task_definitions"])),
+            ["arn:task-definition/{}:1".format(family),
+             "arn:task-definition/{}:2".format(family)])
+
+    def test_shutdown_plan_tear_down_keep_metrics_service(self):
+        ecs = self._make_FUT()
+        ecs._plan["metrics_options"]["tear_down"] = True
+        ecs.locate_metrics_service = mock.Mock(
+            return_value={"serviceArn": "arn:456:::"})
+        self._shutdown_paginators(ecs)
+
+        report = ecs.shutdown_plan(ecs._plan["steps"],
+                                   keep_metrics_service=True)
+        eq_(report["services"], ["arn:123:::"])
+
+    def test_shutdown_plan_throttled(self):
+        from botocore.exceptions import ClientError
+
+        ecs = self._make_FUT()
+        ecs.locate_metrics_service = mock.Mock()
+        ecs.locate_metrics_service.return_value = None
+        self._shutdown_paginators(ecs, task_arns=[])
+        throttled = ClientError({"Error": {"Code": "ThrottlingException"}},
+                                "UpdateService")
+        ecs._ecs_client.update_service.side_effect = [
+            throttled, {}, {}
         ]
 
+        with mock.patch("ardere.aws.time.sleep") as mock_sleep:
+            report = ecs.shutdown_plan(ecs._plan["steps"])
+        mock_sleep.assert_called_once()
+        eq_(sorted(report["services"]), ["arn:123:::", "arn:456:::"])
+
+    def test_shutdown_plan_update_error(self):
+        from botocore.exceptions import ClientError
+
         ecs = self._make_FUT()
         ecs.locate_metrics_service = mock.Mock()
         ecs.locate_metrics_service.return_value = dict(
             serviceArn="arn:456:::"
         )
-        ecs._ecs_client.get_paginator.return_value = mock_paginator
-        ecs._ecs_client.describe_task_definition.return_value = {
-            "taskDefinition": {"taskDefinitionArn": "arn:task:::"}
-        }
+        self._shutdown_paginators(ecs)
         ecs._ecs_client.update_service.side_effect = ClientError(
             {"Error": {}}, "some_op"
         )
 
-        ecs.shutdown_plan(ecs._plan["steps"])
+        report = ecs.shutdown_plan(ecs._plan["steps"])
         ecs._ecs_client.delete_service.assert_not_called()
+        eq_(report["services"], [])
 
-    def test_shutdown_plan_describe_error(self):
+    def test_shutdown_plan_list_error(self):
         from botocore.exceptions import ClientError
 
-        mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
-            {"serviceArns": ["arn:123:::", "arn:456:::"]}
-        ]
-
         ecs = self._make_FUT()
         ecs.locate_metrics_service = mock.Mock()
         ecs.locate_metrics_service.return_value = dict(
             serviceArn="arn:456:::"
         )
-        ecs._plan["steps"] = ecs._plan["steps"][:1]
-        ecs._ecs_client.get_paginator.return_value = mock_paginator
-        ecs._ecs_client.describe_task_definition.side_effect = ClientError(
+        ecs._plan["metrics_options"]["tear_down"] = True
+        task_definitions = self._shutdown_paginators(ecs)
+        task_definitions.paginate.side_effect = ClientError(
             {"Error": {}}, "some_op"
         )
 
-        ecs.shutdown_plan(ecs._plan["steps"])
+        report = ecs.shutdown_plan(ecs._plan["steps"])
         ecs._ecs_client.deregister_task_definition.assert_not_called()
+        eq_(report["task_definitions"], [])
 
     def test_shutdown_plan_delete_error(self):
         from botocore.exceptions import ClientError
 
-        mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
-            {"serviceArns": ["arn:123:::", "arn:456:::"]}
-        ]
-
         ecs = self._make_FUT()
         ecs.locate_metrics_service = mock.Mock()
         ecs.locate_metrics_service.return_value = dict(
             serviceArn="arn:456:::"
         )
-        ecs._ecs_client.get_paginator.return_value = mock_paginator
-        ecs._ecs_client.describe_task_definition.return_value = {
-            "taskDefinition": {"taskDefinitionArn": "arn:task:::"}
-        }
+        self._shutdown_paginators(ecs)
         ecs._ecs_client.delete_service.side_effect = ClientError(
             {"Error": {}}, "some_op"
         )
 
-        ecs.shutdown_plan(ecs._plan["steps"])
+        report = ecs.shutdown_plan(ecs._plan["steps"])
         ecs._ecs_client.delete_service.assert_called()
+        eq_(report["services"], [])
 
     def test_shutdown_plan_deregister_error(self):
         from botocore.exceptions import ClientError
 
-        mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
-            {"serviceArns": ["arn:123:::", "arn:456:::"]}
-        ]
-
         ecs = self._make_FUT()
         ecs.locate_metrics_service = mock.Mock()
         ecs.locate_metrics_service.return_value = dict(
             serviceArn="arn:456:::"
         )
         ecs._plan["metrics_options"]["tear_down"] = True
-        ecs._ecs_client.get_paginator.return_value = mock_paginator
-        ecs._ecs_client.describe_task_definition.return_value = {
-            "taskDefinition": {"taskDefinitionArn": "arn:task:::"}
-        }
+        self._shutdown_paginators(ecs)
         ecs._ecs_client.deregister_task_definition.side_effect = ClientError(
             {"Error": {}}, "some_op"
         )
 
-        ecs.shutdown_plan(ecs._plan["steps"])
+        report = ecs.shutdown_plan(ecs._plan["steps"])
         ecs._ecs_client.delete_service.assert_called()
+        eq_(report["task_definitions"], [])
+
+
+class TestApiExecutor(unittest.TestCase):
+    def _make_FUT(self, **kwargs):
+        from ardere.aws import ApiExecutor
+        return ApiExecutor(**kwargs)
+
+    def _throttled(self):
+        from botocore.exceptions import ClientError
+        return ClientError({"Error": {"Code": "ThrottlingException"}},
+                           "SomeOp")
+
+    def test_call_grows_limit(self):
+        api = self._make_FUT(initial_concurrency=4)
+        method = mock.Mock(return_value="ok")
+        for _ in range(5):
+            eq_(api.call("ecs", method, cluster="fred"), "ok")
+        eq_(api.limit, 5)
+        method.assert_called_with(cluster="fred")
+
+    def test_call_throttled_halves_limit(self):
+        api = self._make_FUT(initial_concurrency=8)
+        method = mock.Mock(side_effect=[self._throttled(), "ok"])
+        with mock.patch("ardere.aws.time.sleep") as mock_sleep:
+            eq_(api.call("ecs", method), "ok")
+        mock_sleep.assert_called_once()
+        eq_(api.limit, 4)
+
+    def test_call_throttled_gives_up(self):
+        from botocore.exceptions import ClientError
+        from ardere.aws import THROTTLE_RETRIES
+
+        api = self._make_FUT(initial_concurrency=8)
+        method = mock.Mock(side_effect=self._throttled())
+        with mock.patch("ardere.aws.time.sleep"):
+            assert_raises(ClientError, api.call, "ecs", method)
+        eq_(method.call_count, THROTTLE_RETRIES)
+        eq_(api.limit, 1)
+
+    def test_call_error_not_retried(self):
+        from botocore.exceptions import ClientError
+
+        api = self._make_FUT()
+        method = mock.Mock(side_effect=ClientError({"Error": {}}, "SomeOp"))
+        assert_raises(ClientError, api.call, "ec2", method)
+        eq_(method.call_count, 1)
+
+    def test_map(self):
+        api = self._make_FUT(initial_concurrency=2)
+
+        def func(item):
+            if item == 2:
+                raise ValueError("bad item")
+            return item * 10
+
+        results = api.map(func, [1, 2, 3])
+        eq_([result.item for result in results], [1, 2, 3])
+        eq_(results[0].result, 10)
+        ok_(isinstance(results[1].error, ValueError))
+        eq_(results[2].result, 30)
+        eq_(api.map(func, []), [])
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_acquire_waits_when_empty(self):
+        from ardere.aws import TokenBucket
+
+        with mock.patch("ardere.aws.time.sleep") as mock_sleep, \
+                mock.patch("ardere.aws.time.time") as mock_time:
+            mock_time.side_effect = [0, 0, 0, 0, 0.1]
+            bucket = TokenBucket(rate=10, burst=2)
+            bucket.acquire()
+            bucket.acquire()
+            mock_sleep.assert_not_called()
+            bucket.acquire()
+        mock_sleep.assert_called_once()
+
+
+class TestPlanStateStore(unittest.TestCase):
+    def _make_FUT(self):
+        from ardere.aws import PlanStateStore
+        PlanStateStore._cache.clear()
+        store = PlanStateStore("state_bucket")
+        store.boto = self.boto_mock = mock.Mock()
+        self.s3_client = self.boto_mock.client.return_value
+        return store
+
+    def _plan(self):
+        plan = json.loads(fixtures.sample_basic_test_plan)
+        plan["plan_run_uuid"] = "abc"
+        return plan
+
+    def test_save(self):
+        import zlib
+
+        store = self._make_FUT()
+        plan = self._plan()
+        plan["next_check_wait"] = 10
+        reference = store.save(plan)
+        eq_(reference, dict(plan_id="abc", plan_version=1,
+                            next_check_wait=10))
+
+        kwargs = self.s3_client.put_object.call_args[1]
+        eq_(kwargs["Bucket"], "state_bucket")
+        eq_(kwargs["Key"], "abc/00000001.json.zlib")
+        stored = json.loads(zlib.decompress(kwargs["Body"]).decode("utf-8"))
+        eq_(stored["steps"], plan["steps"])
+        ok_("next_check_wait" not in stored)
+
+    def test_save_unchanged(self):
+        store = self._make_FUT()
+        reference = store.save(self._plan())
+        plan = store.load(dict(reference, next_check_wait=5))
+        eq_(store.save(plan), dict(plan_id="abc", plan_version=1,
+                                   next_check_wait=5))
+        eq_(self.s3_client.put_object.call_count, 1)
+
+        plan["steps"][0]["service_status"] = "STOPPED"
+        eq_(store.save(plan)["plan_version"], 2)
+
+    def test_load(self):
+        import zlib
+
+        store = self._make_FUT()
+        body = zlib.compress(json.dumps(self._plan()).encode("utf-8"))
+        self.s3_client.get_object.return_value = {
+            "Body": mock.Mock(**{"read.return_value": body})
+        }
+        plan = store.load({"plan_id": "abc", "plan_version": 3,
+                           "error-info": {"Error": "Oops"}})
+        self.s3_client.get_object.assert_called_with(
+            Bucket="state_bucket", Key="abc/00000003.json.zlib")
+        eq_(plan["plan_version"], 3)
+        eq_(plan["error-info"], {"Error": "Oops"})
+        eq_(plan["ecs_name"], self._plan()["ecs_name"])
+
+        # A warm container doesn't fetch the same version again
+        store.load({"plan_id": "abc", "plan_version": 3})
+        eq_(self.s3_client.get_object.call_count, 1)
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from nose.tools import eq_, ok_
+
+# Seconds handler.py may take to import on top of boto3, which every
+# handler needs anyway. The polling states cold-start constantly on small
+# Lambdas, so this is kept well below what boto3 itself takes.
+IMPORT_TIME_BUDGET = 0.25
+
+# Modules only the first state of a plan run needs
+DEFERRED_MODULES = ["toml", "marshmallow", "ardere.validation"]
+
+IMPORT_SCRIPT = """
+import json
+import sys
+import time
+
+import boto3  # noqa
+
+start = time.time()
+import handler  # noqa
+elapsed = time.time() - start
+print(json.dumps(dict(elapsed=elapsed, modules=sorted(sys.modules))))
+"""
+
+
+class TestHandlerImport(unittest.TestCase):
+    def _import_handler(self):
+        root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        output = subprocess.check_output(
+            [sys.executable, "-c", IMPORT_SCRIPT], cwd=root)
+        return json.loads(output.decode("utf-8").splitlines()[-1])
+
+    def test_import_defers_plan_loading(self):
+        result = self._import_handler()
+        eq_([name for name in DEFERRED_MODULES
+             if name in result["modules"]], [])
+
+    def test_import_time_budget(self):
+        # Best of a few runs to keep a busy test host from failing this
+        elapsed = min(self._import_handler()["elapsed"] for _ in range(3))
+        ok_(elapsed < IMPORT_TIME_BUDGET,
+            "handler import took {:.3f}s".format(elapsed))
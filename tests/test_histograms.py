@@ -0,0 +1,89 @@
+import unittest
+
+import mock
+from nose.tools import eq_
+
+
+class TestStatsdRelay(unittest.TestCase):
+    def _make_FUT(self, precision=2):
+        from ardere.scripts.statsd_relay import HistogramRelay
+        return HistogramRelay("step one", "i-1234", precision)
+
+    def test_bucket(self):
+        from ardere.scripts.statsd_relay import bucket
+        eq_(bucket(123.456, 2), "1.2e+02")
+        eq_(bucket(123.456, 3), "1.23e+02")
+        eq_(bucket(0.0042, 1), "4e-03")
+        eq_(bucket(0, 2), "0")
+
+    def test_record(self):
+        relay = self._make_FUT()
+        relay.record("req.time:120|ms\nreq.time:121|ms|@0.5\n"
+                     "req.count:1|c\nbroken\nreq.time:abc|ms")
+        eq_(relay.histograms, {"req.time": {"1.2e+02": 3.0}})
+
+    def test_flush(self):
+        relay = self._make_FUT()
+        relay.record("req.time:120|ms\nreq.time:2000|h")
+        eq_(relay.flush(1000), [
+            "ardere_histogram,host=i-1234,metric=req.time,step=step\\ one "
+            "1.2e+02=1.0,2.0e+03=1.0 1000"
+        ])
+        eq_(relay.flush(2000), [])
+
+    def test_parse_run_file(self):
+        from ardere.scripts.statsd_relay import parse_run_file
+        eq_(parse_run_file("ARDERE_INFLUX_ADDR='1.1.1.1:8086'\n"
+                           "ARDERE_INFLUX_DB='run'\n"),
+            dict(ARDERE_INFLUX_ADDR="1.1.1.1:8086", ARDERE_INFLUX_DB="run"))
+
+
+class TestHistogramMerger(unittest.TestCase):
+    def _series(self):
+        return [
+            {"tags": {"step": "one", "metric": "req.time"},
+             "columns": ["time", "1.0e+01", "2.0e+01", "host", "1.0e+02"],
+             "values": [[1000, 50, 40, "i-1", None],
+                        [1000, 30, None, "i-2", 10]]},
+            {"tags": {"step": "two", "metric": "req.time"},
+             "columns": ["time", "5.0e+00", "host"],
+             "values": [[1000, 3, "i-3"]]}
+        ]
+
+    def test_merge(self):
+        from ardere.scripts.histogram_merger import merge
+        eq_(merge(self._series()), {
+            ("one", "req.time"): {10.0: 80, 20.0: 40, 100.0: 10},
+            ("two", "req.time"): {5.0: 3}
+        })
+
+    def test_percentiles(self):
+        from ardere.scripts.histogram_merger import percentiles
+        eq_(percentiles({10.0: 80, 20.0: 40, 100.0: 10}), dict(
+            count=130.0, p50=10.0, p90=20.0, p99=100.0, p99_9=100.0))
+
+    def test_merge_interval(self):
+        from ardere.scripts.histogram_merger import HistogramMerger
+        merger = HistogramMerger("run")
+        merger._query = mock.Mock(return_value=self._series())
+        merger._write = mock.Mock()
+
+        merger.merge_interval(1000)
+        query = merger._query.call_args[0][0]
+        eq_("time >= 1000s AND time < 1010s" in query, True)
+        merger._write.assert_called_with([
+            "ardere_percentiles,metric=req.time,step=one count=130.0,"
+            "p50=10.0,p90=20.0,p99=100.0,p99_9=100.0 1000000",
+            "ardere_percentiles,metric=req.time,step=two count=3.0,"
+            "p50=5.0,p90=5.0,p99=5.0,p99_9=5.0 1000000"
+        ])
+
+    def test_query_run_database(self):
+        from ardere.scripts import histogram_merger
+        merger = histogram_merger.HistogramMerger("run-1")
+        with mock.patch.object(histogram_merger, "urlopen") as urlopen:
+            urlopen.return_value.read.return_value = \
+                b'{"results": [{"series": []}]}'
+            eq_(merger._query("SELECT 1"), [])
+        url = urlopen.call_args[0][0]
+        eq_("db=run-1" in url, True)
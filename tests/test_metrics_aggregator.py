@@ -0,0 +1,98 @@
+import unittest
+
+from nose.tools import eq_, ok_
+
+# An interval long enough ago for the aggregator to have rolled it up
+NOW = 1000
+TS = 900 * 10 ** 9
+
+
+class TestMetricsAggregator(unittest.TestCase):
+    def _make_FUT(self):
+        from ardere.scripts.metrics_aggregator import MetricsAggregator
+        return MetricsAggregator()
+
+    def test_parse_line(self):
+        from ardere.scripts.metrics_aggregator import parse_line
+        eq_(parse_line('cpu,host=i-1,step=a\\ b usage=1.5,name="x y" 10'),
+            ("cpu", [("host", "i-1"), ("step", "a\\ b")],
+             [("usage", "1.5"), ("name", '"x y"')], 10))
+        eq_(parse_line("garbage"), None)
+        eq_(parse_line("cpu,host usage=1"), None)
+
+    def test_rolled_up_per_step(self):
+        agg = self._make_FUT()
+        agg.ingest("run", "\n".join([
+            "mem,host=i-1,step=one used=100i,used_percent=10.0 {}".format(TS),
+            "mem,host=i-2,step=one used=301i,used_percent=30.0 {}".format(TS),
+            "mem,host=i-3,step=two used=5i,used_percent=1.0 {}".format(TS),
+        ]))
+        eq_(agg.flush(NOW), {"run": [
+            "mem,host=aggregate,step=one used=200i,used_sum=401i,"
+            "used_max=301i,used_percent=20.0,used_percent_sum=40.0,"
+            "used_percent_max=30.0,ardere_hosts=2i {}".format(TS),
+            "mem,host=aggregate,step=two used=5i,used_sum=5i,used_max=5i,"
+            "used_percent=1.0,used_percent_sum=1.0,used_percent_max=1.0,"
+            "ardere_hosts=1i {}".format(TS),
+        ]})
+        eq_(agg.flush(NOW), {})
+
+    def test_statsd_timestamps_grouped(self):
+        agg = self._make_FUT()
+        agg.ingest("run", "\n".join([
+            "counter,host=i-1,step=one value=1i {}".format(TS + 4000123),
+            "counter,host=i-2,step=one value=3i {}".format(TS + 9100000),
+        ]))
+        eq_(agg.flush(NOW), {"run": [
+            "counter,host=aggregate,step=one value=2i,value_sum=4i,"
+            "value_max=3i,ardere_hosts=2i {}".format(TS),
+        ]})
+
+        # Once the interval is flushed, points still falling in it are late
+        agg.ingest("run", "counter,host=i-3,step=one value=5i {}".format(
+            TS + 2000000))
+        eq_(agg.dropped, 1)
+
+    def test_precision(self):
+        agg = self._make_FUT()
+        agg.ingest("run", "cpu,host=i-1 usage=1.0 900000", precision="ms")
+        eq_(list(agg.flush(NOW)["run"][0].split(" "))[-1], str(TS))
+
+    def test_not_due(self):
+        agg = self._make_FUT()
+        agg.ingest("run", "cpu,host=i-1 usage=1.0 {}".format(TS))
+        eq_(agg.flush(TS // 10 ** 9 + 1), {})
+        ok_(agg.flush(NOW)["run"])
+
+    def test_late_points_dropped(self):
+        agg = self._make_FUT()
+        agg.ingest("run", "cpu,host=i-1 usage=1.0 {}".format(TS))
+        agg.flush(NOW)
+        agg.ingest("run", "cpu,host=i-2 usage=2.0 {}".format(TS))
+        eq_(agg.dropped, 1)
+        eq_(agg.flush(NOW), {})
+
+    def test_sampled_hosts_kept(self):
+        agg = self._make_FUT()
+        agg.ingest("run", "\n".join([
+            "cpu,ardere_sampled=1,host=i-1 usage=1.0 {}".format(TS),
+            "cpu,host=i-2 usage=3.0 {}".format(TS),
+        ]))
+        eq_(agg.flush(NOW), {"run": [
+            "cpu,host=i-1 usage=1.0 {}".format(TS),
+            "cpu,host=aggregate usage=2.0,usage_sum=4.0,usage_max=3.0,"
+            "ardere_hosts=2i {}".format(TS),
+        ]})
+
+    def test_histograms_summed(self):
+        agg = self._make_FUT()
+        agg.ingest("run", "\n".join([
+            "ardere_histogram,ardere_sampled=1,host=i-1,metric=t,step=one "
+            "1.2e+02=1.0,2.0e+03=2.0 900000",
+            "ardere_histogram,host=i-2,metric=t,step=one "
+            "1.2e+02=3.0 900000",
+        ]), precision="ms")
+        eq_(agg.flush(NOW), {"run": [
+            "ardere_histogram,metric=t,step=one 1.2e+02=4.0,2.0e+03=2.0 "
+            "{}".format(TS),
+        ]})
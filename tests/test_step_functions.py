@@ -6,7 +6,7 @@ import uuid
 
 import mock
 from botocore.exceptions import ClientError
-from nose.tools import eq_, assert_raises
+from nose.tools import eq_, ok_, assert_raises
 
 from tests import fixtures
 
@@ -14,6 +14,9 @@ from tests import fixtures
 class TestAsyncPlanRunner(unittest.TestCase):
     def setUp(self):
         self.mock_ecs = mock.Mock()
+        self.mock_ecs.task_failures.return_value = {}
+        self.mock_ecs.query_instance_substitutes.return_value = {}
+        self.mock_ecs.find_stragglers.return_value = []
         self._patcher = mock.patch("ardere.step_functions.ECSManager")
         mock_manager = self._patcher.start()
         mock_manager.return_value = self.mock_ecs
@@ -32,6 +35,105 @@ class TestAsyncPlanRunner(unittest.TestCase):
         eq_(len(result), 1)
         eq_(result, {"t2.medium": 1})
 
+    def test_build_instance_map_sequential_steps(self):
+        from ardere.step_functions import AsynchronousPlanRunner
+
+        runner = AsynchronousPlanRunner({"toml": fixtures.sample_toml}, None)
+        result = runner._build_instance_map()
+        eq_(result, {"m3.medium": 8})
+        eq_([step["defer_start"] for step in runner.event["steps"]],
+            [False, True])
+
+    def test_build_instance_map_overlapping_steps(self):
+        from ardere.step_functions import AsynchronousPlanRunner
+
+        runner = AsynchronousPlanRunner({"toml": fixtures.sample_toml}, None)
+        runner.event["steps"][1]["run_delay"] = 200
+        result = runner._build_instance_map()
+        eq_(result, {"m3.medium": 16})
+        eq_([step["defer_start"] for step in runner.event["steps"]],
+            [False, False])
+
+    def test_build_instance_map_mixed_counts(self):
+        from ardere.step_functions import AsynchronousPlanRunner
+
+        runner = AsynchronousPlanRunner({"toml": fixtures.sample_toml}, None)
+        steps = runner.event["steps"]
+        steps[0]["instance_count"] = 4
+        steps.append(dict(steps[1], name="third", instance_count=2,
+                          run_delay=0, run_max_time=1000))
+        result = runner._build_instance_map()
+        eq_(result, {"m3.medium": 10})
+        eq_([step["defer_start"] for step in steps], [False, True, False])
+
+    def test_build_instance_map_packed(self):
+        from ardere.step_functions import AsynchronousPlanRunner
+
+        runner = AsynchronousPlanRunner({"toml": fixtures.sample_toml}, None)
+        runner.event["pack_steps"] = True
+        steps = runner.event["steps"]
+        for step in steps:
+            step["instance_type"] = "c4.2xlarge"
+            step["instance_count"] = 4
+            step["cpu_units"] = 1024
+        steps.append(dict(steps[1], name="heavy", instance_count=2))
+        del steps[2]["cpu_units"]
+
+        result = runner._build_instance_map()
+        eq_(result, {"c4.2xlarge": 6})
+        eq_(len(set(step["statsd_port"] for step in steps)), 3)
+        eq_([step["defer_start"] for step in steps], [False, False, False])
+
+    def test_build_instance_map_packed_memory_and_ports(self):
+        from ardere.step_functions import AsynchronousPlanRunner
+
+        runner = AsynchronousPlanRunner({"toml": fixtures.sample_toml}, None)
+        runner.event["pack_steps"] = True
+        steps = runner.event["steps"]
+        for step in steps:
+            step["instance_type"] = "c4.2xlarge"
+            step["instance_count"] = 2
+            step["cpu_units"] = 512
+        steps.append(dict(steps[1], name="bigmem", memory_reservation=12000))
+        steps.append(dict(steps[1], name="ports", port_mapping=[8000]))
+        steps.append(dict(steps[1], name="ports2", port_mapping=[8000]))
+
+        result = runner._build_instance_map()
+        eq_(result, {"c4.2xlarge": 4})
+
+    def test_build_instance_map_packed_histograms(self):
+        from ardere.step_functions import AsynchronousPlanRunner
+
+        runner = AsynchronousPlanRunner({"toml": fixtures.sample_toml}, None)
+        runner.event["pack_steps"] = True
+        steps = runner.event["steps"]
+        for step in steps:
+            step["instance_type"] = "c4.2xlarge"
+            step["instance_count"] = 2
+            step["cpu_units"] = 512
+        # Clashes with the port telegraf listens on behind the relay
+        steps[1]["port_mapping"] = [9125]
+        eq_(runner._build_instance_map(), {"c4.2xlarge": 2})
+
+        runner.event["metrics_options"] = dict(histograms=True)
+        eq_(runner._build_instance_map(), {"c4.2xlarge": 4})
+
+    def test_build_instance_map_packed_fallback(self):
+        from ardere.step_functions import AsynchronousPlanRunner
+
+        runner = AsynchronousPlanRunner({"toml": fixtures.sample_toml}, None)
+        runner.event["pack_steps"] = True
+        for step in runner.event["steps"]:
+            step["instance_type"] = "m4.large"
+            step["instance_count"] = 1
+            step["cpu_units"] = 256
+            step["memory_reservation"] = 3000
+        eq_(runner._build_instance_map(), {"m4.large": 1})
+
+        # Packed to fit the c4.large that may be launched instead
+        runner.event["capacity_fallback"] = True
+        eq_(runner._build_instance_map(), {"m4.large": 2})
+
     def test_find_test_plan_duration(self):
         result = self.runner._find_test_plan_duration()
         eq_(result, 140)
@@ -45,13 +147,268 @@ class TestAsyncPlanRunner(unittest.TestCase):
         eq_(self.runner.event["steps"][0]["instance_count"], 8)
         eq_(self.runner.event["ecs_name"], "ardere-test")
 
+    def test_load_plan_state(self):
+        from ardere.step_functions import AsynchronousPlanRunner
+
+        os.environ["plan_state_bucket"] = "state_bucket"
+        with mock.patch("ardere.step_functions.PlanStateStore") as store:
+            store.is_reference.return_value = True
+            store.return_value.load.return_value = self.plan
+            runner = AsynchronousPlanRunner(
+                {"plan_id": "abc", "plan_version": 2}, None)
+        del os.environ["plan_state_bucket"]
+        store.assert_called_with("state_bucket")
+        eq_(runner.event, self.plan)
+
+    def test_save_state(self):
+        eq_(self.runner.save_state(self.plan), self.plan)
+
+        os.environ["plan_state_bucket"] = "state_bucket"
+        with mock.patch("ardere.step_functions.PlanStateStore") as store:
+            store.return_value.save.return_value = {"plan_id": "abc"}
+            reference = self.runner.save_state(self.plan)
+        del os.environ["plan_state_bucket"]
+        eq_(reference, {"plan_id": "abc"})
+        store.return_value.save.assert_called_with(self.plan)
+
     def test_populate_missing_instances(self):
         os.environ["ec2_sg"] = "i-23232"
         os.environ["metric_sg"] = "i-84828"
         self.mock_ecs.has_metrics_node.return_value = False
+        self.mock_ecs.request_instances.return_value = {
+            "t2.medium": {"t2.medium": 1}
+        }
         self.runner.populate_missing_instances()
+        self.mock_ecs.touch_instances.assert_called()
         self.mock_ecs.query_active_instances.assert_called()
         self.mock_ecs.request_instances.assert_called()
+        eq_(self.runner.event["instance_substitutes"], {})
+
+    def test_populate_missing_instances_save_state(self):
+        os.environ["ec2_sg"] = "i-23232"
+        os.environ["metric_sg"] = "i-84828"
+        # Given to the plan by the ECSManager before it's validated
+        self.plan["plan_run_uuid"] = "abc123"
+        self.mock_ecs.calculate_missing_instances.return_value = {}
+        mock_client = mock.Mock()
+        self.mock_boto.client.return_value = mock_client
+
+        event = self.runner.populate_missing_instances()
+        os.environ["plan_state_bucket"] = "state_bucket"
+        try:
+            reference = self.runner.save_state(event)
+        finally:
+            del os.environ["plan_state_bucket"]
+        eq_(reference["plan_id"], "abc123")
+        _, kwargs = mock_client.put_object.call_args
+        eq_(kwargs["Bucket"], "state_bucket")
+        ok_(kwargs["Key"].startswith("abc123/"))
+
+    def test_populate_missing_instances_substitutes(self):
+        os.environ["ec2_sg"] = "i-23232"
+        os.environ["metric_sg"] = "i-84828"
+        self.plan["capacity_fallback"] = True
+        self.mock_ecs.has_metrics_node.return_value = True
+        self.mock_ecs.query_active_instances.return_value = {}
+        self.mock_ecs.request_instances.return_value = {
+            "t2.medium": {"t2.medium": 1, "t2.large": 2}
+        }
+        self.runner.populate_missing_instances()
+        _, kwargs = self.mock_ecs.request_instances.call_args
+        eq_(kwargs["fallback"], True)
+        eq_(self.runner.event["instance_substitutes"],
+            {"t2.medium": ["t2.large"]})
+
+    def test_populate_missing_instances_retried(self):
+        os.environ["ec2_sg"] = "i-23232"
+        os.environ["metric_sg"] = "i-84828"
+        self.plan["capacity_fallback"] = True
+        self.mock_ecs.has_metrics_node.return_value = True
+        # The substitutes an earlier attempt launched are found by their tag
+        self.mock_ecs.query_instance_substitutes.return_value = {
+            "t2.medium": {"t2.large": 1}
+        }
+        self.mock_ecs.calculate_missing_instances.return_value = {}
+        self.runner.populate_missing_instances()
+        self.mock_ecs.request_instances.assert_not_called()
+        eq_(self.runner.event["instance_substitutes"],
+            {"t2.medium": ["t2.large"]})
+
+    def test_replace_lost_instances(self):
+        os.environ["ec2_sg"] = "i-23232"
+        self.plan["spot_instances"] = True
+        self.plan["instances_needed"] = {"c4.large": 10, "t2.medium": 2}
+        self.plan["instance_substitutes"] = {"c4.large": ["c3.large"]}
+        self.mock_ecs.query_active_instances.return_value = {
+            "c4.large": 7, "t2.medium": 2
+        }
+        self.mock_ecs.calculate_missing_instances.side_effect = \
+            lambda desired, current: {"c4.large": desired["c4.large"] -
+                                      current["c4.large"]}
+        self.mock_ecs.request_instances.return_value = {
+            "c4.large": {"m4.large": 3}
+        }
+
+        self.runner._replace_lost_instances()
+        _, kwargs = self.mock_ecs.calculate_missing_instances.call_args
+        eq_(kwargs["current"], {"c4.large": 7, "t2.medium": 2})
+        _, kwargs = self.mock_ecs.request_instances.call_args
+        eq_(kwargs["instances"], {"c4.large": 3})
+        eq_(kwargs["spot"], True)
+        eq_(self.runner.event["replaced_instances"], 3)
+        eq_(self.runner.event["instance_substitutes"],
+            {"c4.large": ["c3.large", "m4.large"]})
+
+    def test_replace_lost_instances_on_demand(self):
+        self.plan["instances_needed"] = {"c4.large": 10}
+        self.runner._replace_lost_instances()
+        self.mock_ecs.query_active_instances.assert_not_called()
+
+    def test_replace_lost_instances_none_lost(self):
+        self.plan["spot_instances"] = True
+        self.plan["instances_needed"] = {"c4.large": 10}
+        self.mock_ecs.query_active_instances.return_value = {"c4.large": 10}
+        self.mock_ecs.calculate_missing_instances.return_value = {}
+        self.runner._replace_lost_instances()
+        self.mock_ecs.request_instances.assert_not_called()
+
+    def test_replace_stragglers(self):
+        os.environ["ec2_sg"] = "i-23232"
+        self.plan["instances_needed"] = {"c4.large": 10}
+        self.mock_ecs.find_stragglers.return_value = ["i-1", "i-2"]
+        self.mock_ecs.query_active_instances.return_value = {"c4.large": 8}
+        self.mock_ecs.calculate_missing_instances.return_value = {
+            "c4.large": 2}
+        self.mock_ecs.request_instances.return_value = {
+            "c4.large": {"c4.large": 2}
+        }
+
+        eq_(self.runner._replace_stragglers(), ["i-1", "i-2"])
+        self.mock_ecs.terminate_instances.assert_called_with(["i-1", "i-2"])
+        # EC2 may still describe them as running
+        self.mock_ecs.query_active_instances.assert_called_with(
+            exclude=["i-1", "i-2"])
+        _, kwargs = self.mock_ecs.request_instances.call_args
+        eq_(kwargs["instances"], {"c4.large": 2})
+        eq_(kwargs["spot"], False)
+
+    def test_replace_stragglers_none(self):
+        self.mock_ecs.find_stragglers.return_value = []
+        self.runner._replace_stragglers()
+        self.mock_ecs.terminate_instances.assert_not_called()
+
+    def test_phases_recorded(self):
+        self.mock_ecs.all_services_ready.return_value = True
+        self.runner.create_ecs_services()
+        self.runner.wait_for_cluster_ready()
+        self.runner.wait_for_cluster_ready()
+
+        phases = self.runner._phases()
+        eq_([phase["name"] for phase in phases],
+            ["services_created", "services_ready"])
+        eq_(phases[1]["start"], phases[0]["end"])
+        eq_(phases[1]["invocations"], 2)
+        ok_(phases[1]["end"] >= phases[1]["start"])
+
+        # The phase being run is kept apart until the next one starts
+        eq_(self.runner.event["current_phase"]["name"], "services_ready")
+        eq_([phase["name"] for phase in self.runner.event["phases"]],
+            ["services_created"])
+
+    def test_phases_polls_not_stored(self):
+        from ardere.aws import PlanStateStore
+        os.environ["s3_ready_bucket"] = "test_bucket"
+        self.mock_boto.client.return_value = mock.Mock()
+        self.plan["plan_run_uuid"] = "abc"
+        self.plan["start_time"] = int(time.time()) - 100
+        store = PlanStateStore("bucket")
+        store.boto = mock.Mock()
+        s3 = store.boto.client.return_value
+
+        self.runner.check_for_cluster_done()
+        store.save(self.runner.event)
+        self.runner.check_for_cluster_done()
+        reference = store.save(self.runner.event)
+        eq_(s3.put_object.call_count, 1)
+        eq_(reference["current_phase"]["invocations"], 2)
+
+    def test_phase_aws_calls(self):
+        from ardere.aws import api_calls
+
+        def create_services(steps):
+            api_calls.record("before-call.ecs.CreateService")
+
+        self.mock_ecs.create_services.side_effect = create_services
+        self.runner.create_ecs_services()
+        eq_(self.runner._phases()[0]["aws_calls"],
+            {"ecs.CreateService": 1})
+
+    def test_write_annotations(self):
+        self.plan["metrics_options"] = dict(enabled=True)
+        self.plan["metric_container_arn"] = "arn:::"
+        self.plan["start_time"] = 1000.5
+        self.plan["steps"][0]["stopped_at"] = 2000
+        self.runner._record_phase("services_ready", 900, {})
+
+        self.mock_ecs.run_annotation_task.return_value = ["arn:task/1"]
+        eq_(self.runner._write_annotations(), ["arn:task/1"])
+        args, _ = self.mock_ecs.run_annotation_task.call_args
+        eq_(args[0], "arn:::")
+        eq_([(point["tags"]["event"], point["time"]) for point in args[1]],
+            [("phase", args[1][0]["time"]), ("start", 1000500),
+             ("stop", 2000000)])
+
+        # Nothing new to write
+        self.mock_ecs.run_annotation_task.reset_mock()
+        self.runner._write_annotations()
+        self.mock_ecs.run_annotation_task.assert_not_called()
+
+    def test_write_annotations_failure(self):
+        self.plan["metrics_options"] = dict(enabled=True)
+        self.plan["metric_container_arn"] = "arn:::"
+        self.plan["start_time"] = 1000
+        self.mock_ecs.run_annotation_task.side_effect = ClientError(
+            {"Error": {}}, "some_op")
+
+        self.runner._write_annotations()
+        eq_(self.runner.event["annotations_written"], [])
+
+    def test_write_annotations_metrics_disabled(self):
+        self.plan["metrics_options"] = dict(enabled=False)
+        self.plan["start_time"] = 1000
+        self.runner._write_annotations()
+        self.mock_ecs.run_annotation_task.assert_not_called()
+
+    def test_check_crash_loops(self):
+        step = self.plan["steps"][0]
+        failed = dict(failures=3 * step["instance_count"], exit_code=1,
+                      reason="Essential container in task exited")
+        self.mock_ecs.task_failures.return_value = {step["name"]: failed}
+
+        self.runner._check_crash_loops()
+        eq_(self.runner.event["crash_loops"], {step["name"]: failed})
+
+    def test_check_crash_loops_below_threshold(self):
+        step = self.plan["steps"][0]
+        self.mock_ecs.task_failures.return_value = {step["name"]: dict(
+            failures=1, exit_code=1, reason="oops")}
+
+        self.runner._check_crash_loops()
+        ok_("crash_loops" not in self.runner.event)
+
+    def test_check_crash_loops_abort(self):
+        from ardere.exceptions import ShutdownPlanException
+
+        step = self.plan["steps"][0]
+        self.plan["abort_on_crash_loop"] = True
+        self.plan["crash_loop_threshold"] = 1
+        self.mock_ecs.task_failures.return_value = {step["name"]: dict(
+            failures=step["instance_count"], exit_code=127,
+            reason="Essential container in task exited")}
+
+        with assert_raises(ShutdownPlanException) as cm:
+            self.runner._check_crash_loops()
+        ok_("exit code 127" in str(cm.exception))
 
     def test_populate_missing_instances_fail(self):
         from ardere.exceptions import ValidationException
@@ -118,6 +475,22 @@ class TestAsyncPlanRunner(unittest.TestCase):
         self.runner.ensure_metrics_available()
         self.mock_ecs.locate_metrics_container_ip.assert_called()
 
+    def test_ensure_metrics_available_aggregator(self):
+        self.plan["metrics_options"] = dict(enabled=True, aggregation="step")
+        self.mock_ecs.locate_metrics_service.return_value = {
+            "deployments": [{
+                "desiredCount": 1,
+                "runningCount": 1
+            }]
+        }
+        self.mock_ecs.locate_metrics_container_ip.return_value = (
+            "1.1.1.1", "arn:::"
+        )
+        self.mock_ecs.metrics_service_aggregates.return_value = False
+
+        result = self.runner.ensure_metrics_available()
+        eq_(result["metrics_aggregator"], False)
+
     def test_ensure_metrics_available_running_no_metric_ip(self):
         os.environ["metrics_bucket"] = "metrics"
         self.plan["metrics_options"] = dict(
@@ -207,26 +580,177 @@ class TestAsyncPlanRunner(unittest.TestCase):
         self.mock_ecs.has_started_metric_creation.assert_called()
 
     def test_create_ecs_services(self):
-        self.runner.create_ecs_services()
+        result = self.runner.create_ecs_services()
         self.mock_ecs.create_services.assert_called_with(self.plan["steps"])
+        ok_("services_created_at" in result)
 
     def test_wait_for_cluster_ready_not_ready(self):
         from ardere.exceptions import ServicesStartingException
 
         self.mock_ecs.all_services_ready.return_value = False
+        self.mock_ecs.find_stragglers.return_value = []
         assert_raises(ServicesStartingException,
                       self.runner.wait_for_cluster_ready)
+        self.mock_ecs.find_stragglers.assert_called()
 
     def test_wait_for_cluster_ready_all_ready(self):
         self.mock_ecs.all_services_ready.return_value = True
         self.runner.wait_for_cluster_ready()
         self.mock_ecs.all_services_ready.assert_called()
 
+    def test_wait_for_cluster_ready_stragglers_replaced(self):
+        os.environ["ec2_sg"] = "i-23232"
+        self.plan["instances_needed"] = {"t2.medium": 1}
+        self.mock_ecs.all_services_ready.return_value = False
+        self.mock_ecs.find_stragglers.return_value = ["i-1"]
+        self.mock_ecs.calculate_missing_instances.return_value = {
+            "t2.medium": 1}
+        self.mock_ecs.request_instances.return_value = {
+            "t2.medium": {"t2.medium": 1}}
+
+        # Returned rather than raised so the replacement is kept
+        result = self.runner.wait_for_cluster_ready()
+        eq_(result["services_ready"], False)
+        eq_(result["next_check_wait"], 10)
+        eq_(result["replaced_instances"], 1)
+        ok_("tasks_at_start" not in result)
+
+        self.mock_ecs.all_services_ready.return_value = True
+        result = self.runner.wait_for_cluster_ready()
+        eq_(result["services_ready"], True)
+
+    def test_wait_for_cluster_ready_grace(self):
+        from ardere.exceptions import ServicesStartingException
+
+        self.plan["services_created_at"] = time.time()
+        self.plan["ready_threshold"] = 0.9
+        self.mock_ecs.all_services_ready.return_value = False
+        assert_raises(ServicesStartingException,
+                      self.runner.wait_for_cluster_ready)
+        self.mock_ecs.all_services_ready.assert_called_with(
+            self.plan["steps"], {})
+
+    def test_wait_for_cluster_ready_threshold(self):
+        self.plan["services_created_at"] = time.time() - 200
+        self.plan["ready_threshold"] = 0.9
+        self.plan["steps"][0]["ready_threshold"] = 0.5
+        step = self.plan["steps"][0]
+        step["tasks_desired"] = 10
+        step["tasks_running"] = 6
+        self.mock_ecs.all_services_ready.return_value = True
+
+        result = self.runner.wait_for_cluster_ready()
+        self.mock_ecs.all_services_ready.assert_called_with(
+            self.plan["steps"], {step["name"]: 0.5})
+        eq_(result["tasks_at_start"], dict(desired=10, running=6))
+
+    def test_wait_for_cluster_ready_timeout_abort(self):
+        from ardere.exceptions import ShutdownPlanException
+
+        self.plan["services_created_at"] = time.time() - 2000
+        self.mock_ecs.all_services_ready.return_value = False
+        self.mock_ecs.find_stragglers.return_value = ["i-1"]
+        assert_raises(ShutdownPlanException,
+                      self.runner.wait_for_cluster_ready)
+        # No replacements for a plan about to be aborted
+        self.mock_ecs.terminate_instances.assert_not_called()
+        self.mock_ecs.request_instances.assert_not_called()
+
+    def test_wait_for_cluster_ready_timeout_start(self):
+        self.plan["services_created_at"] = time.time() - 2000
+        self.plan["ready_policy"] = "start"
+        self.mock_ecs.all_services_ready.return_value = False
+        result = self.runner.wait_for_cluster_ready()
+        ok_("tasks_at_start" in result)
+
     def test_signal_cluster_start(self):
         self.plan["plan_run_uuid"] = str(uuid.uuid4())
 
-        self.runner.signal_cluster_start()
+        mock_client = mock.Mock()
+        mock_client.put_object.return_value = {"ETag": '"abc"'}
+        self.mock_boto.client.return_value = mock_client
+
+        now = int(time.time())
+        result = self.runner.signal_cluster_start()
         self.mock_boto.client.assert_called()
+        _, kwargs = mock_client.put_object.call_args
+        eq_(float(kwargs["Body"].decode("utf-8")), result["start_time"])
+        # Containers get a couple of poll intervals to learn of the start
+        ok_(result["start_time"] >= now + 8)
+        eq_(result["ready_etag"], '"abc"')
+
+    def test_signal_cluster_start_histograms(self):
+        self.plan["plan_run_uuid"] = str(uuid.uuid4())
+        self.plan["metrics_options"] = dict(enabled=True)
+        self.plan["metric_container_arn"] = "arn:::"
+        self.mock_boto.client.return_value.put_object.return_value = {}
+
+        self.runner.signal_cluster_start()
+        self.mock_ecs.run_histogram_merger_task.assert_not_called()
+
+        self.plan["metrics_options"]["histograms"] = True
+        result = self.runner.signal_cluster_start()
+        self.mock_ecs.run_histogram_merger_task.assert_called_with(
+            "arn:::",
+            result["start_time"] + self.runner._find_test_plan_duration())
+
+        # Not merging them doesn't keep the plan from starting
+        self.mock_ecs.run_histogram_merger_task.side_effect = ClientError(
+            {"Error": {"Code": "ThrottlingException"}}, "StartTask")
+        self.runner.signal_cluster_start()
+
+    def test_check_for_cluster_done_cached_start(self):
+        os.environ["s3_ready_bucket"] = "test_bucket"
+        mock_client = mock.Mock()
+        self.mock_boto.client.return_value = mock_client
+        self.plan["plan_run_uuid"] = str(uuid.uuid4())
+        self.plan["start_time"] = int(time.time()) - 100
+        self.plan["ready_etag"] = '"abc"'
+
+        self.runner.check_for_cluster_done()
+        self.mock_boto.resource.assert_not_called()
+        mock_client.head_object.assert_called_with(
+            Bucket="test_bucket",
+            Key="{}.ready".format(self.mock_ecs.plan_uuid),
+            IfMatch='"abc"'
+        )
+        args, _ = self.mock_ecs.stop_finished_services.call_args
+        eq_(args[0], self.plan["start_time"])
+
+    def test_check_for_cluster_done_ready_file_removed(self):
+        from ardere.exceptions import ShutdownPlanException
+
+        os.environ["s3_ready_bucket"] = "test_bucket"
+        mock_client = mock.Mock()
+        mock_client.head_object.side_effect = ClientError(
+            {"Error": {"Code": "404"}}, "HeadObject"
+        )
+        self.mock_boto.client.return_value = mock_client
+        self.plan["start_time"] = int(time.time()) - 100
+
+        assert_raises(ShutdownPlanException,
+                      self.runner.check_for_cluster_done)
+        self.mock_ecs.stop_finished_services.assert_not_called()
+
+        # Replaced by another run
+        mock_client.head_object.side_effect = ClientError(
+            {"Error": {"Code": "PreconditionFailed"}}, "HeadObject"
+        )
+        assert_raises(ShutdownPlanException,
+                      self.runner.check_for_cluster_done)
+
+    def test_check_for_cluster_done_ready_file_error(self):
+        os.environ["s3_ready_bucket"] = "test_bucket"
+        mock_client = mock.Mock()
+        mock_client.head_object.side_effect = ClientError(
+            {"Error": {"Code": "SlowDown"}}, "HeadObject"
+        )
+        self.mock_boto.client.return_value = mock_client
+        self.plan["start_time"] = int(time.time()) - 100
+
+        # Left to the state machine to retry rather than ending the plan
+        assert_raises(ClientError, self.runner.check_for_cluster_done)
+        self.mock_ecs.stop_finished_services.assert_not_called()
 
     def test_check_for_cluster_done_not_done(self):
         os.environ["s3_ready_bucket"] = "test_bucket"
@@ -241,6 +765,50 @@ class TestAsyncPlanRunner(unittest.TestCase):
 
         self.plan["plan_run_uuid"] = str(uuid.uuid4())
         self.runner.check_for_cluster_done()
+        self.mock_ecs.stop_finished_services.assert_called()
+        self.mock_ecs.start_deferred_services.assert_called()
+
+    def test_check_for_cluster_done_next_wait(self):
+        os.environ["s3_ready_bucket"] = "test_bucket"
+        mock_file = mock.Mock()
+        mock_file.get.return_value = {"Body": mock_file}
+        mock_file.read.return_value = "{}".format(
+            int(time.time()) - 100).encode(
+            'utf-8')
+        mock_s3_obj = mock.Mock()
+        mock_s3_obj.Object.return_value = mock_file
+        self.mock_boto.resource.return_value = mock_s3_obj
+
+        self.plan["steps"][0]["service_status"] = "STARTED"
+        self.plan["plan_run_uuid"] = str(uuid.uuid4())
+        result = self.runner.check_for_cluster_done()
+        ok_(0 < result["next_check_wait"] <= 40)
+
+    def test_next_check_wait(self):
+        from ardere.step_functions import MAX_DONE_CHECK_WAIT
+
+        start = 1000.0
+        steps = self.plan["steps"]
+        steps[0].update(service_status="STARTED", run_max_time=300)
+        steps.append(dict(steps[0], name="later", run_delay=330,
+                          service_status="DEFERRED"))
+
+        # Wakes up for the first step stopping
+        eq_(self.runner._next_check_wait(start, start + 280.5), 20)
+        # Never waits past the max
+        eq_(self.runner._next_check_wait(start, start + 10),
+            MAX_DONE_CHECK_WAIT)
+
+        # Wakes up to scale up the deferred step
+        steps[0]["service_status"] = "STOPPED"
+        eq_(self.runner._next_check_wait(start, start + 295), 5)
+
+        # Then for it stopping
+        steps[1]["service_status"] = "STARTED"
+        eq_(self.runner._next_check_wait(start, start + 620), 10)
+
+        # Nothing left to do
+        eq_(self.runner._next_check_wait(start, start + 700), 1)
 
     def test_check_for_cluster_done_shutdown(self):
         from ardere.exceptions import ShutdownPlanException
@@ -281,6 +849,45 @@ class TestAsyncPlanRunner(unittest.TestCase):
 
         self.runner.cleanup_cluster()
         self.mock_boto.resource.assert_called()
+        self.mock_ecs.touch_instances.assert_called()
+
+    def test_cleanup_cluster_log_streams(self):
+        self.plan["services_created_at"] = 1000
+        self.mock_ecs.run_log_streams.return_value = {
+            "TestCluster": ["ardere/TestCluster/abc"]}
+        result = self.runner.cleanup_cluster()
+        self.mock_ecs.run_log_streams.assert_called_with(
+            self.plan["steps"], 1000)
+        eq_(result["log_streams"],
+            {"TestCluster": ["ardere/TestCluster/abc"]})
+
+        # Not getting the list doesn't keep the plan from being cleaned up
+        self.mock_ecs.run_log_streams.side_effect = ClientError(
+            {"Error": {"Code": "ThrottlingException"}}, "ListTasks")
+        self.runner.cleanup_cluster()
+        self.mock_ecs.shutdown_plan.assert_called()
+
+    def test_cleanup_cluster_tear_down_annotations(self):
+        self.plan["metrics_options"] = dict(enabled=True, tear_down=True)
+        self.plan["metric_container_arn"] = "arn:::"
+        self.plan["start_time"] = 1000
+        self.mock_ecs.run_annotation_task.return_value = ["arn:task/1"]
+
+        result = self.runner.cleanup_cluster()
+        self.mock_ecs.shutdown_plan.assert_called_with(
+            self.plan["steps"], keep_metrics_service=True)
+        eq_(result["annotation_tasks"], ["arn:task/1"])
+
+    def test_cleanup_cluster_no_annotations(self):
+        self.plan["metrics_options"] = dict(enabled=True, tear_down=True)
+        self.plan["metric_container_arn"] = "arn:::"
+        self.plan["annotations_written"] = ["start"]
+        self.plan["start_time"] = 1000
+
+        result = self.runner.cleanup_cluster()
+        self.mock_ecs.shutdown_plan.assert_called_with(
+            self.plan["steps"], keep_metrics_service=False)
+        ok_("annotation_tasks" not in result)
 
     def test_cleanup_cluster_error(self):
         self.plan["plan_run_uuid"] = str(uuid.uuid4())
@@ -301,10 +908,71 @@ class TestAsyncPlanRunner(unittest.TestCase):
         assert_raises(UndrainedInstancesException,
                       self.runner.check_drained)
 
+    def test_drain_check_annotations(self):
+        from ardere.exceptions import UndrainedInstancesException
+        self.mock_ecs.all_services_done.return_value = True
+        self.plan["annotation_tasks"] = ["arn:task/1"]
+        self.plan["annotations_started_at"] = time.time()
+
+        self.mock_ecs.tasks_stopped.return_value = False
+        assert_raises(UndrainedInstancesException,
+                      self.runner.check_drained)
+        self.mock_ecs.remove_metrics_service.assert_not_called()
+
+        self.mock_ecs.tasks_stopped.side_effect = ClientError(
+            {"Error": {"Code": "ThrottlingException"}}, "DescribeTasks")
+        assert_raises(UndrainedInstancesException,
+                      self.runner.check_drained)
+
+        self.mock_ecs.tasks_stopped.side_effect = None
+        self.mock_ecs.tasks_stopped.return_value = True
+        self.runner.check_drained()
+        self.mock_ecs.remove_metrics_service.assert_called_with()
+
+    def test_drain_check_annotations_timeout(self):
+        from ardere.step_functions import ANNOTATION_WRITE_TIMEOUT
+        self.mock_ecs.all_services_done.return_value = True
+        self.plan["annotation_tasks"] = ["arn:task/1"]
+        self.plan["annotations_started_at"] = \
+            time.time() - ANNOTATION_WRITE_TIMEOUT
+        self.mock_ecs.tasks_stopped.return_value = False
+
+        self.runner.check_drained()
+        self.mock_ecs.remove_metrics_service.assert_called_with()
+
+
+class TestInstancePoolReaper(unittest.TestCase):
+    def _make_FUT(self, event):
+        from ardere.step_functions import InstancePoolReaper
+        reaper = InstancePoolReaper(event, None)
+        reaper.ecs_manager = self.mock_manager = mock.Mock()
+        self.mock_ecs = self.mock_manager.return_value
+        return reaper
+
+    def test_reap_discovers_clusters(self):
+        os.environ["pool_idle_ttl"] = "600"
+        reaper = self._make_FUT({})
+        eq_(reaper.idle_ttl, 600)
+        self.mock_manager.pooled_clusters.return_value = ["a", "b"]
+        self.mock_ecs.reap_idle_instances.return_value = ["i-1"]
+
+        result = reaper.reap_idle_instances()
+        eq_(result["terminated"], {"a": ["i-1"], "b": ["i-1"]})
+        self.mock_ecs.reap_idle_instances.assert_called_with(600)
+
+    def test_reap_named_clusters(self):
+        reaper = self._make_FUT({"ecs_names": ["c"], "idle_ttl": 30})
+        self.mock_ecs.reap_idle_instances.return_value = []
+
+        result = reaper.reap_idle_instances()
+        eq_(result["terminated"], {"c": []})
+        self.mock_manager.pooled_clusters.assert_not_called()
+        self.mock_ecs.reap_idle_instances.assert_called_with(30)
+
 
 class TestValidation(unittest.TestCase):
     def _make_FUT(self):
-        from ardere.step_functions import PlanValidator
+        from ardere.validation import PlanValidator
         return PlanValidator()
 
     def test_validate_success(self):
@@ -315,6 +983,15 @@ class TestValidation(unittest.TestCase):
         eq_(errors, {})
         eq_(len(data["steps"]), len(plan["steps"]))
 
+    def test_validate_keeps_plan_run_uuid(self):
+        schema = self._make_FUT()
+        schema.context["boto"] = mock.Mock()
+        plan = json.loads(fixtures.sample_basic_test_plan)
+        plan["plan_run_uuid"] = "abc"
+        data, errors = schema.load(plan)
+        eq_(errors, {})
+        eq_(data["plan_run_uuid"], "abc")
+
     def test_validate_fail_ecs_name(self):
         schema = self._make_FUT()
         schema.context["boto"] = mock.Mock()
@@ -346,6 +1023,70 @@ class TestValidation(unittest.TestCase):
         data, errors = schema.load(plan)
         eq_(errors, {'steps': {0: {'name': ['Step name too long']}}})
 
+    def test_validate_tasks_per_vcpu(self):
+        schema = self._make_FUT()
+        schema.context["boto"] = mock.Mock()
+        plan = json.loads(fixtures.sample_basic_test_plan)
+        del plan["steps"][0]["port_mapping"]
+        plan["steps"][0]["instance_type"] = "c4.2xlarge"
+        plan["steps"][0]["task_per_vcpu"] = True
+        data, errors = schema.load(plan)
+        eq_(errors, {})
+        eq_(data["steps"][0]["tasks_per_instance"], 8)
+        ok_("task_per_vcpu" not in data["steps"][0])
+
+    def test_validate_tasks_per_vcpu_container_limit(self):
+        schema = self._make_FUT()
+        schema.context["boto"] = mock.Mock()
+        plan = json.loads(fixtures.sample_basic_test_plan)
+        del plan["steps"][0]["port_mapping"]
+        plan["steps"][0]["instance_type"] = "c4.8xlarge"
+        plan["steps"][0]["task_per_vcpu"] = True
+        data, errors = schema.load(plan)
+        eq_(errors, {"steps": [
+            "Step TestCluster can run at most 9 tasks per instance"]})
+
+    def test_validate_tasks_per_instance_histograms(self):
+        schema = self._make_FUT()
+        schema.context["boto"] = mock.Mock()
+        plan = json.loads(fixtures.sample_basic_test_plan)
+        del plan["steps"][0]["port_mapping"]
+        plan["steps"][0]["tasks_per_instance"] = 9
+        data, errors = schema.load(plan)
+        eq_(errors, {})
+        plan["metrics_options"] = dict(histograms=True)
+        data, errors = schema.load(plan)
+        eq_(errors, {"steps": [
+            "Step TestCluster can run at most 8 tasks per instance"]})
+        plan["steps"][0]["tasks_per_instance"] = 10
+        data, errors = schema.load(plan)
+        ok_("tasks_per_instance" in errors["steps"][0])
+
+    def test_validate_ready_bounds(self):
+        schema = self._make_FUT()
+        schema.context["boto"] = mock.Mock()
+        plan = json.loads(fixtures.sample_basic_test_plan)
+        plan["ready_threshold"] = 0.5
+        plan["ready_timeout"] = 1800
+        data, errors = schema.load(plan)
+        eq_(errors, {})
+
+        plan["ready_threshold"] = 0
+        plan["steps"][0]["ready_threshold"] = 0.0
+        plan["ready_timeout"] = 1801
+        data, errors = schema.load(plan)
+        eq_(sorted(errors), ["ready_threshold", "ready_timeout", "steps"])
+        ok_("ready_threshold" in errors["steps"][0])
+
+    def test_validate_tasks_per_instance_ports(self):
+        schema = self._make_FUT()
+        schema.context["boto"] = mock.Mock()
+        plan = json.loads(fixtures.sample_basic_test_plan)
+        plan["steps"][0]["tasks_per_instance"] = 2
+        data, errors = schema.load(plan)
+        eq_(errors, {"steps": {0: {"tasks_per_instance": [
+            "port_mapping can't be used with several tasks per instance"]}}})
+
     def test_validate_fail(self):
         schema = self._make_FUT()
         schema.context["boto"] = mock_boto = mock.Mock()